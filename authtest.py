@@ -0,0 +1,231 @@
+import os
+import socket
+import asyncio
+import tempfile
+import threading
+import time
+import unittest
+import db
+from protocol import (FrameParser, encode_frame, encode_auth, decode_auth_result, AUTH_REQUIRED,
+                      REQUEST_PUBLIC_KEY, PUBLIC_KEY, PEER_PUBLIC_KEY, JOIN, AUTH, AUTH_RESULT)
+from server import ChatServer
+from server_async import AsyncChatServer
+from server_auth import Authenticator, TTLCache, THROTTLED, INVALID_CREDENTIALS
+from server_metrics import Metrics
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+    """Test cases for the LRU + TTL cache."""
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(2, 60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_entries_expire(self):
+        clock = FakeClock()
+        cache = TTLCache(10, 60, clock)
+        cache.put('a', 1)
+        clock.now += 59
+        self.assertEqual(cache.get('a'), 1)
+        clock.now += 1
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+
+class AuthDatabaseMixin:
+    """A users.db with one account, hashed at a cheap cost."""
+
+    def setUp(self):
+        self.original_cost = db.hash_parameters()
+        db.set_hash_cost(n=2 ** 10)
+        self.db_fd, self.db_path = tempfile.mkstemp()
+        database = db.Database(self.db_path)
+        db.create_table(database)
+        db.register_user('alice', 'correct horse', database)
+        database.close()
+
+    def tearDown(self):
+        db.set_hash_cost(*self.original_cost[1:])
+        os.close(self.db_fd)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_path + suffix):
+                os.unlink(self.db_path + suffix)
+
+
+class TestAuthenticator(AuthDatabaseMixin, unittest.TestCase):
+    """Test cases for verification caching and failure throttling."""
+
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+        self.metrics = Metrics()
+        self.auth = Authenticator(self.db_path, max_failures=3, lockout=30, metrics=self.metrics,
+                                  clock=self.clock)
+
+    def tearDown(self):
+        self.auth.close()
+        super().tearDown()
+
+    def check(self, username, password, address='10.0.0.1'):
+        return self.auth.submit(username, password, address).result(timeout=5)
+
+    def test_successful_login_is_cached(self):
+        self.assertEqual(self.check('alice', 'correct horse'), (True, ''))
+        for _ in range(5):
+            self.assertEqual(self.check('alice', 'correct horse'), (True, ''))
+        self.assertEqual(self.metrics.counter('auth_verifications'), 1)
+        self.assertEqual(self.metrics.counter('auth_cache_hits'), 5)
+        # The cache never accepts a different password.
+        self.assertEqual(self.check('alice', 'wrong'), (False, INVALID_CREDENTIALS))
+        # Entries expire, after which the password is hashed again.
+        self.clock.now += 3600
+        self.assertEqual(self.check('alice', 'correct horse'), (True, ''))
+        self.assertEqual(self.metrics.counter('auth_verifications'), 3)
+
+    def test_changed_password_voids_the_cached_login(self):
+        self.assertEqual(self.check('alice', 'correct horse'), (True, ''))
+        # Changed behind the server's back, as with another tool.
+        database = db.Database(self.db_path)
+        with database.connection() as conn:
+            conn.execute('UPDATE users SET password = ? WHERE username = ?',
+                         (db.hash_password('battery staple'), 'alice'))
+        database.close()
+        self.assertEqual(self.check('alice', 'correct horse'), (False, INVALID_CREDENTIALS))
+        self.assertEqual(self.check('alice', 'battery staple'), (True, ''))
+        self.assertEqual(self.check('alice', 'battery staple'), (True, ''))
+        self.assertEqual(self.metrics.counter('auth_cache_hits'), 1)
+
+    def test_repeated_guess_is_not_hashed_again(self):
+        self.assertEqual(self.check('alice', 'guess'), (False, INVALID_CREDENTIALS))
+        self.assertEqual(self.check('alice', 'guess'), (False, INVALID_CREDENTIALS))
+        self.assertEqual(self.metrics.counter('auth_verifications'), 1)
+        self.assertEqual(self.metrics.counter('auth_failures'), 2)
+
+    def test_failures_throttle_username_and_address(self):
+        for n in range(3):
+            self.assertFalse(self.check('alice', f'guess {n}', '10.0.0.2')[0])
+        # Locked out: even the right password is refused without hashing.
+        self.assertEqual(self.check('alice', 'correct horse', '10.0.0.3'), (False, THROTTLED))
+        self.assertEqual(self.check('bob', 'anything', '10.0.0.2'), (False, THROTTLED))
+        self.assertEqual(self.metrics.counter('auth_verifications'), 3)
+        self.clock.now += 31
+        self.assertEqual(self.check('alice', 'correct horse', '10.0.0.3'), (True, ''))
+
+    def test_lockout_grows_with_further_failures(self):
+        for n in range(3):
+            self.check('mallory', f'guess {n}')
+        self.clock.now += 31
+        # One more failure after the first lockout doubles the next one.
+        self.assertEqual(self.check('mallory', 'guess 3'), (False, INVALID_CREDENTIALS))
+        self.clock.now += 31
+        self.assertEqual(self.check('mallory', 'guess 4'), (False, THROTTLED))
+        self.clock.now += 30
+        self.assertEqual(self.check('mallory', 'guess 4'), (False, INVALID_CREDENTIALS))
+
+
+class AuthServerMixin(AuthDatabaseMixin):
+    """AUTH handshake shared by both server engines."""
+
+    def connect(self, session_id=b'room', public_key=b'KEY', credentials=None):
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+        parser = FrameParser()
+        frames = []
+
+        def read_frame():
+            while not frames:
+                if parser.recv_into(sock) == 0:
+                    return None, b''
+                frames.extend((frame_type, bytes(payload)) for frame_type, payload in parser.frames())
+            return frames.pop(0)
+
+        self.assertEqual(read_frame(), (REQUEST_PUBLIC_KEY, AUTH_REQUIRED))
+        if credentials is not None:
+            sock.sendall(encode_frame(AUTH, encode_auth(*credentials)))
+            frame_type, payload = read_frame()
+            self.assertEqual(frame_type, AUTH_RESULT)
+            ok, reason = decode_auth_result(payload)
+            if not ok:
+                self.assertEqual(read_frame()[0], None)
+                sock.close()
+                return None, reason
+        sock.sendall(encode_frame(JOIN, session_id) + encode_frame(PUBLIC_KEY, public_key))
+        return sock, read_frame
+
+    def test_authenticated_clients_are_paired(self):
+        alice, alice_read = self.connect(public_key=b'ALICE', credentials=('alice', 'correct horse'))
+        bob, bob_read = self.connect(public_key=b'BOB', credentials=('alice', 'correct horse'))
+        self.assertEqual(alice_read(), (PEER_PUBLIC_KEY, b'BOB'))
+        self.assertEqual(bob_read(), (PEER_PUBLIC_KEY, b'ALICE'))
+        self.assertEqual(self.server.metrics.counter('auth_cache_hits'), 1)
+        alice.close()
+        bob.close()
+
+    def test_wrong_password_is_refused(self):
+        sock, reason = self.connect(credentials=('alice', 'wrong'))
+        self.assertIsNone(sock)
+        self.assertEqual(reason, INVALID_CREDENTIALS)
+
+    def test_public_key_without_auth_is_dropped(self):
+        sock, read_frame = self.connect()
+        self.assertEqual(read_frame()[0], None)
+        sock.close()
+
+
+class TestThreadedServerAuth(AuthServerMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = ChatServer('127.0.0.1', 0, users_db=self.db_path)
+        threading.Thread(target=self.server.start_server, daemon=True).start()
+        while self.server.server_socket.getsockname()[1] == 0:
+            time.sleep(0.01)
+        self.port = self.server.server_socket.getsockname()[1]
+
+    def tearDown(self):
+        self.server.shutdown_server()
+        super().tearDown()
+
+
+class TestAsyncServerAuth(AuthServerMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = AsyncChatServer('127.0.0.1', 0, users_db=self.db_path)
+        self.loop = asyncio.new_event_loop()
+        self.task = self.loop.create_task(self.server.serve())
+        threading.Thread(target=self.run_loop, daemon=True).start()
+        while self.server.server is None or not self.server.server.sockets:
+            time.sleep(0.01)
+        self.port = self.server.server.sockets[0].getsockname()[1]
+
+    def run_loop(self):
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        while not self.task.done():
+            time.sleep(0.01)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.server.authenticator.close()
+        super().tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
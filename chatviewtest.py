@@ -0,0 +1,92 @@
+import sys
+import threading
+import unittest
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtTest import QTest
+from client_chat_view import MessageModel, MessageView, MessageBuffer, HISTORY_ID_ROLE
+
+app = QApplication.instance() or QApplication(sys.argv)
+
+
+class TestMessageView(unittest.TestCase):
+    """Test cases for the batched, capped chat message list."""
+
+    def setUp(self):
+        self.model = MessageModel(max_rows=1000)
+        self.view = MessageView(self.model)
+        self.view.resize(400, 300)
+        self.view.show()
+        self.buffer = MessageBuffer(self.view.append_rows, max_rows=1000)
+
+    def tearDown(self):
+        self.view.close()
+
+    def wait_until(self, condition, timeout=5000):
+        for _ in range(timeout // 10):
+            if condition():
+                return True
+            QTest.qWait(10)
+        return condition()
+
+    def text(self, row):
+        return self.model.index(row).data()
+
+    def test_burst_is_batched_and_capped(self):
+        def produce():
+            for n in range(20000):
+                self.buffer.push(f"message {n}")
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        producer.join()
+        self.assertTrue(self.wait_until(lambda: self.model.rowCount() and self.text(999) == "message 19999"))
+        self.assertEqual(self.model.rowCount(), 1000)
+        self.assertEqual(self.text(0), "message 19000")
+        self.assertLess(self.buffer.flushes, 20)
+
+    def test_view_follows_new_messages(self):
+        for n in range(200):
+            self.buffer.push(f"message {n}")
+        self.assertTrue(self.wait_until(lambda: self.model.rowCount() == 200))
+        scroll_bar = self.view.verticalScrollBar()
+        self.assertGreater(scroll_bar.maximum(), 0)
+        self.assertEqual(scroll_bar.value(), scroll_bar.maximum())
+
+    def test_prepend_keeps_the_newest_rows(self):
+        self.model.append_rows([(f"new {n}", 1000 + n) for n in range(900)])
+        self.model.prepend_rows([(f"old {n}", n) for n in range(200)])
+        self.assertEqual(self.model.rowCount(), 1100)
+        self.assertEqual(self.text(0), "old 0")
+        self.assertEqual(self.text(1099), "new 899")
+        self.assertEqual(self.model.oldest_history_id(), 0)
+        self.assertEqual(self.model.index(200).data(HISTORY_ID_ROLE), 1000)
+
+    def test_nothing_is_trimmed_while_scrolled_up(self):
+        self.view.append_rows([(f"new {n}", 1000 + n) for n in range(900)])
+        QTest.qWait(10)
+        self.view.verticalScrollBar().setValue(0)
+        self.view.prepend_rows([(f"old {n}", n) for n in range(200)])
+        # Live messages arriving while the user reads older ones.
+        self.view.append_rows([(f"live {n}", 2000 + n) for n in range(50)])
+        self.assertEqual(self.model.rowCount(), 1150)
+        self.assertEqual(self.text(1149), "live 49")
+        # Back at the bottom, the oldest rows go; history can page them in again.
+        self.view.scrollToBottom()
+        self.assertTrue(self.wait_until(lambda: self.model.rowCount() == 1000))
+        self.assertEqual(self.text(999), "live 49")
+        self.assertEqual(self.text(0), "old 150")
+        scroll_bar = self.view.verticalScrollBar()
+        self.assertEqual(scroll_bar.value(), scroll_bar.maximum())
+
+    def test_scrolling_to_top_requests_older_messages(self):
+        requests = []
+        self.view.older_requested.connect(lambda: requests.append(True))
+        self.model.append_rows([(f"message {n}", n) for n in range(200)])
+        self.view.scrollToBottom()
+        QTest.qWait(10)
+        self.view.verticalScrollBar().setValue(0)
+        self.assertEqual(len(requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,221 +1,167 @@
-import ssl
+import time
+
+# Taken before anything else is imported, for --startup-report.
+STARTED = time.perf_counter()
+
+import os
 import sys
-import socket
+import argparse
 import threading
+import multiprocessing
 from PyQt5.QtWidgets import QApplication
-from PyQt5.QtCore import pyqtSlot, Qt, QMetaObject, Q_ARG
-from client_gui import ChatClientGUI
-from client_crypto import CryptoManager
+from PyQt5.QtCore import QObject, QEvent, QTimer
+from client_keys import KeyPool, KeyCache
 from login_gui import LoginSignupGUI
-from db import create_table
-
-
-class ChatClient:
-    def __init__(self, gui, crypto_manager, username):
-        self.gui = gui
-        self.crypto_manager = crypto_manager
-        self.username = username
-        self.sock = None
-        self.connected = False
-        self.public_key_timer = None
-        self.gui.disconnectButton.setEnabled(False)
-
-        # Update window title to include username
-        self.gui.setWindowTitle(f"Secure Chat - {username}")
-
-        self.lock = threading.Lock()  # Synchronize access to the socket
 
-        self.gui.connectButton.clicked.connect(self.connect_to_server)
-        self.gui.disconnectButton.clicked.connect(self.disconnect_from_server)
-        self.gui.sendButton.clicked.connect(self.send_message)
+# Only what the login window needs is imported up front. The chat window,
+# crypto, networking and the accounts database load while the user is
+# typing: the chat modules on a background thread once the login window has
+# painted, and the database on the login worker, where password checks
+# queue up behind it. Run with --startup-report (or see startupbench.py) to
+# time it.
 
-        # Connect the Enter key press to sending the message
-        self.gui.messageInput.returnPressed.connect(self.send_message)  
+# Imported in the background after the first paint.
+CHAT_MODULES = ('client_controller', 'client_gui', 'client_crypto', 'client_history')
 
-        self.connect_button_order()
 
-    def connect_to_server(self):
-        host = self.gui.serverIpInput.text()
-        port = self.gui.serverPortInput.text()
-
-        if not host or not port:
-            self.append_message("Please enter a valid IP and port.")
-            return
-
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        
-# Uncomment here for SSL/TLS certificate---------------------
-        
-        # Wrap the socket with SSL/TLS
-        # context = ssl.create_default_context()
-        # context.verify_mode = ssl.CERT_REQUIRED
-        # context.check_hostname = True 
-        # context.load_verify_locations('path/to/fullchain.pem')
-
-        # self.sock = context.wrap_socket(self.sock, server_hostname=host)
-
-# ------------------------------------------------------------
-        try:
-            self.sock.connect((host, int(port)))
-            self.connected = True
-            self.append_message(f"Connected to server as {self.username}...")
-            self.append_message("Waiting for your friend's connection...")
-            self.gui.update_connection_status("Connecting")
-            self.disconnect_button_order()
-
-            threading.Thread(target=self.listen_for_messages, daemon=True).start()
-        except Exception as e:
-            self.append_message(f"Failed to connect to server: {e}")
-            self.gui.update_connection_status("Disconnected")
-            self.gui.disconnectButton.setEnabled(False)
+def elapsed_ms():
+    return (time.perf_counter() - STARTED) * 1000
 
-    def disconnect_from_server(self):
-        self.close_connection()
-        self.connect_button_order()
-        self.gui.update_connection_status("Disconnected")
 
-    def listen_for_messages(self):
+def preload(modules, done):
+    import importlib
+    for name in modules:
         try:
-            while self.connected:
-                message = self.sock.recv(4096).decode('utf-8')
-                if not message:
-                    continue
-
-                if message.startswith("REQUEST_PUBLIC_KEY"):
-                    self.send_public_key()
-                elif message.startswith("PEER_PUBLIC_KEY"):
-                    self.receive_peer_public_key(message)
-                elif message.startswith("DISCONNECT"):
-                    self.append_message("Disconnected from server.")
-                    self.connected = False
-                    self.connect_button_order()
-                    self.gui.update_connection_status("Disconnected")
-                else:
-                    self.receive_message(message)
-        except socket.error as e:
-            if self.connected:
-                self.append_message(f"Socket error: {e}")
-                self.close_connection()
-                self.connect_button_order()
-                self.gui.update_connection_status("Disconnected")
+            importlib.import_module(name)
         except Exception as e:
-            if self.connected:
-                self.append_message(f"Disconnected from server: {e}")
-                self.close_connection()
-                self.connect_button_order()
-                self.gui.update_connection_status("Disconnected")
-
-    def send_public_key(self):
-        public_key = self.crypto_manager.get_public_key().decode('utf-8')
-        self.sock.sendall(f"PUBLIC_KEY:{public_key}".encode('utf-8'))
-        self.start_public_key_timer()
-
-    def start_public_key_timer(self):
-        if self.public_key_timer:
-            self.public_key_timer.cancel()
-        self.public_key_timer = threading.Timer(60.0, self.handle_public_key_timeout)
-        self.public_key_timer.start()
-
-    def handle_public_key_timeout(self):
-        self.append_message("Public key exchange timed out. Disconnecting...")
-        self.close_connection()
-        self.connect_button_order()
-        self.gui.update_connection_status("Disconnected")
-
-    def receive_peer_public_key(self, message):
-        if self.public_key_timer:
-            self.public_key_timer.cancel()
-        peer_public_key = message.split(":", 1)[1]
-        self.crypto_manager.set_peer_public_key(peer_public_key)
-        self.append_message("Your friend is now connected.")
-        self.gui.update_connection_status("Connected")
-
-        self.disconnect_button_order()
-
-    def send_message(self):
-        message = self.gui.messageInput.text()
-        if message and self.crypto_manager.peer_public_key:
-            encrypted_message = self.crypto_manager.encrypt_message(message)
-            try:
-                self.sock.sendall(encrypted_message.encode('utf-8'))
-                self.gui.messageInput.clear()
-                self.append_message(f"You: {message}")
-            except Exception as e:
-                self.append_message(f"Failed to send message: {e}")
-                self.close_connection()
-                self.connect_button_order()
-                self.gui.update_connection_status("Disconnected")
-        else:
-            self.append_message("No peer public key set or empty message.")
-
-    def receive_message(self, message):
-        try:
-            decrypted_message = self.crypto_manager.decrypt_message(message)
-            if decrypted_message:  # Check if decrypted message is valid
-                self.append_message(f"Peer: {decrypted_message}")
-        except Exception as e:
-            self.append_message(f"Failed to decrypt message: {e}")
-
-    def close_connection(self):
-        with self.lock:
-            if self.connected:
-                self.connected = False
-                try:
-                    self.sock.sendall("DISCONNECT".encode('utf-8'))
-                except socket.error:
-                    pass  # Ignore errors while sending disconnect
-                finally:
-                    try:
-                        self.sock.close()
-                    except socket.error:
-                        pass  # Ignore errors while closing the socket
-                self.append_message("Connection closed.")
-        return  # Ensure no further processing
-
-    def append_message(self, message):
-        QMetaObject.invokeMethod(self.gui, "append_message", Qt.QueuedConnection, Q_ARG(str, message))
-
-    def connect_button_order(self):
-        self.gui.disconnectButton.setEnabled(False)
-        self.gui.connectButton.setEnabled(True)
-    
-    def disconnect_button_order(self):
-        self.gui.disconnectButton.setEnabled(True)
-        self.gui.connectButton.setEnabled(False)
+            # Importing again on the GUI thread at login reports it properly.
+            print(f"Could not preload {name}: {e}")
+    done.set()
+
+
+def prepare_database(path):
+    import sqlite3
+    import db
+    try:
+        db.configure(path or db.DEFAULT_DB_PATH)
+        db.create_table()
+    except (OSError, sqlite3.Error) as e:
+        print(f"Could not open the accounts database: {e}")
+
+
+class FirstPaint(QObject):
+    """Calls callback() once, when the watched widget first paints."""
+
+    def __init__(self, widget, callback):
+        super().__init__(widget)
+        self.callback = callback
+        widget.installEventFilter(self)
+
+    def eventFilter(self, watched, event):
+        if event.type() == QEvent.Paint:
+            watched.removeEventFilter(self)
+            # Let the paint finish before running anything slow.
+            QTimer.singleShot(0, self.callback)
+        return False
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Secure chat client")
+    parser.add_argument('--tls', action='store_true', help="connect to the server over TLS")
+    parser.add_argument('--tls-ca', help="CA bundle used to verify the server certificate (e.g. cacert.pem)")
+    parser.add_argument('--download-dir', help="where received files are saved (default: ~/Downloads)")
+    parser.add_argument('--key-cache', metavar='DIR',
+                        help="keep each user's private key here, encrypted with their password, "
+                             "so later logins skip key generation")
+    parser.add_argument('--database',
+                        help="SQLite file holding user accounts (default: $CHAT_DB_PATH or users.db)")
+    parser.add_argument('--history-dir',
+                        help="where each user's encrypted chat history is kept (default: next to --database)")
+    parser.add_argument('--no-history', action='store_true', help="do not save or show chat history")
+    parser.add_argument('--startup-report', action='store_true',
+                        help="print how long the first window and the chat modules took, then exit")
+    # Qt consumes its own command-line options, so ignore anything unknown.
+    args, _ = parser.parse_known_args(argv)
+    return args
 
 
 def main():
+    args = parse_args(sys.argv[1:])
+
+    # Start generating a keypair now, before Qt is up, so one is ready (or
+    # nearly) by the time the user has logged in. Only one is ever needed,
+    # and none if the user's key is cached: with keys in the cache, the pool
+    # only starts on a miss, in a spawned process since Qt is up by then.
+    key_cache = KeyCache(args.key_cache) if args.key_cache else None
+    if key_cache is not None and key_cache.has_keys():
+        key_pool = KeyPool(limit=1, mp_context=multiprocessing.get_context('spawn'))
+    else:
+        key_pool = KeyPool(limit=1)
+        key_pool.start()
+
     # Create application
     app = QApplication(sys.argv)
-    
-    # Initialize database
-    create_table()
-    
-    # Create login window
+
+    # Create login window; login checks wait on its worker for the database.
     login_window = LoginSignupGUI()
-    
+    login_window.executor.submit(prepare_database, args.database)
+    chat_modules_loaded = threading.Event()
+
+    def on_first_paint():
+        if args.startup_report:
+            print(f"Startup: first window painted after {elapsed_ms():.1f} ms", file=sys.stderr, flush=True)
+        modules = CHAT_MODULES + (('tls',) if args.tls or args.tls_ca else ())
+        threading.Thread(target=preload, args=(modules, chat_modules_loaded), name="preload",
+                         daemon=True).start()
+        if args.startup_report:
+            chat_modules_loaded.wait()
+            print(f"Startup: chat modules loaded after {elapsed_ms():.1f} ms", file=sys.stderr, flush=True)
+            app.quit()
+
+    FirstPaint(login_window, on_first_paint)
+
     # Function to handle successful login
     def on_login_successful(username):
+        import db
+        from client_controller import ChatClient, DEFAULT_DOWNLOAD_DIR
+        from client_crypto import CryptoManager
+        from client_gui import ChatClientGUI
+        from client_keys import load_or_generate
+
+        password = login_window.login_password.text()
         login_window.hide()
-        
-        # Create the chat GUI and client
+
+        # Create the chat GUI and client. The private key is still being
+        # generated or unlocked in the background; the window does not wait.
         chat_gui = ChatClientGUI()
-        crypto_manager = CryptoManager()
-        client = ChatClient(chat_gui, crypto_manager, username)
-        
+        crypto_manager = CryptoManager(private_key=load_or_generate(key_pool, username, password, key_cache))
+        tls_context = None
+        if args.tls or args.tls_ca:
+            from tls import create_client_context
+            tls_context = create_client_context(args.tls_ca)
+        client = ChatClient(chat_gui, crypto_manager, username, tls_context,
+                            args.download_dir or DEFAULT_DOWNLOAD_DIR, password)
+        if not args.no_history:
+            # Unlocked on the login worker; the window does not wait for it.
+            history_dir = args.history_dir or os.path.dirname(os.path.abspath(db.get_database().path))
+            client.load_history(login_window.executor, history_dir, password)
+
         # Handle closing the window
-        chat_gui.closeEvent = lambda event: (client.close_connection(), event.accept())
-        
+        chat_gui.closeEvent = lambda event: (client.close_connection(), client.decrypt_pipeline.close(),
+                                             client.history and client.history.close(), event.accept())
+
         chat_gui.show()
-    
+
     # Connect the login_successful signal to our handler
     login_window.login_successful.connect(on_login_successful)
-    
+
     # Show login window
     login_window.show()
-    
-    sys.exit(app.exec_())
+
+    status = app.exec_()
+    key_pool.shutdown()
+    sys.exit(status)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
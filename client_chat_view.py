@@ -0,0 +1,186 @@
+import threading
+import collections
+from PyQt5.QtCore import (Qt, QObject, QAbstractListModel, QModelIndex, QPoint, QSize, QTimer, QMetaObject,
+                          pyqtSignal, pyqtSlot)
+from PyQt5.QtGui import QPalette
+from PyQt5.QtWidgets import QListView, QStyledItemDelegate, QAbstractItemView
+
+# The chat window as a model/view list instead of a growing QTextEdit.
+#
+# Messages from any thread go into a MessageBuffer, which hands them to the
+# view in one batch per frame: a burst of thousands of messages costs one
+# queued call and one model insert every FLUSH_INTERVAL_MS, not one of each
+# per message. While the view follows the newest messages the model keeps
+# at most max_rows rows, dropping the oldest (history pages them back in
+# when the user scrolls up). While the user is scrolled up nothing is
+# dropped, since newer rows could not be brought back; the model is trimmed
+# once the view is back at the bottom. QListView only lays out and paints
+# the rows on screen.
+
+DEFAULT_MAX_ROWS = 5000
+FLUSH_INTERVAL_MS = 16
+HISTORY_ID_ROLE = Qt.UserRole + 1
+PADDING = 4
+
+
+class MessageModel(QAbstractListModel):
+    """Rows of (text, history id or None), trimmed to max_rows from the
+    oldest end."""
+
+    def __init__(self, max_rows=DEFAULT_MAX_ROWS, parent=None):
+        super().__init__(parent)
+        self.max_rows = max_rows
+        self.rows = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            return self.rows[index.row()][0]
+        if role == HISTORY_ID_ROLE:
+            return self.rows[index.row()][1]
+        return None
+
+    def append_rows(self, rows, trim=True):
+        if trim:
+            rows = rows[-self.max_rows:]
+            self.trim(len(rows))
+        self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+
+    def prepend_rows(self, rows):
+        # Never trimmed here: the newest rows would be lost for good.
+        self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+        self.rows[0:0] = rows
+        self.endInsertRows()
+
+    def trim(self, incoming=0):
+        """Drop the oldest rows so that incoming more fit in max_rows;
+        returns how many were dropped."""
+        excess = min(len(self.rows), len(self.rows) + incoming - self.max_rows)
+        if excess > 0:
+            self.beginRemoveRows(QModelIndex(), 0, excess - 1)
+            del self.rows[:excess]
+            self.endRemoveRows()
+        return max(excess, 0)
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.endResetModel()
+
+    def oldest_history_id(self):
+        return next((history_id for _, history_id in self.rows if history_id is not None), None)
+
+
+class MessageBuffer(QObject):
+    """Coalesces messages pushed from any thread into one sink(rows) call
+    per flush interval, on the GUI thread."""
+
+    def __init__(self, sink, max_rows=DEFAULT_MAX_ROWS, interval_ms=FLUSH_INTERVAL_MS, parent=None):
+        super().__init__(parent)
+        self.sink = sink
+        self.interval_ms = interval_ms
+        # Anything beyond max_rows would be trimmed from the view anyway.
+        self.pending = collections.deque(maxlen=max_rows)
+        self.lock = threading.Lock()
+        self.scheduled = False
+        self.flushes = 0
+
+    def push(self, text, history_id=None):
+        with self.lock:
+            self.pending.append((text, history_id))
+            if self.scheduled:
+                return
+            self.scheduled = True
+        # Only the first message of a batch crosses threads.
+        QMetaObject.invokeMethod(self, "schedule_flush", Qt.QueuedConnection)
+
+    @pyqtSlot()
+    def schedule_flush(self):
+        QTimer.singleShot(self.interval_ms, self.flush)
+
+    @pyqtSlot()
+    def flush(self):
+        with self.lock:
+            rows = list(self.pending)
+            self.pending.clear()
+            self.scheduled = False
+        if rows:
+            self.flushes += 1
+            self.sink(rows)
+
+
+class MessageDelegate(QStyledItemDelegate):
+    """Draws a row as word-wrapped plain text."""
+
+    def text_rect_width(self, option):
+        view = self.parent()
+        width = view.viewport().width() if view is not None else option.rect.width()
+        return max(width - 2 * PADDING, 50)
+
+    def sizeHint(self, option, index):
+        width = self.text_rect_width(option)
+        rect = option.fontMetrics.boundingRect(0, 0, width, 1 << 20, Qt.TextWordWrap, index.data() or '')
+        return QSize(width, rect.height() + 2 * PADDING)
+
+    def paint(self, painter, option, index):
+        painter.save()
+        painter.setPen(option.palette.color(QPalette.Text))
+        painter.drawText(option.rect.adjusted(PADDING, PADDING, -PADDING, -PADDING), Qt.TextWordWrap,
+                         index.data() or '')
+        painter.restore()
+
+
+class MessageView(QListView):
+    """Read-only, auto-scrolling message list over a MessageModel."""
+
+    # Emitted when scrolled to the top, to page in older history.
+    older_requested = pyqtSignal()
+
+    def __init__(self, model, parent=None):
+        super().__init__(parent)
+        self.setModel(model)
+        self.setItemDelegate(MessageDelegate(self))
+        self.setUniformItemSizes(False)
+        self.setWordWrap(True)
+        # Lay out rows in batches so a large model never stalls a repaint.
+        self.setLayoutMode(QListView.Batched)
+        self.setBatchSize(200)
+        self.setResizeMode(QListView.Adjust)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.verticalScrollBar().valueChanged.connect(self.scrolled)
+
+    def following(self):
+        scroll_bar = self.verticalScrollBar()
+        return scroll_bar.value() >= scroll_bar.maximum() - PADDING
+
+    def append_rows(self, rows):
+        # Only trimmed while following: the user may be reading the oldest rows.
+        following = self.following()
+        self.model().append_rows(rows, trim=following)
+        if following:
+            self.scrollToBottom()
+
+    def prepend_rows(self, rows):
+        # Keep the row at the top of the view where it is.
+        top = self.indexAt(QPoint(PADDING, PADDING))
+        self.model().prepend_rows(rows)
+        if top.isValid():
+            self.scrollTo(self.model().index(top.row() + len(rows)), QAbstractItemView.PositionAtTop)
+
+    def scrolled(self, value):
+        scroll_bar = self.verticalScrollBar()
+        if scroll_bar.maximum() == scroll_bar.minimum():
+            return
+        if value == scroll_bar.minimum():
+            self.older_requested.emit()
+        elif self.following() and self.model().trim():
+            # Back at the bottom: drop what was paged in or kept meanwhile.
+            self.scrollToBottom()
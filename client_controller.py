@@ -0,0 +1,271 @@
+import os
+import sqlite3
+import asyncio
+import threading
+from PyQt5.QtWidgets import QFileDialog
+from PyQt5.QtCore import QObject, Qt, QMetaObject, Q_ARG, pyqtSignal
+from client_core import ChatConnection
+from client_crypto import RECORD_MESSAGE
+from client_history import HistoryStore
+from client_pipeline import DecryptPipeline
+from client_transfer import FileTransferManager
+
+CLOSE_TIMEOUT = 1.0
+DEFAULT_DOWNLOAD_DIR = os.path.join(os.path.expanduser('~'), 'Downloads')
+
+
+class ConnectionEvents(QObject):
+    # Emitted on other threads; Qt delivers them on the GUI thread.
+    status_changed = pyqtSignal(str)
+    history_opened = pyqtSignal(object)  # Future of a HistoryStore
+
+
+class ChatClient:
+    """PyQt front end for a client_core.ChatConnection.
+
+    The connection runs on an event loop in a background thread; this class
+    only turns button presses into calls on it and its callbacks into
+    messages and status changes in the window.
+    """
+
+    def __init__(self, gui, crypto_manager, username, tls_context=None, download_dir=DEFAULT_DOWNLOAD_DIR,
+                 password=None, history=None):
+        self.gui = gui
+        self.crypto_manager = crypto_manager
+        self.username = username
+        self.password = password
+        # Encrypted local history of each conversation, shown a page at a time.
+        self.history = history
+        self.conversation = None
+        self.session_id = b''
+        self.tls_context = tls_context
+        self.connection = None
+        self.connected = False
+        self.transfers = FileTransferManager(crypto_manager, self.send_record, self.send_chunk,
+                                             self.report_transfer_progress, self.append_message, download_dir)
+        # Incoming messages are decrypted off the network thread and handed
+        # to the GUI in arrival order.
+        self.decrypt_pipeline = DecryptPipeline(crypto_manager, self.show_peer_message,
+                                                self.show_decrypt_error,
+                                                on_control=self.transfers.handle_control,
+                                                on_chunk=self.transfers.handle_chunk)
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="network", daemon=True).start()
+        self.events = ConnectionEvents()
+        self.events.status_changed.connect(self.show_connection_status)
+        self.events.history_opened.connect(self.history_opened)
+        self.gui.disconnectButton.setEnabled(False)
+
+        # Update window title to include username
+        self.gui.setWindowTitle(f"Secure Chat - {username}")
+
+        self.lock = threading.Lock()  # Guards closing the connection
+        # File transfers send from their own threads, so sequenced records
+        # are numbered and queued for the network thread under this lock.
+        self.send_lock = threading.Lock()
+
+        self.gui.connectButton.clicked.connect(self.connect_to_server)
+        self.gui.disconnectButton.clicked.connect(self.disconnect_from_server)
+        self.gui.sendButton.clicked.connect(self.send_message)
+        self.gui.sendFileButton.clicked.connect(self.choose_file)
+        self.gui.older_history_requested.connect(self.show_older_history)
+
+        # Connect the Enter key press to sending the message
+        self.gui.messageInput.returnPressed.connect(self.send_message)  
+
+        self.connect_button_order()
+
+    def connect_to_server(self):
+        host = self.gui.serverIpInput.text()
+        port = self.gui.serverPortInput.text()
+
+        if not host or not port.isdigit():
+            self.append_message("Please enter a valid IP and port.")
+            return
+
+        self.session_id = self.gui.sessionInput.text().strip().encode('utf-8')
+        self.open_conversation(self.session_id.decode('utf-8'))
+        self.connection = ChatConnection(self.crypto_manager, self.username, self.session_id, self.password,
+                                         receive=self.decrypt_pipeline.submit, on_peer=self.peer_connected,
+                                         on_reconnecting=self.reconnecting, on_resumed=self.resumed,
+                                         on_peer_left=self.peer_left)
+        self.disconnect_button_order()
+        asyncio.run_coroutine_threadsafe(self.run_connection(self.connection, host, int(port)), self.loop)
+
+    async def run_connection(self, connection, host, port):
+        try:
+            await connection.connect(host, port, ssl=self.tls_context)
+        except OSError as e:
+            self.append_message(f"Failed to connect to server: {e}")
+            self.events.status_changed.emit("Disconnected")
+            return
+        self.connected = True
+        self.append_message(f"Connected to server as {self.username}...")
+        # The key exchange may already be done by the time connect() returns.
+        if not connection.peer_connected:
+            self.append_message("Waiting for your friend's connection...")
+            self.events.status_changed.emit("Connecting")
+        reason = await connection.wait_closed()
+        self.connected = False
+        self.transfers.connection_lost()
+        if reason is None:
+            self.append_message("Connection closed.")
+        else:
+            self.append_message(f"Disconnected from server: {reason}")
+        self.events.status_changed.emit("Disconnected")
+
+    def peer_connected(self):
+        self.append_message("Your friend is now connected.")
+        self.events.status_changed.emit("Connected")
+        self.transfers.resume()
+
+    def peer_left(self):
+        self.append_message("Your friend left. Messages you send are kept until they are back.")
+        self.events.status_changed.emit("Connecting")
+        self.transfers.connection_lost()
+
+    def reconnecting(self, reason, delay):
+        # Messages typed meanwhile are held and sent once we are back.
+        self.append_message(f"Connection lost ({reason}); reconnecting in {delay:.1f}s...")
+        self.events.status_changed.emit("Connecting")
+
+    def resumed(self):
+        self.append_message("Reconnected.")
+        self.events.status_changed.emit("Connected")
+
+    def show_connection_status(self, status):
+        self.gui.update_connection_status(status)
+        if status == "Disconnected":
+            self.connect_button_order()
+        else:
+            self.disconnect_button_order()
+
+    def load_history(self, executor, directory, password):
+        """Open the user's history on executor, since deriving its keys is
+        slow, and start using it on the GUI thread once it is open."""
+        future = executor.submit(HistoryStore.for_user, directory, self.username, password)
+        future.add_done_callback(self.events.history_opened.emit)
+
+    def history_opened(self, future):
+        try:
+            self.history = future.result()
+        except (ValueError, OSError, sqlite3.Error) as e:
+            print(f"Chat history unavailable: {e}")
+            return
+        if self.connection is not None:
+            # Already in a conversation: page its history in above what is shown.
+            self.conversation = self.session_id.decode('utf-8')
+            self.show_older_history()
+
+    def open_conversation(self, conversation):
+        if self.history is None or conversation == self.conversation:
+            return
+        self.conversation = conversation
+        self.gui.clear_messages()
+        self.show_older_history()
+        self.gui.chatWindow.scrollToBottom()
+
+    def show_older_history(self):
+        if self.history is None or self.conversation is None:
+            return
+        # Rows trimmed off the top of the view are paged back in from here.
+        oldest = self.gui.messagesModel.oldest_history_id()
+        messages = self.history.page(self.conversation, before=oldest)
+        self.gui.prepend_messages([(f"{'You' if m.outgoing else 'Peer'}: {m.text}", m.id) for m in messages])
+
+    def record_history(self, outgoing, text):
+        """Save a message; returns its history id, or None."""
+        if self.history is None or self.conversation is None:
+            return None
+        try:
+            return self.history.append(self.conversation, outgoing, text)
+        except Exception as e:
+            print(f"Could not save message to history: {e}")
+            return None
+
+    def disconnect_from_server(self):
+        self.close_connection()
+
+    def send_message(self):
+        message = self.gui.messageInput.text()
+        if message and self.crypto_manager.peer_public_key:
+            try:
+                if self.crypto_manager.has_session():
+                    self.send_record(RECORD_MESSAGE, message)
+                else:
+                    self.send_payload(self.crypto_manager.encrypt_message(message).encode('utf-8'))
+                self.gui.messageInput.clear()
+                self.append_message(f"You: {message}", self.record_history(True, message))
+            except Exception as e:
+                self.append_message(f"Failed to send message: {e}")
+                self.close_connection()
+        else:
+            self.append_message("No peer public key set or empty message.")
+
+    def current_connection(self):
+        if self.connection is None or not self.connected:
+            raise ConnectionError("Not connected")
+        return self.connection
+
+    def send_payload(self, payload):
+        with self.send_lock:
+            self.current_connection().send_threadsafe(payload)
+
+    def send_record(self, kind, plaintext):
+        # Numbered and queued under one lock so records leave in counter order.
+        with self.send_lock:
+            self.current_connection().send_threadsafe(self.crypto_manager.encrypt_payload(plaintext, kind))
+
+    def send_chunk(self, record):
+        self.send_payload(record)
+
+    def choose_file(self):
+        if not self.connected or not self.crypto_manager.has_session() or self.connection.peer_away:
+            self.append_message("Connect to your friend before sending a file.")
+            return
+        path, _ = QFileDialog.getOpenFileName(self.gui, "Send File")
+        if path:
+            try:
+                self.transfers.send_file(path)
+            except OSError as e:
+                self.append_message(f"Failed to send file: {e}")
+
+    def report_transfer_progress(self, name, done, total):
+        percent = int(done * 100 / total) if total else 100
+        text = f"{name}: {done / 1e6:.1f} of {total / 1e6:.1f} MB"
+        QMetaObject.invokeMethod(self.gui, "update_transfer_progress", Qt.QueuedConnection,
+                                 Q_ARG(str, text), Q_ARG(int, percent))
+
+    def show_peer_message(self, plaintext):
+        text = plaintext.decode('utf-8')
+        self.append_message(f"Peer: {text}", self.record_history(False, text))
+
+    def show_decrypt_error(self, error):
+        self.append_message(f"Failed to decrypt message: {error}")
+
+    def close_connection(self):
+        self.transfers.connection_lost()
+        with self.lock:
+            if not self.connected:
+                return
+            self.connected = False
+            # Wait briefly so DISCONNECT is on the wire before the window goes.
+            future = asyncio.run_coroutine_threadsafe(self.connection.close(), self.loop)
+            try:
+                future.result(timeout=CLOSE_TIMEOUT)
+            except Exception as e:
+                print(f"Error closing connection: {e}")
+
+    def append_message(self, message, history_id=None):
+        # Safe from any thread; the GUI picks messages up once per frame.
+        self.gui.messages.push(message, history_id)
+
+    def connect_button_order(self):
+        self.gui.disconnectButton.setEnabled(False)
+        self.gui.connectButton.setEnabled(True)
+    
+    def disconnect_button_order(self):
+        self.gui.disconnectButton.setEnabled(True)
+        self.gui.connectButton.setEnabled(False)
+
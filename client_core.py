@@ -0,0 +1,563 @@
+import random
+import struct
+import asyncio
+import collections
+from client_crypto import RECORD_SESSION_KEY, RECORD_CONTROL, RECORD_CHUNK, derive_stream_key, stream_id_of, open_chunk
+from protocol import (FrameParser, ProtocolError, encode_frame, encode_auth, decode_auth_result,
+                      decode_resume_result, AUTH_REQUIRED, REQUEST_PUBLIC_KEY, PUBLIC_KEY, PEER_PUBLIC_KEY, DISCONNECT,
+                      MESSAGE, JOIN, HEARTBEAT, AUTH, AUTH_RESULT, RESUME, RESUME_TOKEN, RESUME_RESULT,
+                      PEER_LEFT, STORED_MESSAGE, HEARTBEAT_INTERVAL, RESUME_TIMEOUT)
+from timer_wheel import TimerWheel
+
+# The client side of the chat protocol with no GUI attached: connect,
+# authenticate, swap keys with the peer, then send and receive encrypted
+# messages. A connection is an asyncio protocol with a small footprint, so
+# one event loop can hold thousands of them (bots, load tests, integration
+# traffic). client.py runs one on a background loop behind the PyQt window.
+#
+# If the connection drops, it reconnects with exponential backoff and
+# resumes its place in the conversation (see RESUME in protocol.py), keeping
+# its peer and session keys. Nothing is lost on the way: every MESSAGE
+# payload between the two clients starts with an envelope the server never
+# looks at. DATA carries a sequence number and an encrypted record, which
+# stays in the sender's unacked buffer until the peer ACKs it. A client that
+# resumes sends RESYNC with the last number it received; the peer resends
+# everything after that and answers with RESEND, which asks for the same the
+# other way. Duplicates are dropped before decryption, so the crypto layer's
+# replay check never sees them.
+#
+# If the peer leaves and the server keeps the conversation open (PEER_LEFT),
+# what we send is stored for the peer's return as STORED_MESSAGE: first a
+# new session key wrapped for it, then records under that key. These are
+# not numbered; nobody is there to acknowledge them.
+
+PEER_KEY_TIMEOUT = 60.0
+CONNECT_TIMEOUT = 10.0
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30.0
+ACK_DELAY = 0.5
+ACK_EVERY = 32
+MAX_UNACKED_BYTES = 32 * 1024 * 1024
+
+ENVELOPE = struct.Struct('!BQ')
+ENVELOPE_DATA = 0
+ENVELOPE_ACK = 1
+ENVELOPE_RESEND = 2
+ENVELOPE_RESYNC = 3
+
+
+async def drive_timers(timers):
+    """Tick a TimerWheel from the running loop until cancelled."""
+    while True:
+        timers.advance()
+        await asyncio.sleep(timers.tick)
+
+
+class ChatConnection(asyncio.BufferedProtocol):
+    """One client connection to a chat server.
+
+        connection = ChatConnection(crypto_manager, 'alice', b'room', password='secret')
+        await connection.connect(host, port)
+        await connection.wait_for_peer()
+        await connection.send("hello")
+        async for text in connection:
+            ...
+        await connection.close()
+
+    Iterating yields the peer's messages as text and stops once the
+    connection is closed for good: by close(), by the server, or after
+    reconnecting has failed for reconnect_timeout seconds. Control records
+    go to on_control(plaintext), file chunks to on_chunk(stream_id, index,
+    final, data) and decryption failures to on_error(exception). A receive(payload) callback, if given,
+    takes every MESSAGE payload instead (client.py hands them to its
+    DecryptPipeline). on_peer() is called once our session key is on its way
+    to the peer, on_reconnecting(reason, delay) when the connection drops
+    and a reconnect is due, on_resumed() once it is back in the
+    conversation, and on_peer_left() when the peer has left and what we
+    send is stored for its return. All callbacks run on the event loop.
+
+    send() waits while more than max_unacked_bytes are unacknowledged, so a
+    sender cannot run far ahead of a peer that has gone away.
+
+    Heartbeat and key-exchange timers go on `timers`, a TimerWheel that many
+    connections can share (tick it with drive_timers); without one, each
+    connection ticks a wheel of its own.
+    """
+
+    def __init__(self, crypto_manager, username, session_id=b'', password=None, timers=None,
+                 peer_timeout=PEER_KEY_TIMEOUT, receive=None, on_peer=None, on_control=None, on_chunk=None,
+                 on_error=None, reconnect=True, reconnect_timeout=RESUME_TIMEOUT, on_reconnecting=None,
+                 on_resumed=None, on_peer_left=None, max_unacked_bytes=MAX_UNACKED_BYTES):
+        self.crypto_manager = crypto_manager
+        self.username = username
+        self.session_id = session_id
+        # Sent in AUTH, over TLS only, to a server that asks for a login.
+        self.password = password
+        self.timers = timers
+        self.peer_timeout = peer_timeout
+        self.receive = receive if receive is not None else self.decrypt
+        self.on_peer = on_peer
+        self.on_control = on_control
+        self.on_chunk = on_chunk
+        self.on_error = on_error
+        self.reconnect = reconnect
+        self.reconnect_timeout = reconnect_timeout
+        self.on_reconnecting = on_reconnecting
+        self.on_resumed = on_resumed
+        self.on_peer_left = on_peer_left
+        self.max_unacked_bytes = max_unacked_bytes
+        self.parser = None
+        self.loop = None
+        self.address = None
+        self.transport = None
+        # Set once the server has placed this transport in the conversation.
+        self.ready = False
+        self.resume_token = None
+        self.reconnect_task = None
+        self.reconnect_deadline = None
+        self.timer_task = None
+        self.peer_timer = None
+        self.heartbeat_timer = None
+        self.ack_timer = None
+        self.stream_keys = {}
+        # Sequence state for this conversation; it survives reconnects.
+        self.sent_seq = 0
+        self.received_seq = 0
+        self.acked_seq = 0
+        self.resend_requested = None
+        self.unacked = collections.deque()  # (sequence number, MESSAGE payload)
+        self.unacked_bytes = 0
+        # Set while the peer is away and the server stores what we send.
+        self.peer_away = False
+        self.stored = []  # records to store, held while we are not connected
+        self.messages = asyncio.Queue()
+        self.peer_event = asyncio.Event()
+        self.closed_event = asyncio.Event()
+        self.peer_connected = False
+        self.closing = False
+        self.close_reason = None
+        self.paused = False
+        self.drain_waiter = None
+
+    async def connect(self, host, port, ssl=None):
+        if self.loop is not None:
+            raise ConnectionError("A ChatConnection can only be connected once")
+        self.loop = asyncio.get_running_loop()
+        self.address = (host, port, ssl)
+        if self.timers is None:
+            self.timers = TimerWheel()
+            self.timer_task = self.loop.create_task(drive_timers(self.timers))
+        try:
+            await self.open()
+        except BaseException:
+            self.stop_timers()
+            self.closed_event.set()
+            raise
+
+    async def open(self):
+        host, port, ssl = self.address
+        await asyncio.wait_for(self.loop.create_connection(lambda: self, host, port, ssl=ssl), CONNECT_TIMEOUT)
+
+    async def reconnect_loop(self, reason):
+        delay = RECONNECT_DELAY
+        if self.reconnect_deadline is None:
+            # Kept until we are back, so a server that lets us in and drops
+            # us again cannot restart the clock.
+            self.reconnect_deadline = self.loop.time() + self.reconnect_timeout
+        try:
+            while True:
+                if self.on_reconnecting is not None:
+                    self.on_reconnecting(reason, delay)
+                # Jitter, so clients dropped together do not return in lockstep.
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+                try:
+                    await self.open()
+                    return
+                except OSError as e:
+                    reason = e
+                if self.loop.time() >= self.reconnect_deadline:
+                    self.finish(reason)
+                    return
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        finally:
+            if self.reconnect_task is asyncio.current_task():
+                self.reconnect_task = None
+
+    async def wait_for_peer(self):
+        """Wait until the key exchange with the peer is done; raises
+        ConnectionError if the connection closes first."""
+        await self.peer_event.wait()
+        if not self.peer_connected:
+            raise ConnectionError(f"Connection closed before the peer joined: {self.close_reason}")
+
+    async def wait_closed(self):
+        """Wait for the connection to close; returns why (None if we closed it)."""
+        await self.closed_event.wait()
+        return self.close_reason
+
+    async def send(self, message):
+        if self.closed_event.is_set():
+            raise ConnectionError(f"Connection closed: {self.close_reason}")
+        self.send_record(self.crypto_manager.encrypt_payload(message))
+        await self.drain()
+
+    async def drain(self):
+        while not self.closed_event.is_set() and (self.paused or self.unacked_bytes > self.max_unacked_bytes):
+            if self.drain_waiter is None:
+                self.drain_waiter = self.loop.create_future()
+            await self.drain_waiter
+        if self.closed_event.is_set():
+            raise ConnectionError(f"Connection closed: {self.close_reason}")
+
+    async def close(self):
+        self.closing = True
+        if self.reconnect_task is not None:
+            self.reconnect_task.cancel()
+        if self.transport is not None:
+            if not self.transport.is_closing():
+                self.transport.write(encode_frame(DISCONNECT))
+                self.transport.close()
+            await self.closed_event.wait()
+        self.finish(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        text = await self.messages.get()
+        if text is None:
+            # Leave the end marker for anyone else iterating.
+            self.messages.put_nowait(None)
+            raise StopAsyncIteration
+        return text
+
+    def write_frame(self, frame_type, payload=b''):
+        if self.transport is None or self.transport.is_closing():
+            raise ConnectionError("Not connected")
+        self.transport.write(encode_frame(frame_type, payload))
+
+    def send_record(self, record):
+        """Number an encrypted record and send it to the peer, or hold it
+        until the connection is back."""
+        if self.peer_away:
+            self.stored.append(record)
+            self.flush_stored()
+            return
+        self.sent_seq += 1
+        payload = ENVELOPE.pack(ENVELOPE_DATA, self.sent_seq) + record
+        self.unacked.append((self.sent_seq, payload))
+        self.unacked_bytes += len(payload)
+        if self.ready:
+            self.transport.write(encode_frame(MESSAGE, payload))
+
+    def flush_stored(self):
+        if not self.ready:
+            return
+        for record in self.stored:
+            self.transport.write(encode_frame(STORED_MESSAGE, record))
+        self.stored.clear()
+
+    def send_threadsafe(self, record):
+        """send_record() from another thread. The record is copied at once,
+        and records from one thread are numbered in the order passed."""
+        if self.loop is None or self.closed_event.is_set():
+            raise ConnectionError("Not connected")
+        self.loop.call_soon_threadsafe(self.send_record, bytes(record))
+
+    def abort(self, reason):
+        if self.close_reason is None:
+            self.close_reason = reason
+        if self.transport is not None:
+            self.transport.close()
+
+    # asyncio protocol callbacks.
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.parser = FrameParser()
+        self.save_tls_session()
+        self.schedule_heartbeat()
+
+    def get_buffer(self, sizehint):
+        return self.parser.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.parser.advance(nbytes)
+        try:
+            for frame_type, payload in self.parser.frames():
+                if self.transport.is_closing():
+                    return
+                self.frame_received(frame_type, payload)
+        except Exception as e:
+            self.abort(e)
+
+    def frame_received(self, frame_type, payload):
+        if frame_type == MESSAGE:
+            self.envelope_received(payload)
+        elif frame_type == STORED_MESSAGE:
+            # Sent while we were gone; there is nothing to acknowledge.
+            self.receive(bytes(payload))
+        elif frame_type == REQUEST_PUBLIC_KEY:
+            if payload == AUTH_REQUIRED:
+                self.authenticate()
+            else:
+                self.start_session()
+        elif frame_type == AUTH_RESULT:
+            ok, reason = decode_auth_result(payload)
+            if not ok:
+                raise ProtocolError(f"login refused: {reason}")
+            self.start_session()
+        elif frame_type == RESUME_TOKEN:
+            self.resume_token = bytes(payload)
+        elif frame_type == RESUME_RESULT:
+            ok, reason = decode_resume_result(payload)
+            if ok:
+                self.resumed()
+            else:
+                print(f"Could not resume the conversation ({reason}); joining it again")
+                self.resume_token = None
+                self.peer_connected = False
+                self.peer_away = False
+                self.stored.clear()
+                self.peer_event.clear()
+                self.reset_sequence()
+                self.start_session()
+        elif frame_type == PEER_PUBLIC_KEY:
+            self.peer_joined(bytes(payload))
+        elif frame_type == PEER_LEFT:
+            self.peer_left()
+        elif frame_type == DISCONNECT:
+            self.abort(ConnectionError("the server ended the conversation"))
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.wake_drain()
+
+    def connection_lost(self, exc):
+        self.save_tls_session()
+        self.transport = None
+        self.ready = False
+        self.paused = False
+        self.wake_drain()
+        self.timers.cancel(self.peer_timer)
+        self.timers.cancel(self.heartbeat_timer)
+        reason = self.close_reason or exc or ConnectionResetError("Connection closed by server")
+        # Only a drop is retried; a refusal, a timeout, DISCONNECT or
+        # close() ends the connection.
+        if (self.reconnect and self.resume_token is not None and not self.closing
+                and self.close_reason is None):
+            self.reconnect_task = self.loop.create_task(self.reconnect_loop(reason))
+        else:
+            self.finish(reason)
+
+    def save_tls_session(self):
+        # A context from tls.create_client_context offers the saved session
+        # when we reconnect, so the reconnect resumes TLS instead of paying
+        # for a full handshake.
+        ssl_object = self.transport.get_extra_info('ssl_object')
+        save_session = getattr(ssl_object and ssl_object.context, 'save_session', None)
+        if save_session is not None:
+            save_session(ssl_object)
+
+    def finish(self, reason):
+        if self.closed_event.is_set():
+            return
+        if self.close_reason is None and not self.closing:
+            self.close_reason = reason
+        if self.timers is not None:
+            for timer in (self.peer_timer, self.heartbeat_timer, self.ack_timer):
+                self.timers.cancel(timer)
+        self.stop_timers()
+        self.peer_connected = False
+        self.peer_event.set()
+        self.closed_event.set()
+        self.messages.put_nowait(None)
+        self.wake_drain()
+
+    def wake_drain(self):
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+        self.drain_waiter = None
+
+    # Handshake.
+
+    def authenticate(self):
+        # The password also unlocks our key cache and chat history, so it
+        # never goes out in the clear.
+        if self.password is None:
+            raise ProtocolError("the server requires a login")
+        if self.transport.get_extra_info('ssl_object') is None:
+            raise ProtocolError("the server asked for a password over an unencrypted connection; "
+                                "connect with TLS")
+        self.write_frame(AUTH, encode_auth(self.username, self.password))
+
+    def start_session(self):
+        if self.resume_token is not None:
+            self.write_frame(RESUME, self.resume_token)
+            return
+        if self.reconnect:
+            # Ask for a token to resume with if this connection drops.
+            self.write_frame(RESUME)
+        self.send_public_key()
+
+    def send_public_key(self):
+        # Join the conversation first so the server pairs us with the right peer.
+        self.write_frame(JOIN, self.session_id)
+        self.write_frame(PUBLIC_KEY, self.crypto_manager.get_public_key())
+        self.ready = True
+        if self.peer_timeout and not self.peer_connected:
+            self.timers.cancel(self.peer_timer)
+            self.peer_timer = self.timers.schedule(self.peer_timeout, self.abort,
+                                                   TimeoutError("Public key exchange timed out"))
+
+    def resumed(self):
+        self.ready = True
+        self.reconnect_deadline = None
+        if self.peer_away:
+            self.flush_stored()
+        else:
+            # Say what we have, so the peer resends only what we missed and
+            # tells us what it missed in turn.
+            self.resend_requested = self.received_seq
+            self.write_control(ENVELOPE_RESYNC)
+        if self.on_resumed is not None:
+            self.on_resumed()
+
+    def peer_joined(self, public_key):
+        self.timers.cancel(self.peer_timer)
+        self.crypto_manager.set_peer_public_key(public_key)
+        # A new peer means a new session: numbering starts again.
+        self.peer_away = False
+        self.reset_sequence()
+        # RSA is only used to hand over our AES session key; every message
+        # after this is AES-GCM.
+        self.send_record(self.crypto_manager.create_session_key())
+        self.peer_connected = True
+        self.peer_event.set()
+        if self.on_peer is not None:
+            self.on_peer()
+
+    def peer_left(self):
+        if self.peer_away:
+            return
+        # Whatever the peer had not acknowledged went with it.
+        self.reset_sequence()
+        self.peer_away = True
+        self.peer_connected = False
+        self.peer_event.clear()
+        # The peer's copy of our session key is gone too, so what we store
+        # for it starts with a new one, wrapped with the key it left with.
+        self.send_record(self.crypto_manager.create_session_key())
+        if self.on_peer_left is not None:
+            self.on_peer_left()
+
+    def schedule_heartbeat(self):
+        self.heartbeat_timer = self.timers.schedule(HEARTBEAT_INTERVAL, self.send_heartbeat)
+
+    def send_heartbeat(self):
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.write_frame(HEARTBEAT)
+        self.schedule_heartbeat()
+
+    def stop_timers(self):
+        if self.timer_task is not None:
+            self.timer_task.cancel()
+            self.timer_task = None
+
+    # Sequencing.
+
+    def write_control(self, kind):
+        # Every control envelope carries, and so acknowledges, what we have.
+        self.transport.write(encode_frame(MESSAGE, ENVELOPE.pack(kind, self.received_seq)))
+        self.acked_seq = self.received_seq
+
+    def envelope_received(self, payload):
+        kind, number = ENVELOPE.unpack_from(payload)
+        if kind == ENVELOPE_DATA:
+            if number != self.received_seq + 1:
+                # A duplicate, or past a gap left while one side was away:
+                # ask once for everything after what we have.
+                if number > self.received_seq + 1 and self.resend_requested != self.received_seq:
+                    self.resend_requested = self.received_seq
+                    self.write_control(ENVELOPE_RESEND)
+                return
+            self.received_seq = number
+            self.receive(bytes(payload[ENVELOPE.size:]))
+            self.schedule_ack()
+            return
+        self.acknowledged(number)
+        if kind == ENVELOPE_RESEND:
+            self.resend(number)
+        elif kind == ENVELOPE_RESYNC:
+            self.resend(number)
+            self.write_control(ENVELOPE_RESEND)
+
+    def acknowledged(self, number):
+        while self.unacked and self.unacked[0][0] <= number:
+            _, payload = self.unacked.popleft()
+            self.unacked_bytes -= len(payload)
+        if self.unacked_bytes <= self.max_unacked_bytes:
+            self.wake_drain()
+
+    def resend(self, after):
+        for number, payload in self.unacked:
+            if number > after:
+                self.transport.write(encode_frame(MESSAGE, payload))
+
+    def schedule_ack(self):
+        if self.received_seq - self.acked_seq >= ACK_EVERY:
+            self.send_ack()
+        elif self.ack_timer is None:
+            self.ack_timer = self.timers.schedule(ACK_DELAY, self.send_ack)
+
+    def send_ack(self):
+        self.timers.cancel(self.ack_timer)
+        self.ack_timer = None
+        if self.ready and self.received_seq > self.acked_seq:
+            self.write_control(ENVELOPE_ACK)
+
+    def reset_sequence(self):
+        if self.unacked:
+            print(f"{len(self.unacked)} messages were not acknowledged by the previous peer")
+        self.unacked.clear()
+        self.unacked_bytes = 0
+        self.sent_seq = self.received_seq = self.acked_seq = 0
+        self.resend_requested = None
+        self.wake_drain()
+
+    # Receiving, when no receive callback is given.
+
+    def decrypt(self, payload):
+        kind = payload[0] if payload else None
+        try:
+            if kind == RECORD_CHUNK:
+                if self.on_chunk is not None:
+                    self.on_chunk(*self.open_chunk(payload))
+                return
+            if kind == RECORD_SESSION_KEY:
+                self.stream_keys.clear()
+            plaintext = self.crypto_manager.decrypt_payload(payload)
+            if kind == RECORD_CONTROL:
+                if self.on_control is not None:
+                    self.on_control(plaintext)
+            elif plaintext:
+                self.messages.put_nowait(plaintext.decode('utf-8'))
+        except Exception as e:
+            if self.on_error is not None:
+                self.on_error(e)
+            else:
+                print(f"Failed to decrypt message: {e}")
+
+    def open_chunk(self, payload):
+        key = self.crypto_manager.receive_key
+        if key is None:
+            raise ValueError("Session key has not been received")
+        stream_id = stream_id_of(payload)
+        stream_key = self.stream_keys.get(stream_id)
+        if stream_key is None:
+            stream_key = self.stream_keys[stream_id] = derive_stream_key(key, stream_id)
+        return open_chunk(stream_key, payload)
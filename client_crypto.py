@@ -1,19 +1,299 @@
 # client_crypto.py
 from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Cipher import PKCS1_OAEP, AES
+from Crypto.Random import get_random_bytes
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Hash import SHA256
 import base64
+import struct
+import threading
+
+# Hybrid mode: once the RSA public keys have been exchanged, each side picks a
+# random AES-256 key for the messages it sends and hands it to the peer
+# wrapped with the peer's RSA key. Every later message is AES-GCM, so only
+# the key exchange pays for RSA and messages have no size limit. Keys are
+# per direction, so the two sides can count nonces independently.
+#
+# Hybrid MESSAGE payloads start with a record kind byte:
+#
+#   RECORD_SESSION_KEY  | RSA-OAEP(session key)
+#   RECORD_MESSAGE      | counter (8, BE) | AES-GCM ciphertext | tag (16)
+#   RECORD_CONTROL      | as RECORD_MESSAGE, for client-to-client signalling
+#   RECORD_CHUNK        | stream ID (16) | index (8, BE) | flags | ciphertext | tag
+#
+# Legacy payloads are base64 text, which never starts with these bytes.
+#
+# Large payloads are split into a stream of RECORD_CHUNKs, each authenticated
+# on its own, so neither side ever holds more than one chunk. Each stream gets
+# its own key, derived from the session key and a random stream ID, and the
+# chunk index is its nonce. The header is authenticated, so chunks cannot be
+# reordered, moved between streams, or cut short without a CHUNK_FINAL.
+
+RECORD_SESSION_KEY = 1
+RECORD_MESSAGE = 2
+RECORD_CHUNK = 3
+RECORD_CONTROL = 4
+SEQUENCED_RECORDS = (RECORD_MESSAGE, RECORD_CONTROL)
+
+SESSION_KEY_SIZE = 32
+TAG_SIZE = 16
+COUNTER = struct.Struct('!Q')
+
+CHUNK_HEADER = struct.Struct('!B16sQB')
+CHUNK_FINAL = 1
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def derive_stream_key(session_key, stream_id):
+    return HKDF(session_key, SESSION_KEY_SIZE, stream_id, SHA256, context=b'secure-chat stream')
+
+
+class StreamEncryptor:
+    """Encrypts one stream chunk by chunk into a reused record buffer."""
+
+    def __init__(self, session_key, stream_id=None):
+        self.stream_id = stream_id or get_random_bytes(16)
+        self.key = derive_stream_key(session_key, self.stream_id)
+        self.index = 0
+        self.finished = False
+        self.buffer = bytearray()
+
+    def encrypt_chunk(self, data, final=False):
+        """Return the RECORD_CHUNK for data as a memoryview that is only valid
+        until the next call."""
+        if self.finished:
+            raise ValueError("Stream already finished")
+        size = CHUNK_HEADER.size + len(data) + TAG_SIZE
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        flags = CHUNK_FINAL if final else 0
+        CHUNK_HEADER.pack_into(self.buffer, 0, RECORD_CHUNK, self.stream_id, self.index, flags)
+        view = memoryview(self.buffer)[:size]
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=COUNTER.pack(self.index) + bytes(4))
+        cipher.update(view[:CHUNK_HEADER.size])
+        cipher.encrypt(data, output=view[CHUNK_HEADER.size:size - TAG_SIZE])
+        view[size - TAG_SIZE:] = cipher.digest()
+        self.index += 1
+        self.finished = final
+        return view
+
+
+class StreamDecryptor:
+    """Checks and decrypts the chunks of one stream, in order."""
+
+    def __init__(self, session_key, stream_id):
+        self.stream_id = stream_id
+        self.key = derive_stream_key(session_key, stream_id)
+        self.index = 0
+        self.finished = False
+        self.buffer = bytearray()
+
+    def decrypt_chunk(self, record):
+        """Return the plaintext of a RECORD_CHUNK as a memoryview that is only
+        valid until the next call. Raises ValueError on any tampering."""
+        record = memoryview(record)
+        if len(record) < CHUNK_HEADER.size + TAG_SIZE:
+            raise ValueError("Truncated stream chunk")
+        kind, stream_id, index, flags = CHUNK_HEADER.unpack_from(record)
+        if kind != RECORD_CHUNK or stream_id != self.stream_id:
+            raise ValueError("Chunk does not belong to this stream")
+        if self.finished or index != self.index:
+            raise ValueError(f"Unexpected chunk {index} (expected {self.index})")
+        size = len(record) - CHUNK_HEADER.size - TAG_SIZE
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        _, _, final, output = open_chunk(self.key, record, memoryview(self.buffer)[:size])
+        self.index += 1
+        self.finished = final
+        return output
+
+
+def stream_id_of(record):
+    return CHUNK_HEADER.unpack_from(record)[1]
+
+
+def open_chunk(stream_key, record, output=None):
+    """Authenticate and decrypt one RECORD_CHUNK without any stream state.
+
+    Returns (stream_id, index, final, plaintext); plaintext is written into
+    output if one is given. Checking the index order is up to the caller.
+    """
+    record = memoryview(record)
+    if len(record) < CHUNK_HEADER.size + TAG_SIZE:
+        raise ValueError("Truncated stream chunk")
+    _, stream_id, index, flags = CHUNK_HEADER.unpack_from(record)
+    cipher = AES.new(stream_key, AES.MODE_GCM, nonce=COUNTER.pack(index) + bytes(4))
+    cipher.update(record[:CHUNK_HEADER.size])
+    if output is None:
+        output = bytearray(len(record) - CHUNK_HEADER.size - TAG_SIZE)
+    cipher.decrypt(record[CHUNK_HEADER.size:-TAG_SIZE], output=output)
+    cipher.verify(record[-TAG_SIZE:])
+    return stream_id, index, bool(flags & CHUNK_FINAL), output
+
+
+def read_chunks(source, chunk_size):
+    """Yield (chunk, final) from a binary file or an iterable of bytes,
+    reading one chunk ahead so the last one can be flagged."""
+    if hasattr(source, 'readinto'):
+        # Two alternating buffers: one being read ahead into, one handed out.
+        buffers = [bytearray(chunk_size), bytearray(chunk_size)]
+        current = 0
+        n = source.readinto(buffers[current])
+        while True:
+            following = source.readinto(buffers[1 - current]) if n else 0
+            yield memoryview(buffers[current])[:n], not following
+            if not following:
+                return
+            current, n = 1 - current, following
+    else:
+        pending = None
+        for data in source:
+            if not data:
+                continue
+            if pending is not None:
+                yield pending, False
+            pending = data
+        yield (pending if pending is not None else b''), True
+
 
 class CryptoManager:
-    def __init__(self):
-        self.private_key = RSA.generate(4096)
-        self.public_key = self.private_key.publickey()
+    def __init__(self, key_size=4096, private_key=None):
+        # private_key may be a Future (see client_keys.KeyPool) so the caller
+        # never waits for key generation; it is resolved on first use, which
+        # happens on the socket thread rather than the GUI thread.
+        self._private_key = private_key if private_key is not None else RSA.generate(key_size)
+        self._public_key = None
+        self.key_lock = threading.Lock()
         self.peer_public_key = None
+        self.send_key = None
+        self.send_counter = 0
+        self.receive_key = None
+        self.receive_counter = -1
+
+    @property
+    def private_key(self):
+        with self.key_lock:
+            if not isinstance(self._private_key, RSA.RsaKey):
+                key = self._private_key.result()
+                self._private_key = key if isinstance(key, RSA.RsaKey) else RSA.import_key(key)
+            return self._private_key
+
+    @property
+    def public_key(self):
+        if self._public_key is None:
+            self._public_key = self.private_key.publickey()
+        return self._public_key
 
     def get_public_key(self):
         return self.public_key.export_key()
 
     def set_peer_public_key(self, public_key):
         self.peer_public_key = RSA.import_key(public_key)
+        # A new peer means a new session; keys from the last one are dropped.
+        self.send_key = None
+        self.receive_key = None
+
+    def create_session_key(self):
+        """Pick a fresh key for our outgoing messages and return the
+        RECORD_SESSION_KEY payload that delivers it to the peer."""
+        if self.peer_public_key is None:
+            raise ValueError("Peer public key is not set")
+        self.send_key = get_random_bytes(SESSION_KEY_SIZE)
+        self.send_counter = 0
+        wrapped = PKCS1_OAEP.new(self.peer_public_key).encrypt(self.send_key)
+        return bytes([RECORD_SESSION_KEY]) + wrapped
+
+    def has_session(self):
+        return self.send_key is not None
+
+    def encrypt_payload(self, message, kind=RECORD_MESSAGE):
+        """Encrypt a str or bytes message as a RECORD_MESSAGE (or
+        RECORD_CONTROL) payload. Payloads must be sent in the order they are
+        made: the receiver rejects a counter that goes backwards."""
+        if self.send_key is None:
+            raise ValueError("Session key is not set")
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        header = bytes([kind]) + COUNTER.pack(self.send_counter)
+        # The counter is the nonce: it never repeats under one key.
+        cipher = AES.new(self.send_key, AES.MODE_GCM, nonce=header[1:] + bytes(4))
+        cipher.update(header)
+        ciphertext, tag = cipher.encrypt_and_digest(message)
+        self.send_counter += 1
+        return header + ciphertext + tag
+
+    def decrypt_payload(self, payload):
+        """Decrypt a MESSAGE payload of any kind to bytes.
+
+        Returns None for a RECORD_SESSION_KEY, which only installs the peer's
+        key. Raises ValueError if the payload fails authentication or is a
+        replay of an earlier message.
+        """
+        kind = payload[0] if payload else None
+        if kind == RECORD_SESSION_KEY:
+            self.receive_key = self.unwrap_session_key(payload)
+            self.receive_counter = -1
+            return None
+        if kind in SEQUENCED_RECORDS:
+            counter, plaintext = self.open_record(payload, self.receive_key)
+            if counter <= self.receive_counter:
+                raise ValueError("Replayed or reordered message")
+            self.receive_counter = counter
+            return plaintext
+        if kind == RECORD_CHUNK:
+            raise ValueError("Stream chunks must be read with decrypt_stream")
+        return self.decrypt_message(payload).encode('utf-8')
+
+    # The two halves of decrypt_payload that touch no state, so they can run
+    # on any thread (see client_pipeline.DecryptPipeline).
+
+    def unwrap_session_key(self, payload):
+        return PKCS1_OAEP.new(self.private_key).decrypt(payload[1:])
+
+    def open_record(self, payload, receive_key):
+        """Authenticate and decrypt a RECORD_MESSAGE or RECORD_CONTROL;
+        returns (counter, plaintext)."""
+        if receive_key is None:
+            raise ValueError("Session key has not been received")
+        header_size = 1 + COUNTER.size
+        header = bytes(payload[:header_size])
+        (counter,) = COUNTER.unpack_from(header, 1)
+        cipher = AES.new(receive_key, AES.MODE_GCM, nonce=header[1:] + bytes(4))
+        cipher.update(header)
+        return counter, cipher.decrypt_and_verify(payload[header_size:-TAG_SIZE], payload[-TAG_SIZE:])
+
+    def encrypt_stream(self, source, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Encrypt a binary file or an iterable of bytes as a stream of
+        RECORD_CHUNK payloads, one per MESSAGE frame.
+
+        Memory use is bounded by chunk_size whatever the payload size: each
+        yielded record is a view that is reused for the next chunk, so send
+        or copy it before asking for the next. An iterable's items are sent
+        as they come, so it should yield pieces of at most chunk_size.
+        """
+        if self.send_key is None:
+            raise ValueError("Session key is not set")
+        encryptor = StreamEncryptor(self.send_key)
+        for data, final in read_chunks(source, chunk_size):
+            yield encryptor.encrypt_chunk(data, final)
+
+    def decrypt_stream(self, records):
+        """Yield the plaintext chunks of a stream of RECORD_CHUNK payloads.
+
+        Each chunk is a view that is reused for the next one. Raises
+        ValueError if a chunk fails authentication or arrives out of order, or
+        if the records end before the final chunk.
+        """
+        if self.receive_key is None:
+            raise ValueError("Session key has not been received")
+        decryptor = None
+        for record in records:
+            if decryptor is None:
+                decryptor = StreamDecryptor(self.receive_key, stream_id_of(record))
+            yield decryptor.decrypt_chunk(record)
+            if decryptor.finished:
+                return
+        raise ValueError("Stream ended before its final chunk")
 
     def encrypt_message(self, message):
         if self.peer_public_key is None:
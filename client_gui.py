@@ -1,10 +1,13 @@
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLineEdit, QPushButton, QTextEdit, QLabel, QProgressBar
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLineEdit, QPushButton, QLabel, QProgressBar
 from PyQt5.QtCore import pyqtSignal, pyqtSlot, Qt
 from PyQt5 import QtCore
+from client_chat_view import MessageModel, MessageView, MessageBuffer
 
 
 class ChatClientGUI(QWidget):
     message_received = pyqtSignal(str)
+    # Emitted when the chat is scrolled to the top, to load older history.
+    older_history_requested = pyqtSignal()
 
     def __init__(self):
         super().__init__()
@@ -20,6 +23,8 @@ class ChatClientGUI(QWidget):
         self.serverIpInput = QLineEdit()
         self.serverPortLabel = QLabel("Server Port:")
         self.serverPortInput = QLineEdit()
+        self.sessionLabel = QLabel("Conversation ID (shared with your friend):")
+        self.sessionInput = QLineEdit()
 
         # Connection status label
         self.connectionStatusLabel = QLabel("Connection Status:")
@@ -29,15 +34,29 @@ class ChatClientGUI(QWidget):
         self.connectButton = QPushButton("Connect")
         self.disconnectButton = QPushButton("Disconnect")
 
-        self.chatWindow = QTextEdit()
-        self.chatWindow.setReadOnly(True)
+        # Messages from any thread go through self.messages, which hands
+        # them to the list a batch per frame.
+        self.messagesModel = MessageModel(parent=self)
+        self.chatWindow = MessageView(self.messagesModel)
+        self.chatWindow.older_requested.connect(self.older_history_requested)
+        self.messages = MessageBuffer(self.chatWindow.append_rows, parent=self)
         self.messageInput = QLineEdit()
         self.sendButton = QPushButton("Send")
+        self.sendFileButton = QPushButton("Send File...")
+
+        # File transfer progress, shown once a transfer starts
+        self.transferLabel = QLabel()
+        self.transferProgress = QProgressBar()
+        self.transferProgress.setRange(0, 100)
+        self.transferLabel.hide()
+        self.transferProgress.hide()
 
         self.layout.addWidget(self.serverIpLabel)
         self.layout.addWidget(self.serverIpInput)
         self.layout.addWidget(self.serverPortLabel)
         self.layout.addWidget(self.serverPortInput)
+        self.layout.addWidget(self.sessionLabel)
+        self.layout.addWidget(self.sessionInput)
         self.layout.addWidget(self.connectionStatusLabel)
         self.layout.addWidget(self.connectionStatus)
         self.layout.addWidget(self.connectButton)
@@ -45,12 +64,30 @@ class ChatClientGUI(QWidget):
         self.layout.addWidget(self.chatWindow)
         self.layout.addWidget(self.messageInput)
         self.layout.addWidget(self.sendButton)
+        self.layout.addWidget(self.sendFileButton)
+        self.layout.addWidget(self.transferLabel)
+        self.layout.addWidget(self.transferProgress)
 
         self.setLayout(self.layout)
 
     @pyqtSlot(str)
     def append_message(self, message):
-        self.chatWindow.append(message)
+        self.messages.push(message)
+
+    def prepend_messages(self, rows):
+        """Show older (text, history id) rows above the current ones."""
+        if rows:
+            self.chatWindow.prepend_rows(rows)
+
+    def clear_messages(self):
+        self.messagesModel.clear()
+
+    @pyqtSlot(str, int)
+    def update_transfer_progress(self, text, percent):
+        self.transferLabel.setText(text)
+        self.transferProgress.setValue(percent)
+        self.transferLabel.show()
+        self.transferProgress.show()
 
     def update_connection_status(self, status):
         base_style = "color: white; padding: 2px; border-radius: 10px;"
@@ -0,0 +1,162 @@
+import os
+import re
+import hmac
+import time
+import hashlib
+import secrets
+import collections
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+import db
+
+# Local chat history, one SQLite file per user next to users.db.
+#
+# Message text is AES-GCM encrypted under a key derived from the user's
+# password (scrypt, salt kept in the file), so the file is useless without
+# it. Search goes through an FTS5 index of keyed word tokens: each word is
+# replaced by an HMAC of it, so the index can match whole words without
+# holding any text. Conversation IDs are stored the same way.
+#
+# Pages are fetched by keyset (id < the oldest id already shown) on the
+# (conversation, id) index, so loading the newest page, or any older one,
+# touches only the rows returned, however long the conversation is.
+
+DEFAULT_PAGE_SIZE = 100
+SCRYPT_N = 2 ** 14
+KEY_SIZE = 32
+NONCE_SIZE = 12
+TOKEN_SIZE = 12
+WORD = re.compile(r'\w+')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB NOT NULL)',
+    '''CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        conversation TEXT NOT NULL,
+        outgoing INTEGER NOT NULL,
+        sent_at INTEGER NOT NULL,
+        nonce BLOB NOT NULL,
+        ciphertext BLOB NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (conversation, id)',
+    # Contentless: the index only needs the tokens to find rowids.
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_index USING fts5(tokens, content='')",
+)
+
+INSERT_MESSAGE = ('INSERT INTO messages (conversation, outgoing, sent_at, nonce, ciphertext) '
+                  'VALUES (?, ?, ?, ?, ?)')
+INSERT_TOKENS = 'INSERT INTO message_index (rowid, tokens) VALUES (?, ?)'
+SELECT_PAGE = ('SELECT id, outgoing, sent_at, nonce, ciphertext FROM messages '
+               'WHERE conversation = ? AND id < ? ORDER BY id DESC LIMIT ?')
+SELECT_MATCHES = ('SELECT m.id, m.outgoing, m.sent_at, m.nonce, m.ciphertext '
+                  'FROM message_index JOIN messages AS m ON m.id = message_index.rowid '
+                  'WHERE message_index MATCH ? AND m.conversation = ? AND message_index.rowid < ? '
+                  'ORDER BY message_index.rowid DESC LIMIT ?')
+
+HistoryMessage = collections.namedtuple('HistoryMessage', 'id outgoing sent_at text')
+
+
+class HistoryStore:
+    """Encrypted, searchable message history for one user.
+
+    Opening derives the keys from the password, which takes a moment, and
+    raises ValueError if the password does not match the one the file was
+    created with. append() and page() may be called from any thread.
+    """
+
+    def __init__(self, path, password, scrypt_n=SCRYPT_N):
+        self.path = path
+        self.database = db.Database(path)
+        conn = self.database.connection()
+        with conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('salt', ?)",
+                         (secrets.token_bytes(16),))
+            conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('scrypt_n', ?)", (scrypt_n,))
+        meta = dict(conn.execute('SELECT name, value FROM meta'))
+        n = int(meta['scrypt_n'])
+        master = hashlib.scrypt(password.encode('utf-8'), salt=meta['salt'], n=n, r=8, p=1,
+                                maxmem=256 * 8 * n + (1 << 20), dklen=KEY_SIZE)
+        self.message_key = HKDF(master, KEY_SIZE, b'', SHA256, context=b'secure-chat history messages')
+        self.token_key = HKDF(master, KEY_SIZE, b'', SHA256, context=b'secure-chat history tokens')
+        check = self.token(b'\0check')
+        stored_check = meta.get('check')
+        if stored_check is None:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('check', ?)", (check,))
+        elif not hmac.compare_digest(stored_check, check):
+            self.database.close()
+            raise ValueError("Wrong password for this history file")
+
+    @classmethod
+    def for_user(cls, directory, username, password):
+        # Usernames are free text, so hex-encode them for the file name.
+        os.makedirs(directory, exist_ok=True)
+        return cls(os.path.join(directory, f"history-{username.encode('utf-8').hex()}.db"), password)
+
+    def token(self, data):
+        return hmac.new(self.token_key, data, hashlib.sha256).hexdigest()[:2 * TOKEN_SIZE]
+
+    def conversation_tag(self, conversation):
+        return self.token(b'\1' + conversation.encode('utf-8'))
+
+    def word_tokens(self, text):
+        return [self.token(word.encode('utf-8')) for word in dict.fromkeys(WORD.findall(text.lower()))]
+
+    def associated_data(self, tag, outgoing, sent_at):
+        return f"{tag}\0{int(outgoing)}\0{sent_at}".encode('ascii')
+
+    def encrypt(self, tag, outgoing, sent_at, text):
+        nonce = secrets.token_bytes(NONCE_SIZE)
+        cipher = AES.new(self.message_key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(self.associated_data(tag, outgoing, sent_at))
+        ciphertext, mac = cipher.encrypt_and_digest(text.encode('utf-8'))
+        return nonce, ciphertext + mac
+
+    def decrypt(self, tag, row):
+        message_id, outgoing, sent_at, nonce, ciphertext = row
+        cipher = AES.new(self.message_key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(self.associated_data(tag, outgoing, sent_at))
+        text = cipher.decrypt_and_verify(ciphertext[:-16], ciphertext[-16:]).decode('utf-8')
+        return HistoryMessage(message_id, bool(outgoing), sent_at / 1000, text)
+
+    def append(self, conversation, outgoing, text, sent_at=None):
+        return self.append_many(conversation, [(outgoing, text, sent_at)])[-1]
+
+    def append_many(self, conversation, messages):
+        """Store (outgoing, text, sent_at) tuples in one transaction; returns their ids."""
+        tag = self.conversation_tag(conversation)
+        rows = []
+        for outgoing, text, sent_at in messages:
+            sent_at = int((time.time() if sent_at is None else sent_at) * 1000)
+            rows.append((outgoing, sent_at, text, self.encrypt(tag, outgoing, sent_at, text)))
+        ids = []
+        conn = self.database.connection()
+        with conn:
+            for outgoing, sent_at, text, (nonce, ciphertext) in rows:
+                message_id = conn.execute(INSERT_MESSAGE, (tag, int(outgoing), sent_at, nonce,
+                                                           ciphertext)).lastrowid
+                conn.execute(INSERT_TOKENS, (message_id, ' '.join(self.word_tokens(text))))
+                ids.append(message_id)
+        return ids
+
+    def page(self, conversation, before=None, limit=DEFAULT_PAGE_SIZE):
+        """Up to limit messages older than id `before` (newest if None), oldest first."""
+        tag = self.conversation_tag(conversation)
+        rows = self.database.execute(SELECT_PAGE, (tag, before or 2 ** 63 - 1, limit)).fetchall()
+        return [self.decrypt(tag, row) for row in reversed(rows)]
+
+    def search(self, conversation, query, before=None, limit=DEFAULT_PAGE_SIZE):
+        """Messages containing every word of query, newest first."""
+        tokens = self.word_tokens(query)
+        if not tokens:
+            return []
+        tag = self.conversation_tag(conversation)
+        match = ' '.join(f'"{token}"' for token in tokens)
+        rows = self.database.execute(SELECT_MATCHES, (match, tag, before or 2 ** 63 - 1, limit)).fetchall()
+        return [self.decrypt(tag, row) for row in rows]
+
+    def close(self):
+        self.database.close()
@@ -0,0 +1,141 @@
+import os
+import threading
+import collections
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# Generating a 4096-bit RSA key takes seconds. KeyPool starts generating at
+# launch, in a separate process so the GUI never competes with it for the
+# GIL, and hands over a key that is usually ready by the time the user has
+# logged in. KeyCache keeps each user's key on disk encrypted with their
+# password, so later runs skip generation altogether; with keys in the
+# cache, client.py only starts the pool if the user's key is not among
+# them, by which time Qt is up and the worker must be spawned, not forked.
+
+DEFAULT_KEY_SIZE = 4096
+KEY_PROTECTION = 'scryptAndAES256-CBC'
+
+
+def generate_key_pem(key_size):
+    # Imported here so client.py can start the pool before loading crypto.
+    from Crypto.PublicKey import RSA
+    return RSA.generate(key_size).export_key()
+
+
+class KeyPool:
+    """Keeps `size` RSA keypairs generating ahead of need in a worker process.
+
+    With a limit, at most that many keys are handed out: nothing is
+    generated beyond them, and the worker process exits once the last one
+    taken is done.
+    """
+
+    def __init__(self, key_size=DEFAULT_KEY_SIZE, size=1, limit=None, mp_context=None):
+        self.key_size = key_size
+        self.size = size
+        self.remaining = limit  # keys that may still be taken; None for no limit
+        self.mp_context = mp_context  # for the worker process; see start()
+        self.executor = None
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+
+    def start(self):
+        # Call before creating the QApplication: the worker process is
+        # forked on first submit, and forking is only safe before Qt starts.
+        # A pool first used later needs a 'spawn' mp_context.
+        with self.lock:
+            wanted = self.size if self.remaining is None else min(self.size, self.remaining)
+            if self.executor is None and wanted:
+                self.executor = ProcessPoolExecutor(max_workers=1, mp_context=self.mp_context)
+            while len(self.pending) < wanted:
+                self.pending.append(self.executor.submit(generate_key_pem, self.key_size))
+
+    def take(self):
+        """Return a Future of a PEM-encoded private key and queue a
+        replacement, unless the limit has been reached."""
+        self.start()
+        with self.lock:
+            if not self.pending:
+                raise RuntimeError("KeyPool has handed out all the keys it may")
+            future = self.pending.popleft()
+            if self.remaining is not None:
+                self.remaining -= 1
+                if self.remaining == 0:
+                    # Lets the key being generated finish, then the worker exits.
+                    self.executor.shutdown(wait=False)
+                    self.executor = None
+        self.start()
+        return future
+
+    def shutdown(self):
+        with self.lock:
+            for future in self.pending:
+                future.cancel()
+            self.pending.clear()
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+
+class KeyCache:
+    """Private keys on disk as PKCS#8, encrypted with the owner's password."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, username):
+        # Usernames are free text, so hex-encode them for the file name.
+        return os.path.join(self.directory, username.encode('utf-8').hex() + '.pem')
+
+    def has_keys(self):
+        try:
+            return any(name.endswith('.pem') for name in os.listdir(self.directory))
+        except OSError:
+            return False
+
+    def load(self, username, password):
+        from Crypto.PublicKey import RSA
+        try:
+            with open(self.path(username), 'rb') as f:
+                return RSA.import_key(f.read(), passphrase=password)
+        except FileNotFoundError:
+            return None
+        except (ValueError, IndexError, TypeError):
+            # Wrong password (it may have been changed) or a damaged file.
+            return None
+
+    def store(self, username, password, key):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        pem = key.export_key(passphrase=password, pkcs=8, protection=KEY_PROTECTION)
+        path = self.path(username)
+        temporary = path + '.tmp'
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pem)
+        os.replace(temporary, path)
+
+
+def load_or_generate(pool, username, password, cache=None):
+    """Future of the user's private key: cached if possible, else from the pool.
+
+    Unlocking (scrypt) and storing the cached key are slow too, so both
+    happen on a background thread.
+    """
+    result = Future()
+
+    def resolve():
+        from Crypto.PublicKey import RSA
+        try:
+            key = cache.load(username, password) if cache is not None else None
+            if key is None:
+                key = RSA.import_key(pool.take().result())
+                if cache is not None:
+                    try:
+                        cache.store(username, password, key)
+                    except OSError as e:
+                        print(f"Could not cache private key: {e}")
+            result.set_result(key)
+        except Exception as e:
+            result.set_exception(e)
+
+    threading.Thread(target=resolve, name="key-loader", daemon=True).start()
+    return result
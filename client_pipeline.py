@@ -0,0 +1,146 @@
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from client_crypto import (RECORD_SESSION_KEY, RECORD_MESSAGE, RECORD_CONTROL, RECORD_CHUNK,
+                           SEQUENCED_RECORDS, derive_stream_key, stream_id_of, open_chunk)
+
+DEFAULT_DECRYPT_WORKERS = 2
+
+
+class DecryptPipeline:
+    """Staged receive path: socket reader -> decrypt pool -> in-order delivery.
+
+    The reader only calls submit(), which queues the payload on the decrypt
+    pool and returns at once, so a burst of messages never holds up the
+    socket. Decrypts run in parallel; a delivery thread waits on them in
+    arrival order and calls deliver(plaintext) (or on_error(exception)) one
+    at a time, so messages reach the GUI in the order they were received.
+
+    A session key record swaps the key for everything submitted after it.
+    Later messages capture a Future of that key rather than the key itself,
+    so they can be queued before the RSA unwrap has finished. The replay
+    check needs the final order and runs on the delivery thread.
+
+    RECORD_CONTROL plaintexts go to on_control(plaintext) and decrypted
+    stream chunks to on_chunk(stream_id, index, final, data), on the same
+    delivery thread and in the same order as messages.
+    """
+
+    def __init__(self, crypto_manager, deliver, on_error=None, workers=DEFAULT_DECRYPT_WORKERS,
+                 on_control=None, on_chunk=None):
+        self.crypto_manager = crypto_manager
+        self.deliver = deliver
+        self.on_error = on_error
+        self.on_control = on_control
+        self.on_chunk = on_chunk
+        self.stream_keys = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decrypt")
+        self.key = None  # Future of the peer's current session key
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        # Stage depths are kept as running counts so submit() stays O(1).
+        self.submitted = 0
+        self.decrypted = 0
+        self.delivered = 0
+        self.max_depths = {'decrypt': 0, 'delivery': 0}
+        self.closed = False
+        self.last_counter = -1
+        self.delivery = threading.Thread(target=self.delivery_loop, name="decrypt-delivery", daemon=True)
+        self.delivery.start()
+
+    def submit(self, payload):
+        kind = payload[0] if payload else None
+        with self.condition:
+            self.submitted += 1
+            self.record_depths()
+        if kind == RECORD_SESSION_KEY:
+            self.key = self.executor.submit(self.crypto_manager.unwrap_session_key, payload)
+            future = self.key
+        elif kind in SEQUENCED_RECORDS:
+            future = self.executor.submit(self.open_record, payload, self.key)
+        elif kind == RECORD_CHUNK:
+            future = self.executor.submit(self.open_chunk, payload, self.key)
+        else:
+            future = self.executor.submit(self.crypto_manager.decrypt_payload, payload)
+        future.add_done_callback(self.decrypt_done)
+        with self.condition:
+            self.pending.append((kind, future))
+            self.condition.notify()
+
+    def decrypt_done(self, future):
+        with self.condition:
+            self.decrypted += 1
+            self.record_depths()
+
+    def open_record(self, payload, key):
+        return self.crypto_manager.open_record(payload, key.result() if key is not None else None)
+
+    def open_chunk(self, payload, key):
+        if key is None:
+            raise ValueError("Session key has not been received")
+        stream_id = stream_id_of(payload)
+        stream_key = self.stream_keys.get((key, stream_id))
+        if stream_key is None:
+            stream_key = derive_stream_key(key.result(), stream_id)
+            self.stream_keys[(key, stream_id)] = stream_key
+        return open_chunk(stream_key, payload)
+
+    def delivery_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                kind, future = self.pending[0]
+            try:
+                result = future.result()
+                if kind == RECORD_SESSION_KEY:
+                    self.last_counter = -1
+                    self.stream_keys.clear()
+                    result = None
+                elif kind in SEQUENCED_RECORDS:
+                    counter, result = result
+                    if counter <= self.last_counter:
+                        raise ValueError("Replayed or reordered message")
+                    self.last_counter = counter
+                if kind == RECORD_CHUNK:
+                    if self.on_chunk is not None:
+                        self.on_chunk(*result)
+                elif kind == RECORD_CONTROL:
+                    if self.on_control is not None:
+                        self.on_control(result)
+                elif result:
+                    self.deliver(result)
+            except Exception as e:
+                if self.on_error is not None and not self.closed:
+                    self.on_error(e)
+            with self.condition:
+                self.pending.popleft()
+                self.delivered += 1
+
+    def depths(self):
+        """Items per stage: waiting for or in decryption, and decrypted but
+        not yet delivered (in delivery, or behind an earlier message)."""
+        with self.condition:
+            return {'decrypt': self.submitted - self.decrypted,
+                    'delivery': self.decrypted - self.delivered}
+
+    def peak_depths(self):
+        """The largest depths() seen so far, for tuning the worker count."""
+        with self.condition:
+            return dict(self.max_depths)
+
+    def record_depths(self):
+        # Caller holds self.condition.
+        depths = {'decrypt': self.submitted - self.decrypted,
+                  'delivery': self.decrypted - self.delivered}
+        for stage, depth in depths.items():
+            if depth > self.max_depths[stage]:
+                self.max_depths[stage] = depth
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,291 @@
+import os
+import re
+import json
+import mmap
+import hashlib
+import threading
+from client_crypto import RECORD_CONTROL, StreamEncryptor, DEFAULT_CHUNK_SIZE
+
+# End-to-end encrypted file transfer over the ordinary MESSAGE relay.
+#
+# Control messages are JSON in RECORD_CONTROL records:
+#
+#   offer    sender -> receiver   {id, name, size}
+#   accept   receiver -> sender   {id, offset}: bytes already on disk
+#   stream   sender -> receiver   {id, stream, offset, window}: chunks of this
+#                                 stream carry the file from offset onwards
+#   ack      receiver -> sender   {id, offset}: bytes written so far, sent
+#                                 every quarter window
+#   complete receiver -> sender   {id, offset}
+#
+# File data travels as RECORD_CHUNK streams. The sender keeps at most
+# window_bytes unacknowledged, which bounds the memory held for one transfer
+# by the relay (below its per-client queue limit) and by the receiver's decrypt
+# pipeline. Transfer IDs come from the file's name, size and mtime. An
+# interrupted transfer is offered again under the same ID once the peer is
+# back, and the receiver answers with the length of its .part file, so the
+# transfer resumes from there.
+
+DEFAULT_WINDOW_BYTES = 2 * 1024 * 1024
+ACKS_PER_WINDOW = 4
+TRANSFER_ID = re.compile(r'[0-9a-f]{32}')
+
+
+def transfer_id(path):
+    info = os.stat(path)
+    key = f"{os.path.basename(path)}\0{info.st_size}\0{info.st_mtime_ns}".encode('utf-8')
+    return hashlib.sha256(key).hexdigest()[:32]
+
+
+def file_chunks(file, offset, size, chunk_size):
+    """Yield (view, final) over file[offset:size] straight from an mmap, so
+    the data is only copied once, by the cipher. Each view is released before
+    the next one is made."""
+    if offset >= size:
+        yield b'', True
+        return
+    with mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+        position = offset
+        while position < size:
+            end = min(position + chunk_size, size)
+            view = memoryview(mapped)[position:end]
+            try:
+                yield view, end == size
+            finally:
+                view.release()
+            position = end
+
+
+class OutgoingTransfer:
+    def __init__(self, path):
+        self.path = path
+        self.id = transfer_id(path)
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.sent = 0
+        self.acked = 0
+        self.running = False
+        # Bumped whenever sending stops or restarts, so a sender thread left
+        # over from a dropped connection knows to give up.
+        self.generation = 0
+        self.condition = threading.Condition()
+
+
+class IncomingTransfer:
+    def __init__(self, transfer_id, name, size, part_path):
+        self.id = transfer_id
+        self.name = name
+        self.size = size
+        self.part_path = part_path
+        self.file = None
+        self.stream_id = None
+        self.next_index = 0
+        self.written = 0
+        self.acked = 0
+        self.ack_interval = 0
+
+
+class FileTransferManager:
+    """Sends and receives files for one ChatClient.
+
+    send_record(kind, plaintext) and send_chunk(record) put encrypted
+    payloads on the connection; progress(name, done, total) and
+    notify(text) report to the user. Incoming control messages and chunks
+    arrive through handle_control and handle_chunk, in order, from the
+    decrypt pipeline's delivery thread.
+    """
+
+    def __init__(self, crypto_manager, send_record, send_chunk, progress, notify, download_dir,
+                 chunk_size=DEFAULT_CHUNK_SIZE, window_bytes=DEFAULT_WINDOW_BYTES):
+        self.crypto_manager = crypto_manager
+        self.send_record = send_record
+        self.send_chunk = send_chunk
+        self.progress = progress
+        self.notify = notify
+        self.download_dir = download_dir
+        self.chunk_size = chunk_size
+        self.window_bytes = max(window_bytes, chunk_size)
+        self.outgoing = {}
+        self.incoming = {}
+        self.streams = {}  # stream ID -> IncomingTransfer
+        self.lock = threading.Lock()
+
+    def send_control(self, message_type, **fields):
+        self.send_record(RECORD_CONTROL, json.dumps(dict(fields, type=message_type)).encode('utf-8'))
+
+    # Sending side.
+
+    def send_file(self, path):
+        transfer = OutgoingTransfer(path)
+        with self.lock:
+            self.outgoing.setdefault(transfer.id, transfer)
+        self.notify(f"Offering {transfer.name} ({transfer.size} bytes)...")
+        self.send_control('offer', id=transfer.id, name=transfer.name, size=transfer.size)
+
+    def resume(self):
+        """Offer every unfinished outgoing transfer again, after a reconnect."""
+        with self.lock:
+            transfers = list(self.outgoing.values())
+        for transfer in transfers:
+            self.notify(f"Resuming {transfer.name}...")
+            self.send_control('offer', id=transfer.id, name=transfer.name, size=transfer.size)
+
+    def start_sending(self, transfer, offset):
+        with transfer.condition:
+            if transfer.running:
+                return
+            transfer.running = True
+            transfer.generation += 1
+            transfer.sent = transfer.acked = offset
+        threading.Thread(target=self.send_loop, args=(transfer, transfer.generation),
+                         name=f"send-{transfer.name}", daemon=True).start()
+
+    def send_loop(self, transfer, generation):
+        try:
+            encryptor = StreamEncryptor(self.crypto_manager.send_key)
+            self.send_control('stream', id=transfer.id, stream=encryptor.stream_id.hex(), offset=transfer.sent,
+                              window=self.window_bytes)
+            with open(transfer.path, 'rb') as file:
+                for data, final in file_chunks(file, transfer.sent, transfer.size, self.chunk_size):
+                    with transfer.condition:
+                        while (transfer.generation == generation
+                               and transfer.sent - transfer.acked >= self.window_bytes):
+                            transfer.condition.wait()
+                        if transfer.generation != generation:
+                            return
+                    self.send_chunk(encryptor.encrypt_chunk(data, final))
+                    transfer.sent += len(data)
+        except Exception as e:
+            if transfer.generation == generation:
+                self.notify(f"Sending {transfer.name} stopped: {e}")
+        finally:
+            with transfer.condition:
+                if transfer.generation == generation:
+                    transfer.running = False
+
+    def acknowledged(self, transfer_id, offset, complete=False):
+        with self.lock:
+            transfer = self.outgoing.get(transfer_id)
+            if complete:
+                self.outgoing.pop(transfer_id, None)
+        if transfer is None:
+            return
+        with transfer.condition:
+            transfer.acked = max(transfer.acked, offset)
+            transfer.condition.notify_all()
+        self.progress(transfer.name, transfer.acked, transfer.size)
+        if complete:
+            self.notify(f"Sent {transfer.name}.")
+
+    # Receiving side.
+
+    def part_path(self, transfer_id):
+        return os.path.join(self.download_dir, f".{transfer_id}.part")
+
+    def offered(self, transfer_id, name, size):
+        # Never trust the peer with a path: the ID names the .part file, so it
+        # must be plain hex, and only the base name of the file is kept.
+        if not TRANSFER_ID.fullmatch(transfer_id):
+            raise ValueError("Malformed transfer ID")
+        name = os.path.basename(name.replace('\\', '/')) or 'download'
+        os.makedirs(self.download_dir, exist_ok=True)
+        transfer = IncomingTransfer(transfer_id, name, size, self.part_path(transfer_id))
+        try:
+            offset = min(os.path.getsize(transfer.part_path), size)
+        except FileNotFoundError:
+            offset = 0
+        with self.lock:
+            previous = self.incoming.get(transfer_id)
+            self.incoming[transfer_id] = transfer
+        if previous is not None and previous.file is not None:
+            previous.file.close()
+            self.streams.pop(previous.stream_id, None)
+        self.notify(f"Receiving {name} ({size} bytes)" + (f", resuming at {offset}" if offset else "") + "...")
+        self.send_control('accept', id=transfer_id, offset=offset)
+
+    def stream_started(self, transfer_id, stream_id, offset, window):
+        transfer = self.incoming.get(transfer_id)
+        if transfer is None:
+            return
+        if transfer.file is None:
+            transfer.file = open(transfer.part_path, 'ab+')
+        transfer.file.truncate(offset)
+        transfer.file.seek(offset)
+        transfer.written = transfer.acked = offset
+        transfer.stream_id = stream_id
+        transfer.next_index = 0
+        transfer.ack_interval = max(1, window // ACKS_PER_WINDOW)
+        self.streams[stream_id] = transfer
+
+    def handle_chunk(self, stream_id, index, final, data):
+        transfer = self.streams.get(stream_id)
+        if transfer is None or transfer.file is None or index != transfer.next_index:
+            raise ValueError("File chunk out of order or for an unknown transfer")
+        transfer.file.write(data)
+        transfer.next_index += 1
+        transfer.written += len(data)
+        if final:
+            self.finish_incoming(transfer)
+        elif transfer.written - transfer.acked >= transfer.ack_interval:
+            transfer.file.flush()
+            transfer.acked = transfer.written
+            self.send_control('ack', id=transfer.id, offset=transfer.written)
+            self.progress(transfer.name, transfer.written, transfer.size)
+
+    def finish_incoming(self, transfer):
+        transfer.file.close()
+        transfer.file = None
+        self.streams.pop(transfer.stream_id, None)
+        with self.lock:
+            self.incoming.pop(transfer.id, None)
+        if transfer.written != transfer.size:
+            self.notify(f"Transfer of {transfer.name} ended at {transfer.written} of {transfer.size} bytes.")
+            return
+        destination = self.unique_path(transfer.name)
+        os.replace(transfer.part_path, destination)
+        self.send_control('complete', id=transfer.id, offset=transfer.written)
+        self.progress(transfer.name, transfer.size, transfer.size)
+        self.notify(f"Received {transfer.name}, saved to {destination}")
+
+    def unique_path(self, name):
+        base, extension = os.path.splitext(name)
+        path = os.path.join(self.download_dir, name)
+        copy = 1
+        while os.path.exists(path):
+            path = os.path.join(self.download_dir, f"{base} ({copy}){extension}")
+            copy += 1
+        return path
+
+    def handle_control(self, plaintext):
+        message = json.loads(plaintext)
+        message_type = message.get('type')
+        if message_type == 'offer':
+            self.offered(message['id'], message['name'], int(message['size']))
+        elif message_type == 'accept':
+            transfer = self.outgoing.get(message['id'])
+            if transfer is not None:
+                self.start_sending(transfer, int(message['offset']))
+        elif message_type == 'stream':
+            self.stream_started(message['id'], bytes.fromhex(message['stream']), int(message['offset']),
+                                int(message['window']))
+        elif message_type == 'ack':
+            self.acknowledged(message['id'], int(message['offset']))
+        elif message_type == 'complete':
+            self.acknowledged(message['id'], int(message['offset']), complete=True)
+
+    def connection_lost(self):
+        """Stop sending and close partial files; both resume on the next session."""
+        with self.lock:
+            outgoing = list(self.outgoing.values())
+            incoming = list(self.incoming.values())
+            self.incoming.clear()
+        for transfer in outgoing:
+            with transfer.condition:
+                transfer.running = False
+                transfer.generation += 1
+                transfer.condition.notify_all()
+        for transfer in incoming:
+            if transfer.file is not None:
+                transfer.file.close()
+                transfer.file = None
+        self.streams.clear()
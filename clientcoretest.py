@@ -0,0 +1,418 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from Crypto.PublicKey import RSA
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtTest import QTest
+from authtest import AuthDatabaseMixin
+from client_controller import ChatClient
+from client_core import ChatConnection, drive_timers
+from client_crypto import CryptoManager
+from client_gui import ChatClientGUI
+from server_async import AsyncChatServer
+from startupbench import run_client, import_breakdown
+from timer_wheel import TimerWheel
+from tls import create_client_context
+
+app = QApplication.instance() or QApplication(sys.argv)
+
+KEYS = [RSA.generate(1024) for _ in range(2)]
+
+
+def make_certificate(directory):
+    """A throwaway self-signed certificate for 127.0.0.1; returns (certfile,
+    keyfile), or None without the openssl command."""
+    certfile, keyfile = os.path.join(directory, 'server.crt'), os.path.join(directory, 'server.key')
+    try:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', keyfile,
+                        '-out', certfile, '-days', '1', '-subj', '/CN=localhost',
+                        '-addext', 'subjectAltName=IP:127.0.0.1,DNS:localhost'],
+                       check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return certfile, keyfile
+
+
+class ServerMixin:
+    """An AsyncChatServer on its own loop thread."""
+
+    users_db = None
+    offline_dir = None
+    certfile = keyfile = None
+
+    def setUp(self):
+        super().setUp()
+        self.server = AsyncChatServer('127.0.0.1', 0, users_db=self.users_db, offline_dir=self.offline_dir,
+                                      certfile=self.certfile, keyfile=self.keyfile)
+        self.loop = asyncio.new_event_loop()
+        self.task = self.loop.create_task(self.server.serve())
+        threading.Thread(target=self.run_loop, daemon=True).start()
+        while self.server.server is None or not self.server.server.sockets:
+            time.sleep(0.01)
+        self.port = self.server.server.sockets[0].getsockname()[1]
+
+    def run_loop(self):
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        while not self.task.done():
+            time.sleep(0.01)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.server.authenticator is not None:
+            self.server.authenticator.close()
+        if self.server.offline_store is not None:
+            self.server.store_executor.shutdown()
+            self.server.offline_store.close()
+        super().tearDown()
+
+    def connection(self, index, session_id=b'room', **kwargs):
+        return ChatConnection(CryptoManager(private_key=KEYS[index % 2]), f'user{index}', session_id, **kwargs)
+
+    def run_async(self, coroutine):
+        return asyncio.run(asyncio.wait_for(coroutine, 30))
+
+
+class TestChatConnection(ServerMixin, unittest.TestCase):
+    """Test cases for the headless asyncio client."""
+
+    def test_pair_exchanges_messages(self):
+        async def scenario():
+            alice, bob = self.connection(0), self.connection(1)
+            await alice.connect('127.0.0.1', self.port)
+            await bob.connect('127.0.0.1', self.port)
+            await asyncio.gather(alice.wait_for_peer(), bob.wait_for_peer())
+            await alice.send("hello bob")
+            await bob.send("hello alice")
+            await alice.send("how are you?")
+            received = [await bob.__anext__(), await bob.__anext__(), await alice.__anext__()]
+            await alice.close()
+            # Alice leaving ends the conversation for Bob too.
+            remaining = [text async for text in bob]
+            return received, remaining, await alice.wait_closed(), await bob.wait_closed()
+
+        received, remaining, alice_reason, bob_reason = self.run_async(scenario())
+        self.assertEqual(received, ["hello bob", "how are you?", "hello alice"])
+        self.assertEqual(remaining, [])
+        self.assertIsNone(alice_reason)
+        self.assertIsInstance(bob_reason, ConnectionError)
+
+    def test_many_clients_share_one_loop(self):
+        pairs = 200
+
+        async def scenario():
+            timers = TimerWheel()
+            driver = asyncio.create_task(drive_timers(timers))
+            connections = [self.connection(n, f'room {n // 2}'.encode(), timers=timers) for n in range(2 * pairs)]
+            await asyncio.gather(*(c.connect('127.0.0.1', self.port) for c in connections))
+            await asyncio.gather(*(c.wait_for_peer() for c in connections))
+            await asyncio.gather(*(c.send(f"from {n}") for n, c in enumerate(connections)))
+            received = await asyncio.gather(*(c.__anext__() for c in connections))
+            await asyncio.gather(*(c.close() for c in connections))
+            driver.cancel()
+            return received
+
+        received = self.run_async(scenario())
+        # Each client hears from the other half of its pair.
+        self.assertEqual(received, [f"from {n ^ 1}" for n in range(2 * pairs)])
+
+    def test_peer_key_timeout_closes_the_connection(self):
+        async def scenario():
+            lonely = self.connection(0, peer_timeout=0.2)
+            await lonely.connect('127.0.0.1', self.port)
+            with self.assertRaises(ConnectionError):
+                await lonely.wait_for_peer()
+            return await lonely.wait_closed()
+
+        self.assertIsInstance(self.run_async(scenario()), TimeoutError)
+
+    def test_password_is_not_sent_unless_asked(self):
+        received = []
+        self.server.authenticate = lambda protocol, payload: received.append(bytes(payload))
+
+        async def scenario():
+            alice = self.connection(0, password='correct horse')
+            bob = self.connection(1, password='correct horse')
+            await alice.connect('127.0.0.1', self.port)
+            await bob.connect('127.0.0.1', self.port)
+            await asyncio.gather(alice.wait_for_peer(), bob.wait_for_peer())
+            await alice.send("no login here")
+            text = await bob.__anext__()
+            await asyncio.gather(alice.close(), bob.close())
+            return text
+
+        self.assertEqual(self.run_async(scenario()), "no login here")
+        # This server has no user store, so no AUTH frame ever reached it.
+        self.assertEqual(received, [])
+
+    def test_dropped_connection_resumes_without_loss(self):
+        async def scenario():
+            alice, bob = self.connection(0), self.connection(1)
+            resumed = asyncio.Event()
+            bob.on_resumed = resumed.set
+            await alice.connect('127.0.0.1', self.port)
+            await bob.connect('127.0.0.1', self.port)
+            await asyncio.gather(alice.wait_for_peer(), bob.wait_for_peer())
+            for n in range(5):
+                await alice.send(f"message {n}")
+            received = [await bob.__anext__() for _ in range(5)]
+            # Drop Bob before he acknowledges, so Alice resends what he has
+            # already seen; then send more while he is away, both ways.
+            bob.transport.abort()
+            for n in range(5, 10):
+                await alice.send(f"message {n}")
+            await bob.send("sent while away")
+            await resumed.wait()
+            received += [await bob.__anext__() for _ in range(5)]
+            reply = await alice.__anext__()
+            await alice.send("last")
+            received.append(await bob.__anext__())
+            await asyncio.gather(alice.close(), bob.close())
+            return received, reply, bob.messages.qsize()
+
+        received, reply, left_over = self.run_async(scenario())
+        self.assertEqual(received, [f"message {n}" for n in range(10)] + ["last"])
+        self.assertEqual(reply, "sent while away")
+        # Only the end marker: no duplicates were delivered.
+        self.assertEqual(left_over, 1)
+
+    def test_expired_session_joins_again(self):
+        async def scenario():
+            alice = self.connection(0)
+            await alice.connect('127.0.0.1', self.port)
+            while not self.server.client_tokens:
+                await asyncio.sleep(0.01)
+            alice.transport.abort()
+            while not self.server.detached:
+                await asyncio.sleep(0.01)
+            # As if resume_timeout had passed before Alice got back.
+            self.loop.call_soon_threadsafe(lambda: [self.server.expire_detached(client_id)
+                                                    for client_id in list(self.server.detached)])
+            bob = self.connection(1)
+            await bob.connect('127.0.0.1', self.port)
+            await asyncio.gather(alice.wait_for_peer(), bob.wait_for_peer())
+            await alice.send("joined again")
+            text = await bob.__anext__()
+            await asyncio.gather(alice.close(), bob.close())
+            return text
+
+        self.assertEqual(self.run_async(scenario()), "joined again")
+
+
+class TestStoredMessages(ServerMixin, unittest.TestCase):
+    """A server with an offline store keeps the conversation for a peer that leaves."""
+
+    def setUp(self):
+        self.offline_dir = tempfile.mkdtemp()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.offline_dir, ignore_errors=True)
+
+    def test_peer_gets_what_was_sent_while_it_was_gone(self):
+        async def scenario():
+            alice, bob = self.connection(0), self.connection(1)
+            left = asyncio.Event()
+            alice.on_peer_left = left.set
+            await alice.connect('127.0.0.1', self.port)
+            await bob.connect('127.0.0.1', self.port)
+            await asyncio.gather(alice.wait_for_peer(), bob.wait_for_peer())
+            await alice.send("before")
+            received = [await bob.__anext__()]
+            await bob.close()
+            await left.wait()
+            await alice.send("while you were gone")
+            await alice.send("and again")
+            # Bob comes back with the same key, as with --key-cache.
+            bob = self.connection(1)
+            await bob.connect('127.0.0.1', self.port)
+            await asyncio.gather(alice.wait_for_peer(), bob.wait_for_peer())
+            received += [await bob.__anext__() for _ in range(2)]
+            await alice.send("live again")
+            received.append(await bob.__anext__())
+            await asyncio.gather(alice.close(), bob.close())
+            return received
+
+        self.assertEqual(self.run_async(scenario()),
+                         ["before", "while you were gone", "and again", "live again"])
+
+
+class TestChatConnectionAuth(ServerMixin, AuthDatabaseMixin, unittest.TestCase):
+    """The AUTH step of the handshake against a server with a user store."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cert_dir = tempfile.mkdtemp()
+        certificate = make_certificate(cls.cert_dir)
+        if certificate is None:
+            shutil.rmtree(cls.cert_dir)
+            raise unittest.SkipTest("needs the openssl command to make a test certificate")
+        cls.certfile, cls.keyfile = certificate
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.cert_dir, ignore_errors=True)
+
+    @property
+    def users_db(self):
+        return self.db_path
+
+    def connect(self, connection, context=None):
+        return connection.connect('127.0.0.1', self.port, ssl=context or create_client_context(self.certfile))
+
+    def test_authenticated_clients_are_paired(self):
+        async def scenario():
+            alice = self.connection(0, password='correct horse')
+            bob = self.connection(1, password='correct horse')
+            alice.username = bob.username = 'alice'
+            await self.connect(alice)
+            await self.connect(bob)
+            await asyncio.gather(alice.wait_for_peer(), bob.wait_for_peer())
+            await alice.send("signed in")
+            text = await bob.__anext__()
+            await asyncio.gather(alice.close(), bob.close())
+            return text
+
+        self.assertEqual(self.run_async(scenario()), "signed in")
+
+    def test_wrong_password_is_refused(self):
+        async def scenario():
+            mallory = self.connection(0, password='wrong')
+            mallory.username = 'alice'
+            await self.connect(mallory)
+            return await mallory.wait_closed()
+
+        reason = self.run_async(scenario())
+        self.assertIn("login refused", str(reason))
+
+    def test_reconnect_resumes_the_tls_session(self):
+        context = create_client_context(self.certfile)
+
+        async def connect_once():
+            alice, bob = self.connection(0, password='correct horse'), self.connection(1, password='correct horse')
+            alice.username = bob.username = 'alice'
+            await self.connect(alice, context)
+            await self.connect(bob, context)
+            await asyncio.gather(alice.wait_for_peer(), bob.wait_for_peer())
+            reused = alice.transport.get_extra_info('ssl_object').session_reused
+            await asyncio.gather(alice.close(), bob.close())
+            return reused
+
+        self.assertFalse(self.run_async(connect_once()))
+        self.assertTrue(self.run_async(connect_once()))
+
+
+class TestChatConnectionAuthWithoutTLS(ServerMixin, AuthDatabaseMixin, unittest.TestCase):
+    """A server with a user store listening on plain TCP."""
+
+    @property
+    def users_db(self):
+        return self.db_path
+
+    def test_password_is_not_sent_without_tls(self):
+        sent = []
+        self.server.authenticate = lambda protocol, payload: sent.append(bytes(payload))
+
+        async def scenario():
+            alice = self.connection(0, password='correct horse')
+            alice.username = 'alice'
+            await alice.connect('127.0.0.1', self.port)
+            return await alice.wait_closed()
+
+        reason = self.run_async(scenario())
+        self.assertIn("TLS", str(reason))
+        self.assertEqual(sent, [])
+
+
+class TestChatClientAdapter(ServerMixin, unittest.TestCase):
+    """The PyQt ChatClient driving a ChatConnection."""
+
+    def wait_until(self, condition, timeout=10000):
+        for _ in range(timeout // 10):
+            if condition():
+                return True
+            QTest.qWait(10)
+        return condition()
+
+    def open_window(self, index):
+        gui = ChatClientGUI()
+        client = ChatClient(gui, CryptoManager(private_key=KEYS[index]), f'user{index}')
+        gui.serverIpInput.setText('127.0.0.1')
+        gui.serverPortInput.setText(str(self.port))
+        gui.sessionInput.setText('room')
+        return gui, client
+
+    def texts(self, gui):
+        return [row[0] for row in gui.messagesModel.rows]
+
+    def test_windows_chat_through_the_server(self):
+        alice_gui, alice = self.open_window(0)
+        bob_gui, bob = self.open_window(1)
+        alice_gui.connectButton.click()
+        bob_gui.connectButton.click()
+        self.assertTrue(self.wait_until(lambda: bob_gui.connectionStatus.text() == "Connected"
+                                        and alice_gui.connectionStatus.text() == "Connected"))
+        self.assertFalse(alice_gui.connectButton.isEnabled())
+        alice_gui.messageInput.setText("hello from the window")
+        alice_gui.sendButton.click()
+        self.assertTrue(self.wait_until(lambda: "Peer: hello from the window" in self.texts(bob_gui)))
+        alice_gui.disconnectButton.click()
+        self.assertTrue(self.wait_until(lambda: bob_gui.connectionStatus.text() == "Disconnected"))
+        self.assertTrue(bob_gui.connectButton.isEnabled())
+        self.assertTrue(self.wait_until(lambda: "Connection closed." in self.texts(alice_gui)))
+        for client in (alice, bob):
+            client.decrypt_pipeline.close()
+            client.loop.call_soon_threadsafe(client.loop.stop)
+
+
+    def test_history_is_opened_in_the_background(self):
+        gui, client = self.open_window(0)
+        directory = tempfile.mkdtemp()
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            client.load_history(executor, directory, 'secret')
+            # Key derivation runs on the executor; the window is not held up.
+            self.assertIsNone(client.history)
+            self.assertTrue(self.wait_until(lambda: client.history is not None))
+            gui.connectButton.click()
+            self.assertTrue(self.wait_until(lambda: client.conversation == 'room'))
+            client.close_connection()
+        finally:
+            executor.shutdown()
+            if client.history is not None:
+                client.history.close()
+            client.decrypt_pipeline.close()
+            client.loop.call_soon_threadsafe(client.loop.stop)
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class TestClientStartup(unittest.TestCase):
+    """client.py shows its login window before loading the chat modules."""
+
+    def test_heavy_modules_are_not_imported_at_startup(self):
+        deferred = ('Crypto', 'asyncio', 'sqlite3', 'ssl', 'client_gui', 'client_core', 'db')
+        output = subprocess.run([sys.executable, '-c', f"import sys, client; print([m for m in {deferred!r} "
+                                 f"if m in sys.modules])"], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), '[]')
+
+    def test_startup_report(self):
+        timings, lines = run_client('offscreen', importtime=True)
+        self.assertLess(timings['first_window_ms'], timings['chat_modules_ms'])
+        breakdown = import_breakdown(lines)
+        self.assertIn('PyQt5', dict(breakdown['before_first_window']['top']))
+        self.assertIn('asyncio', dict(breakdown['after_first_window']['top']))
+
+
+if __name__ == '__main__':
+    unittest.main()
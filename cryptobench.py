@@ -0,0 +1,243 @@
+import io
+import sys
+import json
+import time
+import base64
+import argparse
+import platform
+import Crypto
+from Crypto.PublicKey import RSA
+from client_crypto import CryptoManager, StreamDecryptor, stream_id_of
+
+# Micro- and macro-benchmarks for client_crypto. Each case reports operations
+# per second (and MB/s where a payload is involved). Results are JSON, so a
+# run can be saved as a baseline and later runs compared against it:
+#
+#   python3 cryptobench.py --output baseline.json
+#   python3 cryptobench.py --compare baseline.json      # exit 1 on regression
+#
+# New cipher modes get covered by adding a case to build_cases().
+
+DEFAULT_KEY_SIZES = (2048, 4096)
+DEFAULT_MESSAGE_SIZES = (16, 256, 4096, 65536, 1048576)
+STREAM_BYTES = 16 * 1024 * 1024
+DEFAULT_THRESHOLD = 0.10
+
+
+def measure(operation, min_time=0.5, min_rounds=3, payload_bytes=None):
+    """Run operation repeatedly for at least min_time seconds."""
+    rounds = 0
+    started = time.perf_counter()
+    elapsed = 0.0
+    while rounds < min_rounds or elapsed < min_time:
+        operation()
+        rounds += 1
+        elapsed = time.perf_counter() - started
+    result = {'ops_per_sec': round(rounds / elapsed, 3), 'mean_us': round(elapsed / rounds * 1e6, 3),
+              'rounds': rounds}
+    if payload_bytes:
+        result['mb_per_sec'] = round(payload_bytes * rounds / elapsed / 1e6, 3)
+    return result
+
+
+def rsa_message_sizes(key_size):
+    # PKCS1_OAEP with SHA-1 fits at most key bytes - 42 of plaintext.
+    limit = key_size // 8 - 42
+    return sorted({size for size in (16, 256) if size < limit} | {limit})
+
+
+def session_pair(key_size):
+    sender = CryptoManager(key_size=key_size)
+    receiver = CryptoManager(key_size=key_size)
+    sender.set_peer_public_key(receiver.get_public_key())
+    receiver.set_peer_public_key(sender.get_public_key())
+    receiver.decrypt_payload(sender.create_session_key())
+    return sender, receiver
+
+
+def build_cases(key_sizes=DEFAULT_KEY_SIZES, message_sizes=DEFAULT_MESSAGE_SIZES):
+    """Yield (name, thunk); calling the thunk sets the case up and returns
+    (operation, measure options). Setup is not timed."""
+    for key_size in key_sizes:
+        yield f"keygen/rsa-{key_size}", lambda key_size=key_size: (
+            lambda: RSA.generate(key_size), {'min_time': 0, 'min_rounds': 3})
+
+    setups = {}
+
+    def rsa_setup(key_size):
+        # One pair of keys serves every RSA case at this size.
+        if key_size not in setups:
+            sender, receiver = session_pair(key_size)
+            setups[key_size] = (sender, receiver, receiver.get_public_key(), sender.create_session_key())
+        return setups[key_size]
+
+    for key_size in key_sizes:
+        def export_case(key_size=key_size):
+            sender, _, _, _ = rsa_setup(key_size)
+            return lambda: sender.public_key.export_key(), {}
+
+        def import_case(key_size=key_size):
+            sender, _, public_key, _ = rsa_setup(key_size)
+            return lambda: sender.set_peer_public_key(public_key), {}
+
+        def wrap_case(key_size=key_size):
+            sender, _, _, _ = rsa_setup(key_size)
+            return sender.create_session_key, {}
+
+        def unwrap_case(key_size=key_size):
+            _, receiver, _, wrapped = rsa_setup(key_size)
+            return lambda: receiver.unwrap_session_key(wrapped), {}
+
+        yield f"rsa-{key_size}/get_public_key", export_case
+        yield f"rsa-{key_size}/set_peer_public_key", import_case
+        yield f"rsa-{key_size}/create_session_key", wrap_case
+        yield f"rsa-{key_size}/unwrap_session_key", unwrap_case
+
+        for size in rsa_message_sizes(key_size):
+            def encrypt_case(key_size=key_size, size=size):
+                sender, _, _, _ = rsa_setup(key_size)
+                message = 'x' * size
+                return lambda: sender.encrypt_message(message), {'payload_bytes': size}
+
+            def decrypt_case(key_size=key_size, size=size):
+                sender, receiver, _, _ = rsa_setup(key_size)
+                ciphertext = sender.encrypt_message('x' * size)
+                return lambda: receiver.decrypt_message(ciphertext), {'payload_bytes': size}
+
+            yield f"rsa-{key_size}/encrypt_message/{size}", encrypt_case
+            yield f"rsa-{key_size}/decrypt_message/{size}", decrypt_case
+
+    for size in message_sizes:
+        data = bytes(size)
+        encoded = base64.b64encode(data)
+        yield f"base64/encode/{size}", lambda data=data, size=size: (
+            lambda: base64.b64encode(data), {'payload_bytes': size})
+        yield f"base64/decode/{size}", lambda encoded=encoded, size=size: (
+            lambda: base64.b64decode(encoded), {'payload_bytes': size})
+
+    gcm = {}
+
+    def gcm_pair():
+        if not gcm:
+            gcm['pair'] = session_pair(min(key_sizes) if key_sizes else 2048)
+        return gcm['pair']
+
+    for size in message_sizes:
+        def encrypt_case(size=size):
+            sender, _ = gcm_pair()
+            data = bytes(size)
+            return lambda: sender.encrypt_payload(data), {'payload_bytes': size}
+
+        def decrypt_case(size=size):
+            sender, receiver = gcm_pair()
+            payload = sender.encrypt_payload(bytes(size))
+            # open_record skips the replay check, so one payload can be reused.
+            return lambda: receiver.open_record(payload, receiver.receive_key), {'payload_bytes': size}
+
+        yield f"aes-gcm/encrypt_payload/{size}", encrypt_case
+        yield f"aes-gcm/decrypt_payload/{size}", decrypt_case
+
+    def stream_encrypt_case():
+        sender, _ = gcm_pair()
+        data = bytes(STREAM_BYTES)
+
+        def operation():
+            for _ in sender.encrypt_stream(io.BytesIO(data)):
+                pass
+        return operation, {'payload_bytes': STREAM_BYTES, 'min_time': 1.0}
+
+    def stream_decrypt_case():
+        sender, receiver = gcm_pair()
+        records = [bytes(record) for record in sender.encrypt_stream(io.BytesIO(bytes(STREAM_BYTES)))]
+
+        def operation():
+            decryptor = StreamDecryptor(receiver.receive_key, stream_id_of(records[0]))
+            for record in records:
+                decryptor.decrypt_chunk(record)
+        return operation, {'payload_bytes': STREAM_BYTES, 'min_time': 1.0}
+
+    yield f"stream/encrypt/{STREAM_BYTES}", stream_encrypt_case
+    yield f"stream/decrypt/{STREAM_BYTES}", stream_decrypt_case
+
+
+def run(cases, name_filter=None, min_time=0.5, report=None):
+    results = {}
+    for name, thunk in cases:
+        if name_filter and not any(part in name for part in name_filter):
+            continue
+        operation, options = thunk()
+        options.setdefault('min_time', min_time)
+        results[name] = measure(operation, **options)
+        if report is not None:
+            report(name, results[name])
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'pycryptodome': Crypto.__version__,
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Return [(name, baseline ops/s, current ops/s, change)] for cases in
+    both runs, and the names that got slower by more than threshold."""
+    rows = []
+    regressions = []
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        change = result['ops_per_sec'] / before['ops_per_sec'] - 1
+        rows.append((name, before['ops_per_sec'], result['ops_per_sec'], change))
+        if change < -threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def print_result(name, result):
+    line = f"{name:<45} {result['ops_per_sec']:>14.1f} ops/s {result['mean_us']:>14.1f} us"
+    if 'mb_per_sec' in result:
+        line += f" {result['mb_per_sec']:>10.1f} MB/s"
+    print(line, file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for client_crypto")
+    parser.add_argument('--key-sizes', type=int, nargs='+', default=list(DEFAULT_KEY_SIZES))
+    parser.add_argument('--message-sizes', type=int, nargs='+', default=list(DEFAULT_MESSAGE_SIZES))
+    parser.add_argument('--filter', nargs='+', help="only run cases whose name contains one of these")
+    parser.add_argument('--min-time', type=float, default=0.5, help="seconds to spend per case")
+    parser.add_argument('--output', help="write the JSON results here (default: stdout)")
+    parser.add_argument('--compare', metavar='BASELINE', help="compare with a saved JSON run")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="fractional slowdown that counts as a regression (default 0.10)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    current = run(build_cases(args.key_sizes, args.message_sizes), args.filter, args.min_time, print_result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+    elif not args.compare:
+        print(json.dumps(current, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows, regressions = compare(baseline, current, args.threshold)
+        for name, before, after, change in rows:
+            flag = "  REGRESSION" if name in regressions else ""
+            print(f"{name:<45} {before:>14.1f} -> {after:>14.1f} ops/s {change:>+8.1%}{flag}")
+        if regressions:
+            print(f"{len(regressions)} case(s) slower than the baseline by more than {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+import time
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import io
+import unittest
+from concurrent.futures import Future
+from Crypto.PublicKey import RSA
+from client_crypto import CryptoManager, RECORD_SESSION_KEY, RECORD_MESSAGE, RECORD_CHUNK
+from client_keys import KeyPool, KeyCache, load_or_generate
+from client_pipeline import DecryptPipeline
+import cryptobench
+
+
+class TestHybridEncryption(unittest.TestCase):
+    """Test cases for the RSA-wrapped AES-GCM session mode."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.alice_keys = CryptoManager(key_size=2048)
+        cls.bob_keys = CryptoManager(key_size=2048)
+
+    def setUp(self):
+        self.alice = self.alice_keys
+        self.bob = self.bob_keys
+        self.alice.set_peer_public_key(self.bob.get_public_key())
+        self.bob.set_peer_public_key(self.alice.get_public_key())
+        self.assertIsNone(self.bob.decrypt_payload(self.alice.create_session_key()))
+        self.assertIsNone(self.alice.decrypt_payload(self.bob.create_session_key()))
+
+    def test_round_trip_both_directions(self):
+        payload = self.alice.encrypt_payload("hello")
+        self.assertEqual(payload[0], RECORD_MESSAGE)
+        self.assertEqual(self.bob.decrypt_payload(payload), b"hello")
+        self.assertEqual(self.alice.decrypt_payload(self.bob.encrypt_payload(b"hi")), b"hi")
+
+    def test_messages_larger_than_rsa_limit(self):
+        message = "x" * 100000
+        self.assertEqual(self.bob.decrypt_payload(self.alice.encrypt_payload(message)), message.encode())
+
+    def test_tampered_message_is_rejected(self):
+        payload = bytearray(self.alice.encrypt_payload("secret"))
+        payload[12] ^= 1
+        with self.assertRaises(ValueError):
+            self.bob.decrypt_payload(bytes(payload))
+
+    def test_replayed_message_is_rejected(self):
+        payload = self.alice.encrypt_payload("once")
+        self.bob.decrypt_payload(payload)
+        with self.assertRaises(ValueError):
+            self.bob.decrypt_payload(payload)
+
+    def test_session_key_record(self):
+        self.assertEqual(self.alice.create_session_key()[0], RECORD_SESSION_KEY)
+
+    def test_legacy_rsa_messages_still_decrypt(self):
+        legacy = self.alice.encrypt_message("old client").encode('utf-8')
+        self.assertEqual(self.bob.decrypt_payload(legacy), b"old client")
+
+    def test_stream_round_trip_from_file(self):
+        data = bytes(range(256)) * 1000
+        records = [bytes(record) for record in self.alice.encrypt_stream(io.BytesIO(data), chunk_size=4096)]
+        self.assertEqual(len(records), 63)
+        self.assertTrue(all(record[0] == RECORD_CHUNK for record in records))
+        plaintext = b''.join(bytes(chunk) for chunk in self.bob.decrypt_stream(records))
+        self.assertEqual(plaintext, data)
+
+    def test_stream_from_iterable_and_empty_stream(self):
+        records = [bytes(record) for record in self.alice.encrypt_stream([b'ab', b'', b'cd'])]
+        self.assertEqual(b''.join(bytes(c) for c in self.bob.decrypt_stream(records)), b'abcd')
+        records = [bytes(record) for record in self.alice.encrypt_stream(io.BytesIO(b''))]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(b''.join(bytes(c) for c in self.bob.decrypt_stream(records)), b'')
+
+    def test_stream_rejects_reordering_and_truncation(self):
+        records = [bytes(record) for record in self.alice.encrypt_stream(io.BytesIO(bytes(10000)), chunk_size=1000)]
+        with self.assertRaises(ValueError):
+            list(self.bob.decrypt_stream([records[0], records[2]]))
+        with self.assertRaises(ValueError):
+            list(self.bob.decrypt_stream(records[:-1]))
+        tampered = bytearray(records[-1])
+        tampered[-1] ^= 1
+        with self.assertRaises(ValueError):
+            list(self.bob.decrypt_stream(records[:-1] + [bytes(tampered)]))
+
+
+class TestKeyProvisioning(unittest.TestCase):
+    """Test cases for the background key pool and the password-protected key cache."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = KeyCache(self.directory)
+        self.pool = KeyPool(key_size=1024)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_crypto_manager_resolves_future_key_on_first_use(self):
+        future = Future()
+        manager = CryptoManager(private_key=future)
+        future.set_result(self.pool.take().result())
+        self.assertIn(b'PUBLIC KEY', manager.get_public_key())
+
+    def test_limited_pool_stops_generating(self):
+        pool = KeyPool(key_size=1024, size=2, limit=1)
+        pool.start()
+        self.assertEqual(len(pool.pending), 1)
+        key = pool.take()
+        self.assertIsNone(pool.executor)
+        self.assertEqual(len(pool.pending), 0)
+        self.assertIn(b'PRIVATE KEY', key.result(timeout=60))
+        with self.assertRaises(RuntimeError):
+            pool.take()
+        pool.shutdown()
+
+    def test_cache_hit_leaves_a_lazy_pool_idle(self):
+        self.cache.store('alice', 'secret', RSA.import_key(self.pool.take().result(timeout=60)))
+        self.assertTrue(self.cache.has_keys())
+        lazy = KeyPool(key_size=1024, limit=1, mp_context=multiprocessing.get_context('spawn'))
+        load_or_generate(lazy, 'alice', 'secret', self.cache).result(timeout=60)
+        self.assertIsNone(lazy.executor)
+        # A miss starts it, in a spawned process.
+        key = load_or_generate(lazy, 'bob', 'secret', self.cache).result(timeout=60)
+        self.assertEqual(key.size_in_bits(), 1024)
+        lazy.shutdown()
+
+    def test_generated_key_is_cached_for_next_login(self):
+        key = load_or_generate(self.pool, 'alice', 'secret', self.cache).result(timeout=60)
+        cached = load_or_generate(self.pool, 'alice', 'secret', self.cache).result(timeout=60)
+        self.assertEqual(key.export_key(), cached.export_key())
+
+    def test_cached_key_needs_the_password(self):
+        key = load_or_generate(self.pool, 'bob', 'right', self.cache).result(timeout=60)
+        self.assertIsNone(self.cache.load('bob', 'wrong'))
+        self.assertEqual(self.cache.load('bob', 'right').export_key(), key.export_key())
+
+
+class TestDecryptPipeline(unittest.TestCase):
+    """Test cases for the off-thread, in-order decrypt pipeline."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sender = CryptoManager(key_size=1024)
+        cls.receiver = CryptoManager(key_size=1024)
+        cls.sender.set_peer_public_key(cls.receiver.get_public_key())
+
+    def setUp(self):
+        self.delivered = []
+        self.errors = []
+        self.done = threading.Event()
+        self.pipeline = DecryptPipeline(self.receiver, self.deliver, self.errors.append, workers=4)
+
+    def tearDown(self):
+        self.pipeline.close()
+
+    def deliver(self, plaintext):
+        self.delivered.append(plaintext)
+        if plaintext == b'last':
+            self.done.set()
+
+    def test_delivers_in_arrival_order(self):
+        self.pipeline.submit(self.sender.create_session_key())
+        messages = [str(i).encode() * (1 + i % 7 * 5000) for i in range(200)] + [b'last']
+        for message in messages:
+            self.pipeline.submit(self.sender.encrypt_payload(message))
+        self.assertTrue(self.done.wait(30))
+        self.assertEqual(self.delivered, messages)
+        self.assertEqual(self.errors, [])
+        self.assertGreater(self.pipeline.peak_depths()['decrypt'], 0)
+
+    def test_replay_is_reported_not_delivered(self):
+        self.pipeline.submit(self.sender.create_session_key())
+        payload = self.sender.encrypt_payload(b'once')
+        self.pipeline.submit(payload)
+        self.pipeline.submit(payload)
+        self.pipeline.submit(self.sender.encrypt_payload(b'last'))
+        self.assertTrue(self.done.wait(30))
+        self.assertEqual(self.delivered, [b'once', b'last'])
+        self.assertEqual(len(self.errors), 1)
+
+    def test_depths_drain_to_zero(self):
+        self.pipeline.submit(self.sender.create_session_key())
+        self.pipeline.submit(self.sender.encrypt_payload(b'last'))
+        self.assertTrue(self.done.wait(30))
+        for _ in range(100):
+            if self.pipeline.depths() == {'decrypt': 0, 'delivery': 0}:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.pipeline.depths(), {'decrypt': 0, 'delivery': 0})
+
+
+class TestCryptoBenchmark(unittest.TestCase):
+    """Test cases for the benchmark runner and baseline comparison."""
+
+    def test_run_reports_throughput(self):
+        report = cryptobench.run(cryptobench.build_cases((1024,), (16, 4096)), ['aes-gcm', 'base64'], 0.01)
+        self.assertEqual(len(report['results']), 8)
+        result = report['results']['aes-gcm/decrypt_payload/4096']
+        self.assertGreater(result['ops_per_sec'], 0)
+        self.assertIn('mb_per_sec', result)
+        self.assertIn('pycryptodome', report['meta'])
+
+    def test_rsa_messages_fit_the_key(self):
+        self.assertEqual(cryptobench.rsa_message_sizes(1024), [16, 86])
+        self.assertEqual(cryptobench.rsa_message_sizes(4096), [16, 256, 470])
+
+    def test_compare_flags_regressions(self):
+        baseline = {'results': {'a': {'ops_per_sec': 100.0}, 'b': {'ops_per_sec': 100.0}}}
+        current = {'results': {'a': {'ops_per_sec': 95.0}, 'b': {'ops_per_sec': 80.0},
+                               'c': {'ops_per_sec': 1.0}}}
+        rows, regressions = cryptobench.compare(baseline, current, threshold=0.10)
+        self.assertEqual([row[0] for row in rows], ['a', 'b'])
+        self.assertEqual(regressions, ['b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
 import unittest
 import os
 import sqlite3
+import threading
+import db
 from db import create_table, register_user, validate_login, hash_password
 
 class TestDatabase(unittest.TestCase):
@@ -10,23 +12,22 @@ class TestDatabase(unittest.TestCase):
         """Set up test environment - use a test database file."""
         # Use a test database file
         self.db_name = 'test_users.db'
+        db.configure(self.db_name)
         
-        # Ensure we're using the test database
-        self._original_connect = sqlite3.connect
-        def mock_connect(database_name, *args, **kwargs):
-            if database_name == 'users.db':
-                return self._original_connect(self.db_name, *args, **kwargs)
-            return self._original_connect(database_name, *args, **kwargs)
-        sqlite3.connect = mock_connect
+        # Keep hashing cheap so the tests stay fast
+        self._original_cost = db.hash_parameters()
+        db.set_hash_cost(n=2 ** 10)
         
         # Create the test database and table
         create_table()
     
     def tearDown(self):
         """Clean up after tests - remove the test database."""
-        sqlite3.connect = self._original_connect
-        if os.path.exists(self.db_name):
-            os.remove(self.db_name)
+        db.close()
+        db.set_hash_cost(*self._original_cost[1:])
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_name + suffix):
+                os.remove(self.db_name + suffix)
     
     def test_create_table(self):
         """Test that the users table is created correctly."""
@@ -100,6 +101,35 @@ class TestDatabase(unittest.TestCase):
         result = validate_login('nonexistentuser', 'anypassword')
         self.assertFalse(result)
     
+    def test_connections_use_wal(self):
+        """Test that the database runs in WAL mode on a reused connection."""
+        conn = db.get_database().connection()
+        self.assertIs(conn, db.get_database().connection())
+        mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, 'wal')
+    
+    def test_concurrent_signup_and_login(self):
+        """Test that parallel writers and readers do not hit a locked database."""
+        register_user('reader', 'readerpassword')
+        errors = []
+        
+        def worker(index):
+            try:
+                for n in range(25):
+                    self.assertTrue(register_user(f'user{index}-{n}', 'password'))
+                    self.assertTrue(validate_login('reader', 'readerpassword'))
+            except Exception as e:
+                errors.append(e)
+        
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        count = db.get_database().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        self.assertEqual(count, 8 * 25 + 1)
+    
     def test_password_hashing(self):
         """Test that password hashing works correctly."""
         password = "mySecurePassword123"
@@ -111,12 +141,47 @@ class TestDatabase(unittest.TestCase):
         # Hash should not be the plain password
         self.assertNotEqual(hashed, password)
         
-        # Same password should produce the same hash
-        self.assertEqual(hashed, hash_password(password))
+        # Hashes are salted, so the same password hashes differently
+        # each time, but both hashes verify
+        again = hash_password(password)
+        self.assertNotEqual(hashed, again)
+        self.assertEqual(db.verify_password(password, hashed), (True, False))
+        self.assertEqual(db.verify_password(password, again), (True, False))
         
-        # Different passwords should produce different hashes
-        self.assertNotEqual(hashed, hash_password("differentPassword"))
-
+        # Different passwords should not verify
+        self.assertFalse(db.verify_password("differentPassword", hashed)[0])
+    
+    def stored_password(self, username):
+        row = db.get_database().execute("SELECT password FROM users WHERE username=?", (username,)).fetchone()
+        return row[0]
+    
+    def test_passwords_are_not_stored_in_plaintext(self):
+        """Test that registration stores a hash, not the password."""
+        register_user('hasheduser', 'secretpassword')
+        stored = self.stored_password('hasheduser')
+        self.assertNotIn('secretpassword', stored)
+        self.assertTrue(stored.startswith('scrypt$1024$'))
+    
+    def test_rehash_on_login_when_cost_changes(self):
+        """Test that a login upgrades a hash made with an older cost."""
+        register_user('olduser', 'oldpassword')
+        db.set_hash_cost(n=2 ** 11)
+        self.assertFalse(validate_login('olduser', 'wrongpassword'))
+        self.assertTrue(self.stored_password('olduser').startswith('scrypt$1024$'))
+        self.assertTrue(validate_login('olduser', 'oldpassword'))
+        self.assertTrue(self.stored_password('olduser').startswith('scrypt$2048$'))
+        self.assertTrue(validate_login('olduser', 'oldpassword'))
+    
+    def test_legacy_plaintext_password_is_upgraded(self):
+        """Test that accounts from before hashing still log in and get hashed."""
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("INSERT INTO users (username, password) VALUES (?, ?)", ('legacy', 'plainpassword'))
+        conn.commit()
+        conn.close()
+        self.assertFalse(validate_login('legacy', 'wrongpassword'))
+        self.assertTrue(validate_login('legacy', 'plainpassword'))
+        self.assertNotEqual(self.stored_password('legacy'), 'plainpassword')
+        self.assertTrue(validate_login('legacy', 'plainpassword'))
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
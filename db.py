@@ -1,34 +1,234 @@
+import os
+import hmac
+import base64
+import hashlib
+import secrets
 import sqlite3
+import threading
 
-def create_table():
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('''
+# User accounts live in one SQLite file. Connections are opened once per
+# thread and kept, so a login is a single indexed query on a warm connection
+# with its statements already prepared, not a connect/parse/close cycle.
+# The database runs in WAL mode, where readers never block the writer and
+# the writer never blocks readers; concurrent writers queue on busy_timeout
+# instead of failing with "database is locked".
+
+DEFAULT_DB_PATH = os.environ.get('CHAT_DB_PATH', 'users.db')
+BUSY_TIMEOUT = 5.0
+CACHED_STATEMENTS = 128
+
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    # With WAL, NORMAL only syncs at checkpoints; a power cut can lose the
+    # last commits but never corrupts the file.
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-8192',  # KiB
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA foreign_keys=ON',
+)
+
+# Passwords are stored as "scrypt$n$r$p$salt$hash" (or
+# "pbkdf2_sha256$iterations$salt$hash" where OpenSSL lacks scrypt), so the
+# cost travels with each hash. Raising the cost only affects new hashes;
+# existing ones are upgraded the next time their owner logs in. The default
+# scrypt cost takes ~50 ms and 16 MiB; CHAT_SCRYPT_N tunes it for the
+# hardware at hand.
+SCRYPT_N = int(os.environ.get('CHAT_SCRYPT_N', 2 ** 14))
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = int(os.environ.get('CHAT_PBKDF2_ITERATIONS', 600000))
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+CREATE_USERS = '''
     CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         username TEXT UNIQUE NOT NULL,
         password TEXT NOT NULL
     )
-    ''')
-    conn.commit()
-    conn.close()
+    '''
+INSERT_USER = 'INSERT INTO users (username, password) VALUES (?, ?)'
+SELECT_LOGIN = 'SELECT id, password FROM users WHERE username = ?'
+UPDATE_PASSWORD = 'UPDATE users SET password = ? WHERE id = ? AND password = ?'
+
+
+class Database:
+    """Per-thread connections to one SQLite database.
+
+    connection() returns the calling thread's connection, opening and
+    configuring it on first use. sqlite3 keeps a cache of prepared
+    statements per connection, so the SQL above is only compiled once per
+    thread. close() closes every connection, from any thread.
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH, timeout=BUSY_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connection(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn is None:
+            # check_same_thread is off only so close() can run from another
+            # thread; each connection is otherwise used by its own thread.
+            conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False,
+                                   cached_statements=CACHED_STATEMENTS)
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            self.local.connection = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def execute(self, sql, parameters=()):
+        return self.connection().execute(sql, parameters)
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
+        self.local = threading.local()
+
+
+database = None
+database_lock = threading.Lock()
+
+
+def configure(path=DEFAULT_DB_PATH, timeout=BUSY_TIMEOUT):
+    """Point the module-level functions at the database file at path."""
+    global database
+    configured = Database(path, timeout)
+    with database_lock:
+        previous, database = database, configured
+    if previous is not None:
+        previous.close()
+    return configured
+
+
+def get_database():
+    global database
+    with database_lock:
+        if database is None:
+            database = Database()
+        return database
+
+
+def close():
+    global database
+    with database_lock:
+        previous, database = database, None
+    if previous is not None:
+        previous.close()
 
-def register_user(username, password):
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
+
+def set_hash_cost(n=None, r=None, p=None, iterations=None):
+    """Change the cost used for new password hashes."""
+    global SCRYPT_N, SCRYPT_R, SCRYPT_P, PBKDF2_ITERATIONS
+    if n is not None:
+        if n < 2 or n & (n - 1):
+            raise ValueError("scrypt n must be a power of two")
+        SCRYPT_N = n
+    SCRYPT_R = r or SCRYPT_R
+    SCRYPT_P = p or SCRYPT_P
+    PBKDF2_ITERATIONS = iterations or PBKDF2_ITERATIONS
+
+
+def hash_parameters():
+    if hasattr(hashlib, 'scrypt'):
+        return ('scrypt', SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return ('pbkdf2_sha256', PBKDF2_ITERATIONS)
+
+
+def derive(password, salt, parameters):
+    password = password.encode('utf-8')
+    if parameters[0] == 'scrypt':
+        n, r, p = parameters[1:]
+        # scrypt needs 128 * r * n bytes; OpenSSL refuses more than maxmem.
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=256 * r * n + (1 << 20),
+                              dklen=HASH_BYTES)
+    return hashlib.pbkdf2_hmac('sha256', password, salt, parameters[1], HASH_BYTES)
+
+
+def hash_password(password, parameters=None):
+    parameters = parameters or hash_parameters()
+    salt = secrets.token_bytes(SALT_BYTES)
+    digest = derive(password, salt, parameters)
+    return '$'.join([*map(str, parameters), base64.b64encode(salt).decode('ascii'),
+                     base64.b64encode(digest).decode('ascii')])
+
+
+def parse_hash(stored):
+    """Return (parameters, salt, digest), or None for a legacy plaintext row."""
+    fields = stored.split('$')
     try:
-        cursor.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, password))
-        conn.commit()
+        if fields[0] == 'scrypt' and len(fields) == 6:
+            parameters = ('scrypt', int(fields[1]), int(fields[2]), int(fields[3]))
+        elif fields[0] == 'pbkdf2_sha256' and len(fields) == 4:
+            parameters = ('pbkdf2_sha256', int(fields[1]))
+        else:
+            return None
+        return parameters, base64.b64decode(fields[-2]), base64.b64decode(fields[-1])
+    except ValueError:
+        return None
+
+
+def verify_password(password, stored):
+    """Return (matches, needs_rehash) for a stored hash."""
+    parsed = parse_hash(stored)
+    if parsed is None:
+        # Accounts created before passwords were hashed.
+        return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8')), True
+    parameters, salt, digest = parsed
+    matches = hmac.compare_digest(derive(password, salt, parameters), digest)
+    return matches, parameters != hash_parameters()
+
+
+def create_table(database=None):
+    conn = (database or get_database()).connection()
+    with conn:
+        conn.execute(CREATE_USERS)
+
+def register_user(username, password, database=None):
+    # Hash before taking the write lock; this is the slow part.
+    hashed = hash_password(password)
+    conn = (database or get_database()).connection()
+    try:
+        with conn:
+            conn.execute(INSERT_USER, (username, hashed))
         return True
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
-
-def validate_login(username, password):
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE username = ? AND password = ?', (username, password))
-    user = cursor.fetchone()
-    conn.close()
-    return user is not None
+
+def validate_login(username, password, database=None):
+    """Check a password; slow by design, so call it off the GUI thread."""
+    return check_login(username, password, database) is not None
+
+def check_login(username, password, database=None):
+    """Like validate_login, but returns the stored hash the password matched
+    (as it is after any rehash), or None."""
+    conn = (database or get_database()).connection()
+    user = conn.execute(SELECT_LOGIN, (username,)).fetchone()
+    if user is None:
+        # Take as long as a real check, so timing does not reveal which
+        # usernames exist.
+        hash_password(password)
+        return None
+    user_id, stored = user
+    matches, needs_rehash = verify_password(password, stored)
+    if not matches:
+        return None
+    if needs_rehash:
+        rehashed = hash_password(password)
+        with conn:
+            if conn.execute(UPDATE_PASSWORD, (rehashed, user_id, stored)).rowcount:
+                stored = rehashed
+    return stored
+
+def stored_password(username, database=None):
+    """The user's stored password hash, or None; one indexed row, no hashing."""
+    conn = (database or get_database()).connection()
+    user = conn.execute(SELECT_LOGIN, (username,)).fetchone()
+    return None if user is None else user[1]
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+from client_history import HistoryStore, SELECT_PAGE
+
+
+class TestHistoryStore(unittest.TestCase):
+    """Test cases for the encrypted, paginated message history."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = HistoryStore.for_user(self.directory, 'alice', 'secret')
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def fill(self, count, conversation='room'):
+        self.store.append_many(conversation, [(n % 2 == 0, f"message {n}", 1000 + n) for n in range(count)])
+
+    def test_pages_walk_back_by_keyset(self):
+        self.fill(250)
+        newest = self.store.page('room', limit=100)
+        self.assertEqual([m.text for m in newest], [f"message {n}" for n in range(150, 250)])
+        older = self.store.page('room', before=newest[0].id, limit=100)
+        self.assertEqual(older[-1].text, "message 149")
+        oldest = self.store.page('room', before=older[0].id, limit=100)
+        self.assertEqual(len(oldest), 50)
+        self.assertEqual(oldest[0].text, "message 0")
+        self.assertTrue(oldest[0].outgoing)
+        self.assertEqual(oldest[0].sent_at, 1000)
+        self.assertEqual(self.store.page('room', before=oldest[0].id), [])
+
+    def test_conversations_are_separate(self):
+        self.store.append('room', True, "hello room")
+        self.store.append('other', False, "hello other")
+        self.assertEqual([m.text for m in self.store.page('room')], ["hello room"])
+        self.assertEqual([m.text for m in self.store.search('other', 'hello')], ["hello other"])
+
+    def test_search_matches_whole_words(self):
+        self.store.append('room', True, "Meet at the station")
+        self.store.append('room', False, "Which station?")
+        self.store.append('room', True, "The north one")
+        self.assertEqual([m.text for m in self.store.search('room', 'STATION')],
+                         ["Which station?", "Meet at the station"])
+        self.assertEqual([m.text for m in self.store.search('room', 'the station')], ["Meet at the station"])
+        self.assertEqual(self.store.search('room', 'stat'), [])
+
+    def test_nothing_is_stored_in_plaintext(self):
+        self.store.append('private room', True, "attack at dawn")
+        self.store.close()
+        for name in os.listdir(self.directory):
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                data = f.read()
+            self.assertNotIn(b'dawn', data)
+            self.assertNotIn(b'private room', data)
+
+    def test_wrong_password_is_rejected(self):
+        self.store.append('room', True, "hello")
+        with self.assertRaises(ValueError):
+            HistoryStore(self.store.path, 'not the password')
+        reopened = HistoryStore(self.store.path, 'secret')
+        self.assertEqual([m.text for m in reopened.page('room')], ["hello"])
+        reopened.close()
+
+    def test_page_query_uses_the_conversation_index(self):
+        self.fill(1000)
+        plan = self.store.database.execute('EXPLAIN QUERY PLAN ' + SELECT_PAGE, ('x', 10, 10)).fetchall()
+        details = ' '.join(row[-1] for row in plan)
+        self.assertIn('messages_by_conversation', details)
+        self.assertNotIn('TEMP B-TREE', details)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,7 @@ from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtWidgets import QPushButton, QLineEdit
 
 from login_gui import LoginSignupGUI
+import db
 from db import create_table, register_user
 
 # Create QApplication instance for tests
@@ -22,13 +23,12 @@ class TestLoginIntegration(unittest.TestCase):
         # Use a temporary file for the test database
         self.db_fd, self.db_path = tempfile.mkstemp()
         
-        # Override sqlite3.connect to use our test database
-        self._original_connect = sqlite3.connect
-        def mock_connect(database_name, *args, **kwargs):
-            if database_name == 'users.db':
-                return self._original_connect(self.db_path, *args, **kwargs)
-            return self._original_connect(database_name, *args, **kwargs)
-        sqlite3.connect = mock_connect
+        # Point the database layer at our test database
+        db.configure(self.db_path)
+        
+        # Keep hashing cheap so the tests stay fast
+        self._original_cost = db.hash_parameters()
+        db.set_hash_cost(n=2 ** 10)
         
         # Create the test database and table
         create_table()
@@ -42,9 +42,33 @@ class TestLoginIntegration(unittest.TestCase):
     def tearDown(self):
         """Clean up after tests."""
         self.login_gui.close()
-        sqlite3.connect = self._original_connect
+        if hasattr(self, 'box_closer'):
+            self.box_closer.stop()
+        db.close()
+        db.set_hash_cost(*self._original_cost[1:])
         os.close(self.db_fd)
-        os.unlink(self.db_path)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_path + suffix):
+                os.unlink(self.db_path + suffix)
+    
+    def wait_until(self, condition, timeout=5000):
+        """Run the event loop until condition() holds; checks finish on a worker thread."""
+        for _ in range(timeout // 10):
+            if condition():
+                return True
+            QTest.qWait(10)
+        return condition()
+    
+    def close_message_boxes(self):
+        """Keep closing message boxes until the test ends; they open when a check finishes."""
+        def close_message_box():
+            for widget in QApplication.topLevelWidgets():
+                if widget.isVisible() and widget.metaObject().className() == 'QMessageBox':
+                    QTest.keyClick(widget, Qt.Key_Enter)
+        
+        self.box_closer = QTimer()
+        self.box_closer.timeout.connect(close_message_box)
+        self.box_closer.start(50)
     
     def test_successful_login(self):
         """Test successful login with valid credentials."""
@@ -67,7 +91,7 @@ class TestLoginIntegration(unittest.TestCase):
         
         # Find and click the login button
         login_button = None
-        for child in self.login_gui.findChildren(QPushButton):
+        for child in self.login_gui.login_page.findChildren(QPushButton):
             if child.text() == "Login":
                 login_button = child
                 break
@@ -76,7 +100,7 @@ class TestLoginIntegration(unittest.TestCase):
         QTest.mouseClick(login_button, Qt.LeftButton)
         
         # Check that login was successful
-        self.assertTrue(self.login_success_received)
+        self.assertTrue(self.wait_until(lambda: self.login_success_received))
         self.assertEqual(self.login_username_received, 'testuser')
     
     def test_failed_login(self):
@@ -106,19 +130,13 @@ class TestLoginIntegration(unittest.TestCase):
         self.assertIsNotNone(login_button)
         
         # Use a timer to close the error message box
-        def close_message_box():
-            # Find active QMessageBox and close it
-            for widget in QApplication.topLevelWidgets():
-                if widget.isVisible() and widget.metaObject().className() == 'QMessageBox':
-                    QTest.keyClick(widget, Qt.Key_Enter)
-        
-        QTimer.singleShot(100, close_message_box)
+        self.close_message_boxes()
         
         # Click login button
         QTest.mouseClick(login_button, Qt.LeftButton)
         
-        # Process events to ensure signal handling completes
-        QApplication.processEvents()
+        # Wait for the check to finish
+        self.assertTrue(self.wait_until(login_button.isEnabled))
         
         # Check that login failed
         self.assertFalse(self.login_success_received)
@@ -143,18 +161,13 @@ class TestLoginIntegration(unittest.TestCase):
         self.assertIsNotNone(signup_button)
         
         # Use a timer to close the success message box
-        def close_message_box():
-            for widget in QApplication.topLevelWidgets():
-                if widget.isVisible() and widget.metaObject().className() == 'QMessageBox':
-                    QTest.keyClick(widget, Qt.Key_Enter)
-        
-        QTimer.singleShot(100, close_message_box)
+        self.close_message_boxes()
         
         # Click signup button
         QTest.mouseClick(signup_button, Qt.LeftButton)
         
-        # Process events to ensure signal handling completes
-        QApplication.processEvents()
+        # Wait for the account to be created
+        self.assertTrue(self.wait_until(lambda: self.login_gui.stacked_widget.currentIndex() == 0))
         
         # The login page should now be showing with username prefilled
         self.assertEqual(self.login_gui.stacked_widget.currentIndex(), 0)
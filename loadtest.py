@@ -0,0 +1,273 @@
+import os
+import sys
+import time
+import json
+import socket
+import struct
+import asyncio
+import argparse
+import subprocess
+from Crypto.PublicKey import RSA
+from protocol import (FrameParser, encode_frame, REQUEST_PUBLIC_KEY, PUBLIC_KEY, PEER_PUBLIC_KEY,
+                      DISCONNECT, MESSAGE, JOIN)
+from server_metrics import LatencyHistogram
+from server_async import raise_file_limit
+
+# Headless load generator for the relay. Each simulated pair joins its own
+# conversation, swaps real RSA public keys through the server, then both sides
+# send MESSAGE frames at a fixed rate. Every payload starts with the sender's
+# perf_counter() timestamp, so the receiver (in the same process) can record
+# the full client -> relay -> client latency.
+
+STAMP = struct.Struct('!d')
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+
+class ProcessStats:
+    """CPU time, resident memory and thread count of a process, from /proc."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+    def available(self):
+        return os.path.exists(f"/proc/{self.pid}/stat")
+
+    def cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            # The command name may contain spaces; fields resume after ')'.
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.ticks
+
+    def status(self):
+        values = {}
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                values[key] = value.strip()
+        return {
+            'rss_mb': int(values.get('VmRSS', '0 kB').split()[0]) / 1024,
+            'threads': int(values.get('Threads', '0')),
+        }
+
+
+class LoadClient:
+    def __init__(self, session_id, public_key, size, latencies):
+        self.session_id = session_id
+        self.public_key = public_key
+        self.size = max(size, STAMP.size)
+        self.latencies = latencies
+        self.parser = FrameParser()
+        self.reader = None
+        self.writer = None
+        self.peer_key = None
+        self.sent = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.recording = False
+
+    async def read_frame(self):
+        while True:
+            frame = next(self.parser.frames(), None)
+            if frame is not None:
+                return frame[0], bytes(frame[1])
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            self.parser.feed(data)
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        frame_type, _ = await self.read_frame()
+        if frame_type != REQUEST_PUBLIC_KEY:
+            raise ConnectionError(f"Expected REQUEST_PUBLIC_KEY, got frame {frame_type}")
+        self.writer.write(encode_frame(JOIN, self.session_id) + encode_frame(PUBLIC_KEY, self.public_key))
+
+    async def wait_for_peer(self):
+        frame_type, payload = await self.read_frame()
+        if frame_type != PEER_PUBLIC_KEY:
+            raise ConnectionError(f"Expected PEER_PUBLIC_KEY, got frame {frame_type}")
+        self.peer_key = RSA.import_key(payload)
+
+    async def send_loop(self, rate, stop_at):
+        padding = bytes(self.size - STAMP.size)
+        interval = 1.0 / rate if rate else 0
+        next_send = time.perf_counter()
+        while next_send < stop_at:
+            self.writer.write(encode_frame(MESSAGE, STAMP.pack(time.perf_counter()) + padding))
+            self.sent += 1
+            await self.writer.drain()
+            if interval:
+                # Keep to the schedule rather than sleeping a fixed interval,
+                # so slow iterations do not lower the offered rate.
+                next_send += interval
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                next_send = time.perf_counter()
+                await asyncio.sleep(0)
+
+    async def receive_loop(self):
+        while True:
+            frame_type, payload = await self.read_frame()
+            if frame_type == DISCONNECT:
+                return
+            if frame_type == MESSAGE and self.recording:
+                (stamp,) = STAMP.unpack_from(payload)
+                self.latencies.record(time.perf_counter() - stamp)
+                self.received += 1
+                self.received_bytes += len(payload)
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            self.writer.write(encode_frame(DISCONNECT))
+            self.writer.close()
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+async def run_benchmark(host, port, pairs=10, rate=10.0, size=256, duration=10.0,
+                        key_bits=2048, key_count=2, server_pid=None):
+    """Drive `pairs` conversations against host:port and return a report dict."""
+    raise_file_limit()
+    keys = [RSA.generate(key_bits).publickey().export_key() for _ in range(key_count)]
+    latencies = LatencyHistogram()
+    connect_times = LatencyHistogram()
+    clients = []
+    for pair in range(pairs):
+        session_id = f"load-{pair}".encode()
+        clients.append(LoadClient(session_id, keys[(2 * pair) % key_count], size, latencies))
+        clients.append(LoadClient(session_id, keys[(2 * pair + 1) % key_count], size, latencies))
+
+    async def connect(client):
+        started = time.perf_counter()
+        await client.connect(host, port)
+        await client.wait_for_peer()
+        connect_times.record(time.perf_counter() - started)
+
+    try:
+        await asyncio.gather(*(connect(client) for client in clients))
+        server = ProcessStats(server_pid) if server_pid else None
+        if server is not None and not server.available():
+            server = None
+        own = ProcessStats(os.getpid())
+        own_cpu = own.cpu_seconds() if own.available() else None
+        server_cpu = server.cpu_seconds() if server else None
+
+        receivers = [asyncio.ensure_future(client.receive_loop()) for client in clients]
+        for client in clients:
+            client.recording = True
+        started = time.perf_counter()
+        stop_at = started + duration
+        await asyncio.gather(*(client.send_loop(rate, stop_at) for client in clients))
+        # Give frames still in flight a moment to arrive before counting.
+        await asyncio.sleep(min(1.0, duration / 10))
+        elapsed = time.perf_counter() - started
+        for client in clients:
+            client.recording = False
+
+        report = {
+            'pairs': pairs,
+            'rate_per_client': rate,
+            'message_bytes': clients[0].size if clients else size,
+            'duration': round(elapsed, 3),
+            'connect_p99_ms': round(connect_times.percentile(0.99) * 1000, 3),
+            'sent': sum(client.sent for client in clients),
+            'received': sum(client.received for client in clients),
+        }
+        report['messages_per_second'] = round(report['received'] / elapsed, 1)
+        report['mb_per_second'] = round(sum(client.received_bytes for client in clients) / elapsed / 1e6, 3)
+        for name, quantile in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+            report[f'latency_{name}_ms'] = round(latencies.percentile(quantile) * 1000, 3)
+        report['latency_max_ms'] = round(latencies.max * 1000, 3)
+        if server is not None:
+            report['server_cpu_percent'] = round((server.cpu_seconds() - server_cpu) / elapsed * 100, 1)
+            stats = server.status()
+            report['server_rss_mb'] = round(stats['rss_mb'], 1)
+            report['server_threads'] = stats['threads']
+        if own_cpu is not None:
+            report['loadgen_cpu_percent'] = round((own.cpu_seconds() - own_cpu) / elapsed * 100, 1)
+        for receiver in receivers:
+            receiver.cancel()
+        return report
+    finally:
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+
+
+def free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def start_local_server(host, engine='threaded', workers=1, extra_args=()):
+    """Run server.py in a child process on a free port; returns (process, port)."""
+    port = free_port(host)
+    command = [sys.executable, SERVER_SCRIPT, '--host', host, '--port', str(port), '--engine', engine,
+               '--workers', str(workers), '--idle-timeout', '0', *extra_args]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode}")
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Server did not start listening in time")
+
+
+def print_report(report):
+    width = max(len(key) for key in report)
+    for key, value in report.items():
+        print(f"{key:<{width}}  {value}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Headless load generator for the chat relay")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int,
+                        help="benchmark a running server; by default a local server.py is started")
+    parser.add_argument('--engine', choices=('threaded', 'asyncio'), default='threaded',
+                        help="engine of the local server")
+    parser.add_argument('--workers', type=int, default=1, help="worker processes of the local server (CPU and RSS then cover only the parent)")
+    parser.add_argument('--pairs', type=int, default=10, help="simulated client pairs")
+    parser.add_argument('--rate', type=float, default=10.0,
+                        help="messages per second sent by each client (0 = as fast as possible)")
+    parser.add_argument('--size', type=int, default=256, help="MESSAGE payload size in bytes")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to send for")
+    parser.add_argument('--key-bits', type=int, default=2048,
+                        help="RSA key size for the key exchange (keys are generated once and shared)")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    process = None
+    port = args.port
+    server_pid = None
+    if port is None:
+        process, port = start_local_server(args.host, args.engine, args.workers)
+        server_pid = process.pid
+    try:
+        report = asyncio.run(run_benchmark(args.host, port, args.pairs, args.rate, args.size,
+                                           args.duration, args.key_bits, server_pid=server_pid))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,24 @@
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, 
                              QLineEdit, QPushButton, QStackedWidget, 
                              QMessageBox, QApplication)
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5.QtCore import Qt, pyqtSignal
 from PyQt5.QtGui import QFont
 
 class LoginSignupGUI(QWidget):
     login_successful = pyqtSignal(str)  # Signal to emit when login is successful
+    # Results of password checks, emitted from the worker thread and
+    # delivered on the GUI thread
+    login_checked = pyqtSignal(str, bool)
+    signup_checked = pyqtSignal(str, bool)
     
     def __init__(self):
         super().__init__()
+        # Password hashing is slow on purpose, so it never runs on the
+        # event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="login")
+        self.login_checked.connect(self.finish_login)
+        self.signup_checked.connect(self.finish_signup)
         self.init_ui()
         
     def init_ui(self):
@@ -57,8 +67,8 @@ class LoginSignupGUI(QWidget):
         self.login_password.setEchoMode(QLineEdit.Password)
         
         # Login button
-        login_button = QPushButton("Login")
-        login_button.clicked.connect(self.handle_login)
+        self.login_button = QPushButton("Login")
+        self.login_button.clicked.connect(self.handle_login)
         
         # Link to signup
         signup_text = QLabel("Don't have an account?")
@@ -80,7 +90,7 @@ class LoginSignupGUI(QWidget):
         layout.addWidget(password_label)
         layout.addWidget(self.login_password)
         layout.addSpacing(10)
-        layout.addWidget(login_button)
+        layout.addWidget(self.login_button)
         layout.addSpacing(20)
         layout.addLayout(signup_layout)
         layout.addStretch()
@@ -115,8 +125,8 @@ class LoginSignupGUI(QWidget):
         self.signup_confirm.setEchoMode(QLineEdit.Password)
         
         # Signup button
-        signup_button = QPushButton("Create Account")
-        signup_button.clicked.connect(self.handle_signup)
+        self.signup_button = QPushButton("Create Account")
+        self.signup_button.clicked.connect(self.handle_signup)
         
         # Link to login
         login_text = QLabel("Already have an account?")
@@ -140,7 +150,7 @@ class LoginSignupGUI(QWidget):
         layout.addWidget(confirm_label)
         layout.addWidget(self.signup_confirm)
         layout.addSpacing(10)
-        layout.addWidget(signup_button)
+        layout.addWidget(self.signup_button)
         layout.addSpacing(20)
         layout.addLayout(login_layout)
         layout.addStretch()
@@ -158,7 +168,16 @@ class LoginSignupGUI(QWidget):
             QMessageBox.warning(self, "Login Error", "Please enter both username and password.")
             return
         
-        if validate_login(username, password):
+        self.login_button.setEnabled(False)
+        self.run_check(validate_login, self.login_checked, username, password)
+    
+    def run_check(self, check, signal, username, password):
+        future = self.executor.submit(check, username, password)
+        future.add_done_callback(lambda f: signal.emit(username, not f.exception() and bool(f.result())))
+    
+    def finish_login(self, username, valid):
+        self.login_button.setEnabled(True)
+        if valid:
             self.login_successful.emit(username)
         else:
             QMessageBox.warning(self, "Login Error", "Invalid username or password.")
@@ -178,7 +197,12 @@ class LoginSignupGUI(QWidget):
             QMessageBox.warning(self, "Signup Error", "Passwords do not match.")
             return
         
-        if register_user(username, password):
+        self.signup_button.setEnabled(False)
+        self.run_check(register_user, self.signup_checked, username, password)
+    
+    def finish_signup(self, username, created):
+        self.signup_button.setEnabled(True)
+        if created:
             QMessageBox.information(self, "Success", "Account created successfully. You can now log in.")
             self.stacked_widget.setCurrentIndex(0)  # Switch to login page
             self.login_username.setText(username)  # Pre-fill username
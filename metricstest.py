@@ -0,0 +1,58 @@
+import unittest
+import urllib.request
+from server_metrics import LatencyHistogram, Metrics, start_metrics_server
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    """Test cases for the log-linear latency histogram."""
+
+    def test_percentiles_within_bucket_precision(self):
+        histogram = LatencyHistogram()
+        for micros in range(1, 10001):
+            histogram.record(micros / 1_000_000)
+        self.assertEqual(histogram.count, 10000)
+        for quantile, expected in ((0.5, 0.005), (0.99, 0.0099), (0.999, 0.00999)):
+            self.assertAlmostEqual(histogram.percentile(quantile), expected, delta=expected * 0.04)
+
+    def test_small_values_are_exact(self):
+        histogram = LatencyHistogram()
+        for micros in (3, 7, 20):
+            histogram.record(micros / 1_000_000)
+        self.assertEqual(histogram.percentile(1.0), 20 / 1_000_000)
+
+    def test_empty_histogram(self):
+        self.assertEqual(LatencyHistogram().percentile(0.99), 0.0)
+
+
+class TestMetrics(unittest.TestCase):
+    """Test cases for the metrics registry and its scrape endpoint."""
+
+    def test_render_includes_counters_gauges_and_rates(self):
+        metrics = Metrics()
+        metrics.inc('messages_relayed', 5)
+        metrics.add_gauge('connections', 2)
+        metrics.gauge_callback('sessions', lambda: 1)
+        metrics.observe('relay_latency', 0.001)
+        text = metrics.render()
+        self.assertIn('chat_messages_relayed_total 5', text)
+        self.assertIn('chat_connections 2', text)
+        self.assertIn('chat_sessions 1', text)
+        self.assertIn('chat_relay_latency_seconds_count 1', text)
+        metrics.inc('messages_relayed')
+        self.assertIn('chat_messages_relayed_per_second', metrics.render())
+
+    def test_http_endpoint(self):
+        metrics = Metrics()
+        metrics.inc('send_errors')
+        httpd = start_metrics_server(metrics, 0)
+        try:
+            url = f"http://127.0.0.1:{httpd.server_address[1]}/metrics"
+            with urllib.request.urlopen(url, timeout=5) as response:
+                self.assertIn(b'chat_send_errors_total 1', response.read())
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import os
+import mmap
+import time
+import struct
+import hashlib
+import threading
+from protocol import HEADER, HEADER_SIZE
+
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_SEGMENT_AGE = 3600.0
+DEFAULT_FSYNC_INTERVAL = 0.05
+LENGTH = struct.Struct('!I')
+
+
+def mailbox_of(session_id, public_key):
+    """The recipient ID for frames kept for the client with public_key in
+    session_id. A client that comes back with the same key (see
+    client.py --key-cache) finds them; anyone else joining does not."""
+    return hashlib.sha256(LENGTH.pack(len(session_id)) + session_id + public_key).digest()
+
+
+class Segment:
+    __slots__ = ('path', 'file', 'size', 'created')
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.size = self.file.tell()
+        self.created = time.monotonic()
+
+
+class OfflineStore:
+    """Append-only, per-recipient segment files for undeliverable frames.
+
+    Each recipient gets a directory of numbered segment files holding frames
+    in wire format (header + payload), so storing a message is one buffered
+    write and replay is a sequential scan. Segments rotate by size or age. A
+    background thread fsyncs everything written since the last pass in one
+    group commit every fsync_interval seconds.
+    """
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 segment_age=DEFAULT_SEGMENT_AGE, fsync_interval=DEFAULT_FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.fsync_interval = fsync_interval
+        self.segments = {}  # recipient -> open Segment being appended to
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.running = True
+        os.makedirs(directory, exist_ok=True)
+        self.committer = threading.Thread(target=self.commit_loop, name="offline-fsync", daemon=True)
+        self.committer.start()
+
+    def recipient_dir(self, recipient):
+        # Recipients are arbitrary bytes (see mailbox_of), so hex-encode them.
+        return os.path.join(self.directory, 'r-' + recipient.hex())
+
+    def segment_paths(self, recipient):
+        directory = self.recipient_dir(recipient)
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.endswith('.seg'))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(directory, name) for name in names]
+
+    def has_messages(self, recipient):
+        with self.lock:
+            return recipient in self.segments or bool(self.segment_paths(recipient))
+
+    def append(self, recipient, frame_type, payload):
+        header = HEADER.pack(len(payload), frame_type)
+        with self.lock:
+            segment = self.segments.get(recipient)
+            if segment is not None and (segment.size >= self.segment_bytes
+                                        or time.monotonic() - segment.created >= self.segment_age):
+                self.close_segment(recipient)
+                segment = None
+            if segment is None:
+                segment = self.open_segment(recipient)
+            segment.file.write(header)
+            segment.file.write(payload)
+            segment.size += len(header) + len(payload)
+            self.dirty.add(recipient)
+
+    def open_segment(self, recipient):
+        directory = self.recipient_dir(recipient)
+        os.makedirs(directory, exist_ok=True)
+        existing = self.segment_paths(recipient)
+        number = int(os.path.basename(existing[-1])[:-4]) + 1 if existing else 0
+        segment = Segment(os.path.join(directory, f"{number:020d}.seg"))
+        self.segments[recipient] = segment
+        return segment
+
+    def close_segment(self, recipient):
+        segment = self.segments.pop(recipient)
+        segment.file.flush()
+        os.fsync(segment.file.fileno())
+        segment.file.close()
+        self.dirty.discard(recipient)
+
+    def replay(self, recipient, deliver):
+        """Call deliver(frame_type, payload) for every stored frame, oldest
+        first, deleting each segment once all its frames are delivered.
+
+        If deliver returns False the frame was not taken: replay stops and
+        that frame and everything after it stay stored for the next replay.
+        Returns the number of frames delivered.
+        """
+        count = 0
+        for path in self.pending_segments(recipient):
+            frames = self.read_segment(path)
+            for n, (frame_type, payload) in enumerate(frames):
+                if deliver(frame_type, payload) is False:
+                    self.finish_segment(recipient, path, frames[n:])
+                    return count
+                count += 1
+            self.finish_segment(recipient, path)
+        return count
+
+    def pending_segments(self, recipient):
+        """Close the recipient's open segment and return its segment paths,
+        oldest first. Frames appended afterwards go to a new segment and
+        are left for the next replay."""
+        with self.lock:
+            if recipient in self.segments:
+                self.close_segment(recipient)
+            return self.segment_paths(recipient)
+
+    def read_segment(self, path):
+        """Return the complete [(frame_type, payload)] records in a segment."""
+        size = os.path.getsize(path)
+        if size == 0:
+            return []
+        frames = []
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            offset = 0
+            while offset + HEADER_SIZE <= size:
+                length, frame_type = HEADER.unpack_from(mapped, offset)
+                end = offset + HEADER_SIZE + length
+                if end > size:
+                    # Torn write from a crash: the record never completed.
+                    break
+                frames.append((frame_type, mapped[offset + HEADER_SIZE:end]))
+                offset = end
+        return frames
+
+    def finish_segment(self, recipient, path, remaining=()):
+        """Delete a replayed segment, or, if some of its frames were not
+        delivered, replace it with just those so they keep their place."""
+        if remaining:
+            partial = path + '.tmp'
+            with open(partial, 'wb') as file:
+                for frame_type, payload in remaining:
+                    file.write(HEADER.pack(len(payload), frame_type))
+                    file.write(payload)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(partial, path)
+            return
+        os.remove(path)
+        with self.lock:
+            if recipient not in self.segments:
+                try:
+                    os.rmdir(self.recipient_dir(recipient))
+                except OSError:
+                    pass
+
+    def commit_loop(self):
+        while self.running:
+            time.sleep(self.fsync_interval)
+            self.commit()
+
+    def commit(self):
+        # Flush under the lock, then fsync duplicated descriptors outside it
+        # so appends are not held up by the disk.
+        with self.lock:
+            fds = []
+            for recipient in self.dirty:
+                segment = self.segments.get(recipient)
+                if segment is not None:
+                    segment.file.flush()
+                    fds.append(os.dup(segment.file.fileno()))
+            self.dirty.clear()
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        self.running = False
+        with self.lock:
+            for recipient in list(self.segments):
+                self.close_segment(recipient)
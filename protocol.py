@@ -0,0 +1,239 @@
+import ssl
+import json
+import struct
+
+# Wire format shared by server.py and client.py:
+#
+#   +----------------+------+-----------------+
+#   | length (4, BE) | type | payload (length) |
+#   +----------------+------+-----------------+
+#
+# The length covers the payload only. Control frames carry an empty payload
+# (or a PEM public key); MESSAGE payloads are opaque ciphertext to the server.
+# A client may send JOIN with a conversation ID before its PUBLIC_KEY to be
+# paired with the other client that joins the same ID. Clients send HEARTBEAT
+# while otherwise quiet so the server does not reap them as idle.
+#
+# A server with a user store says so with an AUTH_REQUIRED payload in
+# REQUEST_PUBLIC_KEY, and requires AUTH ({"username", "password"} as JSON)
+# before JOIN/PUBLIC_KEY. It answers with AUTH_RESULT ({"ok", "reason"}); a
+# client waits for the result before sending its key. AUTH carries the
+# password in the clear, so clients send it only when asked and only over
+# TLS. Servers without a user store accept any AUTH.
+#
+# A client that can reconnect sends an empty RESUME before its key; once it
+# has joined, the server answers with RESUME_TOKEN. If that client drops
+# without a DISCONNECT, its place in the conversation is held for
+# RESUME_TIMEOUT seconds: a new connection sends RESUME with the token in
+# place of JOIN/PUBLIC_KEY and gets RESUME_RESULT (same body as
+# AUTH_RESULT). On success it carries on with the same peer and keys; on
+# failure it falls back to JOIN/PUBLIC_KEY.
+#
+# A server with an offline store keeps a conversation open when one side
+# leaves: the other gets PEER_LEFT and may send STORED_MESSAGE frames, which
+# the server keeps in a mailbox for the client that left (identified by the
+# conversation ID and its public key) and replays, as STORED_MESSAGE, when a
+# client with that key joins the conversation again. The first stored frame
+# should carry a fresh session key wrapped for the absent peer, since the
+# old session's keys are gone by the time the mailbox is read. Without an
+# offline store, the other side gets DISCONNECT instead.
+
+# Seconds a server waits for PUBLIC_KEY, how long a connection may stay silent
+# before it is reaped, how often clients send HEARTBEAT to stay under it, and
+# how long a dropped client's place is held for it to resume.
+PUBLIC_KEY_TIMEOUT = 30.0
+IDLE_TIMEOUT = 300.0
+HEARTBEAT_INTERVAL = 60.0
+RESUME_TIMEOUT = 60.0
+
+HEADER = struct.Struct('!IB')
+HEADER_SIZE = HEADER.size
+MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+
+REQUEST_PUBLIC_KEY = 1
+PUBLIC_KEY = 2
+PEER_PUBLIC_KEY = 3
+DISCONNECT = 4
+MESSAGE = 5
+JOIN = 6
+HEARTBEAT = 7
+AUTH = 8
+AUTH_RESULT = 9
+RESUME = 10
+RESUME_TOKEN = 11
+RESUME_RESULT = 12
+PEER_LEFT = 13
+STORED_MESSAGE = 14
+
+# REQUEST_PUBLIC_KEY payload from a server that requires AUTH.
+AUTH_REQUIRED = b'\x01'
+
+FRAME_NAMES = {
+    REQUEST_PUBLIC_KEY: "REQUEST_PUBLIC_KEY",
+    PUBLIC_KEY: "PUBLIC_KEY",
+    PEER_PUBLIC_KEY: "PEER_PUBLIC_KEY",
+    DISCONNECT: "DISCONNECT",
+    MESSAGE: "MESSAGE",
+    JOIN: "JOIN",
+    HEARTBEAT: "HEARTBEAT",
+    AUTH: "AUTH",
+    AUTH_RESULT: "AUTH_RESULT",
+    RESUME: "RESUME",
+    RESUME_TOKEN: "RESUME_TOKEN",
+    RESUME_RESULT: "RESUME_RESULT",
+    PEER_LEFT: "PEER_LEFT",
+    STORED_MESSAGE: "STORED_MESSAGE",
+}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_auth(username, password):
+    return json.dumps({'username': username, 'password': password}).encode('utf-8')
+
+
+def decode_auth(payload):
+    try:
+        credentials = json.loads(bytes(payload))
+        return str(credentials['username']), str(credentials['password'])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ProtocolError(f"Malformed AUTH frame: {e}")
+
+
+def encode_auth_result(ok, reason=''):
+    return json.dumps({'ok': ok, 'reason': reason}).encode('utf-8')
+
+
+def decode_auth_result(payload, frame_name='AUTH_RESULT'):
+    try:
+        result = json.loads(bytes(payload))
+        return bool(result['ok']), str(result.get('reason', ''))
+    except (ValueError, KeyError, TypeError) as e:
+        raise ProtocolError(f"Malformed {frame_name} frame: {e}")
+
+
+# RESUME_RESULT has the same layout as AUTH_RESULT.
+def encode_resume_result(ok, reason=''):
+    return encode_auth_result(ok, reason)
+
+
+def decode_resume_result(payload):
+    return decode_auth_result(payload, 'RESUME_RESULT')
+
+
+def encode_header(frame_type, length):
+    return HEADER.pack(length, frame_type)
+
+
+def encode_frame(frame_type, payload=b''):
+    return HEADER.pack(len(payload), frame_type) + payload
+
+
+def send_frame(sock, frame_type, payload=b''):
+    # Scatter-gather the header and payload so the payload (typically a
+    # memoryview into a FrameParser buffer) is never copied into a new frame.
+    header = HEADER.pack(len(payload), frame_type)
+    if isinstance(sock, ssl.SSLSocket) or not hasattr(sock, 'sendmsg'):
+        sock.sendall(header)
+        if payload:
+            sock.sendall(payload)
+        return
+    buffers = [header, memoryview(payload)] if payload else [header]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            else:
+                buffers[0] = memoryview(buffers[0])[sent:]
+                sent = 0
+
+
+class FrameParser:
+    """Incremental frame parser over a single reusable receive buffer.
+
+    Bytes are written straight into the buffer (get_buffer/advance, recv_into
+    or feed) and complete frames are returned by frames() as
+    (frame_type, memoryview) pairs. The views point into the buffer and are
+    only valid until the next write into the parser; callers that need to
+    keep a payload must copy it.
+    """
+
+    def __init__(self, initial_size=65536, max_payload_size=MAX_PAYLOAD_SIZE):
+        self.initial_size = initial_size
+        self.max_payload_size = max_payload_size
+        self.buffer = bytearray(initial_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def pending(self):
+        return self.end - self.start
+
+    def _needed(self):
+        # Bytes required to complete the frame at self.start.
+        available = self.end - self.start
+        if available < HEADER_SIZE:
+            return HEADER_SIZE
+        length, _ = HEADER.unpack_from(self.buffer, self.start)
+        if length > self.max_payload_size:
+            raise ProtocolError(f"Frame of {length} bytes exceeds limit of {self.max_payload_size}")
+        return HEADER_SIZE + length
+
+    def get_buffer(self, size_hint=-1):
+        pending = self.end - self.start
+        if not pending:
+            self.start = self.end = 0
+            if len(self.buffer) > self.initial_size:
+                self._replace_buffer(self.initial_size)
+        # Leave room for the rest of the current frame, or size_hint more bytes.
+        needed = max(self._needed(), pending + max(size_hint, 1))
+        if len(self.buffer) - self.start < needed:
+            if needed > len(self.buffer):
+                self._replace_buffer(max(needed, 2 * len(self.buffer)))
+            else:
+                # Slide the partial frame to the front. Same-size slice
+                # assignment never resizes the (exported) bytearray.
+                self.buffer[0:pending] = self.buffer[self.start:self.end]
+                self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def _replace_buffer(self, size):
+        # Earlier payload views keep the old buffer alive until dropped.
+        pending = self.end - self.start
+        buffer = bytearray(size)
+        buffer[0:pending] = self.view[self.start:self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start, self.end = 0, pending
+
+    def advance(self, nbytes):
+        self.end += nbytes
+
+    def feed(self, data):
+        data = memoryview(data)
+        while data:
+            buffer = self.get_buffer(len(data))
+            n = min(len(buffer), len(data))
+            buffer[:n] = data[:n]
+            self.advance(n)
+            data = data[n:]
+
+    def recv_into(self, sock):
+        nbytes = sock.recv_into(self.get_buffer())
+        self.advance(nbytes)
+        return nbytes
+
+    def frames(self):
+        while self.end - self.start >= HEADER_SIZE:
+            length, frame_type = HEADER.unpack_from(self.buffer, self.start)
+            if length > self.max_payload_size:
+                raise ProtocolError(f"Frame of {length} bytes exceeds limit of {self.max_payload_size}")
+            frame_end = self.start + HEADER_SIZE + length
+            if frame_end > self.end:
+                break
+            payload = self.view[self.start + HEADER_SIZE:frame_end]
+            self.start = frame_end
+            yield frame_type, payload
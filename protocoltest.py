@@ -0,0 +1,104 @@
+import unittest
+import socket
+import threading
+from protocol import (FrameParser, ProtocolError, encode_frame, send_frame, encode_resume_result,
+                      decode_resume_result, HEADER_SIZE, PUBLIC_KEY, PEER_PUBLIC_KEY, DISCONNECT, MESSAGE)
+
+class TestFrameParser(unittest.TestCase):
+    """Test cases for the length-prefixed frame parser."""
+
+    def collect(self, parser):
+        return [(frame_type, bytes(payload)) for frame_type, payload in parser.frames()]
+
+    def test_coalesced_frames(self):
+        """Several frames arriving in one read are all returned in order."""
+        parser = FrameParser()
+        parser.feed(encode_frame(PEER_PUBLIC_KEY, b'key') + encode_frame(MESSAGE, b'ciphertext')
+                    + encode_frame(DISCONNECT))
+        self.assertEqual(self.collect(parser), [
+            (PEER_PUBLIC_KEY, b'key'),
+            (MESSAGE, b'ciphertext'),
+            (DISCONNECT, b''),
+        ])
+        self.assertEqual(parser.pending(), 0)
+
+    def test_split_frame(self):
+        """A frame split across reads is only returned once complete."""
+        parser = FrameParser()
+        data = encode_frame(PUBLIC_KEY, b'-----BEGIN PUBLIC KEY-----' * 40)
+        for i in range(len(data) - 1):
+            parser.feed(data[i:i + 1])
+            self.assertEqual(self.collect(parser), [])
+        parser.feed(data[-1:])
+        self.assertEqual(self.collect(parser), [(PUBLIC_KEY, b'-----BEGIN PUBLIC KEY-----' * 40)])
+
+    def test_frame_larger_than_buffer(self):
+        """The buffer grows for a large frame and shrinks back afterwards."""
+        parser = FrameParser(initial_size=16)
+        payload = bytes(range(256)) * 64
+        parser.feed(encode_frame(MESSAGE, payload))
+        self.assertEqual(self.collect(parser), [(MESSAGE, payload)])
+        parser.get_buffer()
+        self.assertEqual(len(parser.buffer), 16)
+
+    def test_partial_frame_is_compacted(self):
+        """A trailing partial frame survives buffer compaction."""
+        parser = FrameParser(initial_size=32)
+        first = encode_frame(MESSAGE, b'a' * 20)
+        second = encode_frame(MESSAGE, b'b' * 20)
+        parser.feed(first + second[:HEADER_SIZE + 2])
+        self.assertEqual(self.collect(parser), [(MESSAGE, b'a' * 20)])
+        parser.feed(second[HEADER_SIZE + 2:])
+        self.assertEqual(self.collect(parser), [(MESSAGE, b'b' * 20)])
+
+    def test_oversized_frame_rejected(self):
+        """A length prefix above the limit raises ProtocolError."""
+        parser = FrameParser(max_payload_size=10)
+        parser.feed(encode_frame(MESSAGE, b'x' * 11))
+        with self.assertRaises(ProtocolError):
+            self.collect(parser)
+
+
+class TestSendFrame(unittest.TestCase):
+    """Test cases for scatter-gather frame sending."""
+
+    def test_send_frame_survives_partial_sends(self):
+        """A payload larger than the socket buffer arrives intact."""
+        left, right = socket.socketpair()
+        left.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        payload = bytearray(range(256)) * 4096
+        sender = threading.Thread(target=send_frame, args=(left, MESSAGE, memoryview(payload)))
+        sender.start()
+        parser = FrameParser()
+        frames = []
+        while not frames:
+            parser.recv_into(right)
+            frames = [(frame_type, bytes(data)) for frame_type, data in parser.frames()]
+        sender.join()
+        self.assertEqual(frames, [(MESSAGE, bytes(payload))])
+        left.close()
+        right.close()
+
+    def test_send_empty_frame(self):
+        """Control frames without a payload are sent as a bare header."""
+        left, right = socket.socketpair()
+        send_frame(left, DISCONNECT)
+        self.assertEqual(right.recv(HEADER_SIZE + 1), encode_frame(DISCONNECT))
+        left.close()
+        right.close()
+
+
+class TestResults(unittest.TestCase):
+    """Test cases for the AUTH_RESULT / RESUME_RESULT payloads."""
+
+    def test_resume_result_round_trip(self):
+        self.assertEqual(decode_resume_result(encode_resume_result(False, "expired")), (False, "expired"))
+        self.assertEqual(decode_resume_result(memoryview(encode_resume_result(True))), (True, ''))
+
+    def test_malformed_resume_result_names_its_frame(self):
+        with self.assertRaisesRegex(ProtocolError, "RESUME_RESULT"):
+            decode_resume_result(b'{"reason": "no ok"}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,30 +1,76 @@
 import ssl
+import time
 import socket
+import secrets
+import argparse
 import threading
+from protocol import (FrameParser, ProtocolError, encode_frame, decode_auth, encode_auth_result,
+                      encode_resume_result, AUTH_REQUIRED, REQUEST_PUBLIC_KEY, PUBLIC_KEY, PEER_PUBLIC_KEY, DISCONNECT,
+                      MESSAGE, JOIN, HEARTBEAT, AUTH, AUTH_RESULT, RESUME, RESUME_TOKEN, RESUME_RESULT,
+                      PEER_LEFT, STORED_MESSAGE, PUBLIC_KEY_TIMEOUT, IDLE_TIMEOUT, RESUME_TIMEOUT)
+from server_sessions import SessionTable, SessionFull, DEFAULT_SESSION
+from server_outbound import OutboundQueue, OVERFLOW_POLICIES, DISCONNECT_CLIENT, DEFAULT_MAX_QUEUE_BYTES
+from tls import create_server_context, HANDSHAKE_TIMEOUT
+from offline_store import OfflineStore, mailbox_of
+from timer_wheel import TimerWheel
+from server_metrics import Metrics, start_metrics_server
+from server_auth import Authenticator
+
+RESUME_TOKEN_SIZE = 16
 
 class ChatServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, max_queue_bytes=DEFAULT_MAX_QUEUE_BYTES,
+                 overflow_policy=DISCONNECT_CLIENT, certfile=None, keyfile=None, offline_dir=None,
+                 handshake_timeout=PUBLIC_KEY_TIMEOUT, idle_timeout=IDLE_TIMEOUT, metrics_port=None,
+                 users_db=None, resume_timeout=RESUME_TIMEOUT):
         self.host = host
         self.port = port
+        self.max_queue_bytes = max_queue_bytes
+        self.overflow_policy = overflow_policy
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.clients = {}
+        self.outbound = {}
         self.public_keys = {}
+        self.sessions = SessionTable()
+        # Resumable clients that drop are detached, not removed: their place
+        # in the session is kept until they resume or resume_timeout passes.
+        self.resume_timeout = resume_timeout
+        self.resume_tokens = {}  # token -> (client_id, user)
+        self.client_tokens = {}  # client_id -> token
+        self.detached = {}  # client_id -> expiry timer
+        self.pending_keys = {}  # detached client_id -> peer public key that arrived meanwhile
         self.running = True
         self.lock = threading.Lock()
-
-# Uncomment here for SSL/TLS certificate---------------------
-
-        # self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        # self.context.load_cert_chain(certfile='server.crt', keyfile='server.key')
-
-# ------------------------------------------------------------
-
+        self.context = create_server_context(certfile, keyfile) if certfile else None
+        # With a store, a conversation outlives one side leaving: messages the
+        # other side sends meanwhile are kept until the absent client joins.
+        self.offline_store = OfflineStore(offline_dir) if offline_dir else None
+        self.absent = {}  # client_id -> mailbox of the peer that left it
+        self.replaying = {}  # client_id -> live frames held until its stored ones are queued
+        # Handshake and idle timers live on one wheel driven by the accept loop.
+        self.handshake_timeout = handshake_timeout
+        self.idle_timeout = idle_timeout
+        self.timers = TimerWheel()
+        self.last_activity = {}
+        self.metrics = Metrics()
+        self.metrics.gauge_callback('sessions', lambda: len(self.sessions))
+        self.metrics.gauge_callback('detached_clients', lambda: len(self.detached))
+        self.metrics.gauge_callback('outbound_queued_bytes', lambda: sum(self.queue_depths().values()))
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        # With a user store, clients must AUTH before sending their key.
+        self.authenticator = Authenticator(users_db, metrics=self.metrics) if users_db else None
+        if self.authenticator is not None and self.context is None:
+            print("Warning: --users-db without --certfile; clients will not send passwords without TLS.")
 
     def start_server(self):
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
+        self.server_socket.settimeout(self.timers.tick)
         print(f"Server started on {self.host}:{self.port}")
+        if self.metrics_port is not None:
+            self.metrics_server = start_metrics_server(self.metrics, self.metrics_port)
         try:
             self.accept_clients()
         except KeyboardInterrupt:
@@ -37,124 +83,485 @@ class ChatServer:
             try:
                 client_socket, client_address = self.server_socket.accept()
                 print(f"New connection from {client_address}")
-
-# Uncomment here for SSL/TLS certificate---------------------
-
-                # client_socket = self.context.wrap_socket(client_socket, server_side=True)
-
-# ------------------------------------------------------------
-
-                if len(self.clients) >= 2:
-                    print("Too many clients connected. Disconnecting all clients.")
-                    self.disconnect_all_clients()
-                    continue
                 client_thread = threading.Thread(target=self.handle_client, args=(client_socket,))
                 client_thread.daemon = True
                 client_thread.start()
+            except socket.timeout:
+                pass
             except socket.error:
                 if not self.running:
                     break
+            self.timers.advance()
+
+    def expire_connection(self, client_socket, client_id, reason):
+        print(f"Disconnecting client {client_id}: {reason}")
+        try:
+            # Wakes the client's thread out of recv; it then cleans up.
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def check_idle(self, client_socket, client_id):
+        if self.clients.get(client_id) is not client_socket:
+            return
+        idle = time.monotonic() - self.last_activity.get(client_id, 0)
+        if idle >= self.idle_timeout:
+            self.expire_connection(client_socket, client_id, f"idle for {idle:.0f}s")
+        else:
+            self.timers.schedule(self.idle_timeout - idle, self.check_idle, client_socket, client_id)
+
+    def start_tls(self, client_socket):
+        # Runs on the client's own thread, so a slow or stalled handshake
+        # never holds up accept().
+        tls_socket = self.context.wrap_socket(client_socket, server_side=True,
+                                              do_handshake_on_connect=False)
+        tls_socket.settimeout(HANDSHAKE_TIMEOUT)
+        tls_socket.do_handshake()
+        tls_socket.settimeout(None)
+        if tls_socket.session_reused:
+            print(f"Resumed TLS session for {tls_socket.getpeername()}")
+        return tls_socket
 
     def handle_client(self, client_socket):
         client_id = client_socket.getpeername()
+        self.metrics.add_gauge('connections', 1)
+        self.metrics.add_gauge('handshakes_in_flight', 1)
+        if self.context is not None:
+            try:
+                client_socket = self.start_tls(client_socket)
+            except (ssl.SSLError, OSError) as e:
+                print(f"TLS handshake with {client_id} failed: {e}")
+                self.metrics.inc('tls_handshake_failures')
+                self.metrics.add_gauge('handshakes_in_flight', -1)
+                self.metrics.add_gauge('connections', -1)
+                client_socket.close()
+                return
+        parser = FrameParser()
+        session_id = DEFAULT_SESSION
+        user = None
+        resumable = False
+        registered = False
+        goodbye = False
+        handshake_timer = None
+        if self.handshake_timeout:
+            handshake_timer = self.timers.schedule(self.handshake_timeout, self.expire_connection,
+                                                   client_socket, client_id, "no PUBLIC_KEY received")
         try:
-            client_socket.sendall("REQUEST_PUBLIC_KEY".encode('utf-8'))
-            public_key_msg = client_socket.recv(4096).decode('utf-8')
-            public_key = public_key_msg.split(":", 1)[1]
-            with self.lock:
-                self.public_keys[client_id] = public_key
-                self.clients[client_id] = client_socket
-            self.broadcast_peer_public_key(client_socket, client_id)
-
+            client_socket.sendall(encode_frame(REQUEST_PUBLIC_KEY,
+                                               AUTH_REQUIRED if self.authenticator is not None else b''))
             while True:
                 try:
-                    message = client_socket.recv(4096).decode('utf-8')
-                    if message == "DISCONNECT":
-                        print(f"Client {client_id} disconnected")
-                        self.remove_client(client_socket, client_id)
+                    if parser.recv_into(client_socket) == 0:
+                        print(f"Client {client_id} closed the connection.")
                         break
-                    self.route_message(client_id, message)
+                    received_at = time.perf_counter()
+                    self.last_activity[client_id] = time.monotonic()
+                    for frame_type, payload in parser.frames():
+                        if frame_type == MESSAGE and registered:
+                            self.route_message(client_id, payload, received_at)
+                        elif frame_type == STORED_MESSAGE and registered:
+                            self.route_stored(client_id, payload)
+                        elif frame_type == HEARTBEAT:
+                            pass
+                        elif frame_type == AUTH and user is None:
+                            user = self.authenticate(client_socket, client_id, payload)
+                            if user is None:
+                                return
+                        elif frame_type == JOIN and not registered:
+                            session_id = bytes(payload)
+                        elif frame_type == PUBLIC_KEY and not registered:
+                            if self.authenticator is not None and user is None:
+                                raise ProtocolError("PUBLIC_KEY before AUTH")
+                            self.timers.cancel(handshake_timer)
+                            self.join_session(client_socket, client_id, session_id, bytes(payload),
+                                              resumable, user)
+                            registered = True
+                            self.metrics.add_gauge('handshakes_in_flight', -1)
+                            if self.idle_timeout:
+                                self.timers.schedule(self.idle_timeout, self.check_idle, client_socket, client_id)
+                        elif frame_type == RESUME and not registered:
+                            if self.authenticator is not None and user is None:
+                                raise ProtocolError("RESUME before AUTH")
+                            if not payload:
+                                # A new session the client will want to resume if it drops.
+                                resumable = True
+                            else:
+                                resumed_id = self.resume_session(client_socket, bytes(payload), user)
+                                if resumed_id is not None:
+                                    # From here on this connection is the client it replaces.
+                                    self.last_activity.pop(client_id, None)
+                                    client_id = resumed_id
+                                    self.last_activity[client_id] = time.monotonic()
+                                    self.timers.cancel(handshake_timer)
+                                    registered = True
+                                    self.metrics.add_gauge('handshakes_in_flight', -1)
+                                    if self.idle_timeout:
+                                        self.timers.schedule(self.idle_timeout, self.check_idle, client_socket,
+                                                             client_id)
+                        elif frame_type == DISCONNECT:
+                            print(f"Client {client_id} disconnected")
+                            goodbye = True
+                            return
+                        else:
+                            raise ProtocolError(f"Unexpected frame type {frame_type}")
                 except ConnectionResetError:
                     print(f"Client {client_id} reset the connection.")
-                    self.remove_client(client_socket, client_id)
+                    self.metrics.inc('connection_errors')
                     break
                 except socket.error:
                     break
+        except SessionFull as e:
+            print(f"Rejecting client {client_id}: {e}")
+            try:
+                client_socket.sendall(encode_frame(DISCONNECT))
+            except socket.error:
+                pass
         except Exception as e:
             print(f"Error handling client {client_id}: {e}")
-            self.remove_client(client_socket, client_id)
         finally:
-            self.remove_client(client_socket, client_id)
+            self.timers.cancel(handshake_timer)
+            if not registered:
+                self.metrics.add_gauge('handshakes_in_flight', -1)
+            self.metrics.add_gauge('connections', -1)
+            self.client_lost(client_socket, client_id, registered, goodbye)
+
+    def authenticate(self, client_socket, client_id, payload):
+        # Runs on the client's own thread; a slow password check only holds
+        # up this client. Returns the username, or None if refused.
+        username, password = decode_auth(payload)
+        if self.authenticator is None:
+            ok, reason = True, ''
+        else:
+            ok, reason = self.authenticator.submit(username, password, client_id[0]).result()
+        client_socket.sendall(encode_frame(AUTH_RESULT, encode_auth_result(ok, reason)))
+        if not ok:
+            print(f"Refusing client {client_id}: {reason}")
+            return None
+        return username
+
+    def outbound_queue(self, client_socket, client_id):
+        return OutboundQueue(client_socket, client_id, self.max_queue_bytes, self.overflow_policy,
+                             on_failure=lambda: self.client_lost(client_socket, client_id, True, False),
+                             metrics=self.metrics)
 
-    def broadcast_peer_public_key(self, client_socket, client_id):
+    def join_session(self, client_socket, client_id, session_id, public_key, resumable=False, user=None):
+        queue = self.outbound_queue(client_socket, client_id)
+        token = peer_queue = peer_public_key = None
         with self.lock:
-            for other_client_id, other_client_socket in self.clients.items():
-                if other_client_id != client_id:
-                    try:
-                        other_client_socket.sendall(f"PEER_PUBLIC_KEY:{self.public_keys[client_id]}".encode('utf-8'))
-                        client_socket.sendall(f"PEER_PUBLIC_KEY:{self.public_keys[other_client_id]}".encode('utf-8'))
-                        self.public_keys.clear()
-                    except Exception as e:
-                        print(f"Error broadcasting public key: {e}")
-
-    def route_message(self, sender_id, message):
+            try:
+                peer_id = self.sessions.join(session_id, client_id)
+            except SessionFull:
+                queue.close()
+                raise
+            # Keys are kept while their client is here: a survivor is paired
+            # again if its peer comes back.
+            self.public_keys[client_id] = public_key
+            self.clients[client_id] = client_socket
+            self.outbound[client_id] = queue
+            if resumable and self.resume_timeout:
+                token = secrets.token_bytes(RESUME_TOKEN_SIZE)
+                self.resume_tokens[token] = (client_id, user)
+                self.client_tokens[client_id] = token
+            if peer_id is not None:
+                self.absent.pop(peer_id, None)
+                peer_public_key = self.public_keys.get(peer_id)
+                peer_queue = self.outbound.get(peer_id)
+                if peer_queue is None:
+                    # The peer is detached; it gets our key when it resumes.
+                    self.pending_keys[peer_id] = public_key
+            if self.offline_store is not None:
+                self.replaying[client_id] = []
+        # Queues are filled outside the lock: under the BLOCK policy a put
+        # waits for a slow reader, which must only hold up its own sender.
+        # The peer sees our key only after we have its key, and anything it
+        # sends us is held in self.replaying until the stored frames are queued.
+        if token is not None:
+            queue.put(RESUME_TOKEN, token)
+        if peer_id is not None:
+            queue.put(PEER_PUBLIC_KEY, peer_public_key)
+            if peer_queue is not None:
+                peer_queue.put(PEER_PUBLIC_KEY, public_key)
+        if self.offline_store is not None:
+            self.replay_stored(client_id, queue, mailbox_of(session_id, public_key))
+
+    def replay_stored(self, client_id, queue, mailbox):
+        # put() returns False once the client is gone; the store keeps
+        # whatever it did not take.
+        replayed = self.offline_store.replay(mailbox, queue.put)
+        if replayed:
+            print(f"Replayed {replayed} stored messages to client {client_id}")
+        while True:
+            with self.lock:
+                held = self.replaying.get(client_id)
+                # A resumed connection may have taken over meanwhile.
+                queue = self.outbound.get(client_id)
+                if not held or queue is None:
+                    self.replaying.pop(client_id, None)
+                    return
+                self.replaying[client_id] = []
+            for frame_type, payload, received_at in held:
+                if queue.put(frame_type, payload, received_at) and frame_type == MESSAGE:
+                    self.metrics.inc('messages_relayed')
+                    self.metrics.inc('bytes_relayed', len(payload))
+
+    def resume_session(self, client_socket, token, user):
+        """Hand a detached (or half-open) client's place to a new connection;
+        returns the client ID it takes over, or None."""
         with self.lock:
-            for client_id, client_socket in list(self.clients.items()):
-                if client_id != sender_id:
-                    try:
-                        client_socket.sendall(message.encode('utf-8'))
-                    except BrokenPipeError:
-                        print(f"Client {client_id} has disconnected.")
-                        self.remove_client(client_socket, client_id)
-                    except Exception as e:
-                        print(f"Error routing message: {e}")
+            entry = self.resume_tokens.get(token)
+            accepted = entry is not None and entry[1] == user
+            if accepted:
+                client_id = entry[0]
+                self.timers.cancel(self.detached.pop(client_id, None))
+                old_socket = self.clients.get(client_id)
+                old_queue = self.outbound.get(client_id)
+                queue = self.outbound_queue(client_socket, client_id)
+                self.clients[client_id] = client_socket
+                self.outbound[client_id] = queue
+                queue.put(RESUME_RESULT, encode_resume_result(True))
+                public_key = self.pending_keys.pop(client_id, None)
+                if public_key is not None:
+                    queue.put(PEER_PUBLIC_KEY, public_key)
+                if client_id in self.absent:
+                    # Its peer left while it was away.
+                    queue.put(PEER_LEFT)
+        if not accepted:
+            client_socket.sendall(encode_frame(RESUME_RESULT,
+                                               encode_resume_result(False, "Unknown or expired session")))
+            return None
+        if old_queue is not None:
+            old_queue.close()
+        if old_socket is not None:
+            try:
+                # Wakes the old connection's thread, which then finds it was replaced.
+                old_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        print(f"Client {client_id} resumed its session")
+        self.metrics.inc('resumes')
+        return client_id
+
+    def client_lost(self, client_socket, client_id, registered, goodbye):
+        with self.lock:
+            attached = self.clients.get(client_id) is client_socket
+            detach = attached and not goodbye and self.running and client_id in self.client_tokens
+            if detach:
+                del self.clients[client_id]
+                queue = self.outbound.pop(client_id, None)
+                self.last_activity.pop(client_id, None)
+                self.detached[client_id] = self.timers.schedule(self.resume_timeout, self.expire_detached,
+                                                                client_id)
+        if detach or (registered and not attached):
+            # Detached until it resumes, or already removed or taken over
+            # by a resumed connection: only this socket goes.
+            if detach and queue is not None:
+                queue.close()
+            self.close_socket(client_socket, client_id)
+            return
+        self.remove_client(client_socket, client_id)
+
+    def expire_detached(self, client_id):
+        with self.lock:
+            if self.detached.pop(client_id, None) is None:
+                return
+        print(f"Client {client_id} did not resume within {self.resume_timeout:.0f}s")
+        self.remove_client(None, client_id)
+
+    def forget_resume(self, client_id):
+        # Caller holds self.lock.
+        token = self.client_tokens.pop(client_id, None)
+        if token is not None:
+            del self.resume_tokens[token]
+        self.timers.cancel(self.detached.pop(client_id, None))
+        self.pending_keys.pop(client_id, None)
+
+    def route_message(self, sender_id, payload, received_at=None):
+        # payload is a view into the sender's receive buffer. The peer's queue
+        # sends it directly when it can and copies it only if it must wait.
+        waiting_since = time.perf_counter()
+        with self.lock:
+            self.metrics.observe('route_lock_wait', time.perf_counter() - waiting_since)
+            peer_id = self.sessions.peer_of(sender_id)
+            held = self.replaying.get(peer_id)
+            if held is not None:
+                held.append((MESSAGE, bytes(payload), received_at))
+                return
+            queue = self.outbound.get(peer_id)
+            if queue is None:
+                # A detached peer is sent whatever it has not acknowledged
+                # once it resumes; one that left gets STORED_MESSAGE instead.
+                return
+        if queue.put(MESSAGE, payload, received_at):
+            self.metrics.inc('messages_relayed')
+            self.metrics.inc('bytes_relayed', len(payload))
+
+    def route_stored(self, sender_id, payload):
+        # Stored for the peer that left, or relayed if it is back before the
+        # sender has seen it rejoin.
+        with self.lock:
+            peer_id = self.sessions.peer_of(sender_id)
+            held = self.replaying.get(peer_id)
+            if held is not None:
+                held.append((STORED_MESSAGE, bytes(payload), None))
+                return
+            queue = self.outbound.get(peer_id)
+            mailbox = self.absent.get(sender_id)
+            if queue is None and mailbox is not None:
+                # Only a buffered write (the store fsyncs on its own thread);
+                # doing it under the lock keeps it ahead of a replay.
+                self.offline_store.append(mailbox, STORED_MESSAGE, payload)
+                self.metrics.inc('messages_stored')
+        if queue is not None:
+            queue.put(STORED_MESSAGE, payload)
+
+    def queue_depths(self):
+        with self.lock:
+            queues = list(self.outbound.values())
+        return {queue.client_id: queue.depth()[1] for queue in queues}
+
+    def dropped_frames(self):
+        with self.lock:
+            return sum(queue.dropped for queue in self.outbound.values())
 
     def remove_client(self, client_socket, client_id):
+        # client_socket is None when a detached client expires.
+        with self.lock:
+            if client_socket is not None and self.clients.get(client_id) is client_socket:
+                del self.clients[client_id]
+            self.last_activity.pop(client_id, None)
+            queue = self.outbound.pop(client_id, None)
+            public_key = self.public_keys.pop(client_id, None)
+            session_id = self.sessions.session_of(client_id)
+            self.forget_resume(client_id)
+            self.absent.pop(client_id, None)
+            self.replaying.pop(client_id, None)
+            peer_id = self.sessions.leave(client_id)
+            peer_queue = None
+            stays = peer_id is not None and self.offline_store is not None and public_key is not None
+            if stays:
+                # The peer keeps its place and may leave messages for us.
+                self.absent[peer_id] = mailbox_of(session_id, public_key)
+                self.pending_keys.pop(peer_id, None)
+                peer_queue = self.outbound.get(peer_id)
+            elif peer_id is not None:
+                peer_queue = self.outbound.pop(peer_id, None)
+                self.clients.pop(peer_id, None)
+                self.public_keys.pop(peer_id, None)
+                self.forget_resume(peer_id)
+                self.absent.pop(peer_id, None)
+                self.replaying.pop(peer_id, None)
+                self.sessions.leave(peer_id)
+
+        if queue is not None:
+            queue.close()
+        if client_socket is not None:
+            self.close_socket(client_socket, client_id)
+
+        # Without a store a conversation ends when either side leaves; other
+        # sessions are untouched.
+        if peer_queue is not None and stays:
+            peer_queue.put(PEER_LEFT)
+        elif peer_queue is not None:
+            peer_queue.put(DISCONNECT)
+            peer_queue.close(flush=True)
+
+    def close_socket(self, client_socket, client_id):
+        try:
+            # shutdown() wakes this client's reader if it is blocked in recv
+            # on another thread (e.g. when its writer failed).
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         try:
             client_socket.close()
         except Exception as e:
             print(f"Error closing socket for client {client_id}: {e}")
 
-        with self.lock:
-            if client_id in self.clients:
-                del self.clients[client_id]
-            if client_id in self.public_keys:
-                del self.public_keys[client_id]
-
-        self.disconnect_all_clients()
-
     def notify_disconnection(self, client_id):
         with self.lock:
-            for client_socket in list(self.clients.values()):
-                try:
-                    client_socket.sendall("DISCONNECT".encode('utf-8'))
-                except Exception as e:
-                    print(f"Error notifying disconnection: {e}")
+            queues = list(self.outbound.values())
+        for queue in queues:
+            queue.put(DISCONNECT)
 
     def disconnect_all_clients(self):
         with self.lock:
-            for client_socket in list(self.clients.values()):
-                try:
-                    client_socket.sendall("DISCONNECT".encode('utf-8'))
-                    client_socket.close()
-                except Exception as e:
-                    print(f"Error disconnecting client: {e}")
+            queues = list(self.outbound.values())
             self.clients.clear()
+            self.outbound.clear()
             self.public_keys.clear()
-            print("All clients have been disconnected. Waiting for new connections...")
+            self.sessions = SessionTable()
+            self.resume_tokens.clear()
+            self.client_tokens.clear()
+            self.detached.clear()
+            self.pending_keys.clear()
+            self.absent.clear()
+            self.replaying.clear()
+        for queue in queues:
+            queue.put(DISCONNECT)
+            queue.close(flush=True)
+        print("All clients have been disconnected. Waiting for new connections...")
 
     def shutdown_server(self):
         self.running = False
         self.disconnect_all_clients()
+        if self.offline_store is not None:
+            self.offline_store.close()
+        if self.authenticator is not None:
+            self.authenticator.close()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
         try:
             self.server_socket.close()
         except Exception as e:
             print(f"Error closing server socket: {e}")
 
-def main():
-    host = '127.0.0.1'
-    port = 7004
-    server = ChatServer(host, port)
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Secure chat relay server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7004)
+    parser.add_argument('--engine', choices=('threaded', 'asyncio'), default='threaded',
+                        help="threaded: one thread per client; asyncio: single event loop")
+    parser.add_argument('--max-queue-bytes', type=int, default=DEFAULT_MAX_QUEUE_BYTES,
+                        help="outbound bytes buffered per client before the overflow policy applies")
+    parser.add_argument('--overflow-policy', choices=OVERFLOW_POLICIES, default=DISCONNECT_CLIENT,
+                        help="what to do when a client's outbound queue is full")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="run N asyncio worker processes sharing the port (SO_REUSEPORT)")
+    parser.add_argument('--certfile', help="enable TLS with this certificate chain (e.g. server.crt)")
+    parser.add_argument('--keyfile', help="private key for --certfile (e.g. server.key)")
+    parser.add_argument('--handshake-timeout', type=float, default=PUBLIC_KEY_TIMEOUT,
+                        help="seconds a client may take to send its public key (0 disables)")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="disconnect clients silent for this many seconds (0 disables)")
+    parser.add_argument('--offline-dir',
+                        help="keep conversations open when one side leaves, storing messages for it "
+                             "in append-only segment files here")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve counters and latency histograms at http://127.0.0.1:PORT/metrics "
+                             "(each worker uses PORT + its index)")
+    parser.add_argument('--users-db',
+                        help="require clients to log in (AUTH) against the accounts in this SQLite file")
+    parser.add_argument('--resume-timeout', type=float, default=RESUME_TIMEOUT,
+                        help="seconds a dropped client's place in its conversation is held for it to "
+                             "reconnect (0 ends the conversation at once; not used with --workers)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = dict(max_queue_bytes=args.max_queue_bytes, overflow_policy=args.overflow_policy,
+                   certfile=args.certfile, keyfile=args.keyfile, offline_dir=args.offline_dir,
+                   handshake_timeout=args.handshake_timeout, idle_timeout=args.idle_timeout,
+                   metrics_port=args.metrics_port, users_db=args.users_db, resume_timeout=args.resume_timeout)
+    if args.workers > 1:
+        from server_workers import run_workers
+        run_workers(args.host, args.port, args.workers, **options)
+        return
+    if args.engine == 'asyncio':
+        from server_async import AsyncChatServer
+        server = AsyncChatServer(args.host, args.port, **options)
+    else:
+        server = ChatServer(args.host, args.port, **options)
     server.start_server()
 
 if __name__ == '__main__':
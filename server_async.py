@@ -0,0 +1,554 @@
+import time
+import asyncio
+import secrets
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from protocol import (FrameParser, ProtocolError, encode_frame, decode_auth, encode_auth_result,
+                      encode_resume_result, AUTH_REQUIRED, REQUEST_PUBLIC_KEY, PUBLIC_KEY, PEER_PUBLIC_KEY, DISCONNECT,
+                      MESSAGE, JOIN, HEARTBEAT, AUTH, AUTH_RESULT, RESUME, RESUME_TOKEN, RESUME_RESULT,
+                      PEER_LEFT, STORED_MESSAGE, PUBLIC_KEY_TIMEOUT, IDLE_TIMEOUT, RESUME_TIMEOUT)
+from server_sessions import SessionTable, SessionFull, DEFAULT_SESSION
+from server_outbound import DROP, DISCONNECT_CLIENT, BLOCK, DEFAULT_MAX_QUEUE_BYTES
+from tls import create_server_context, HANDSHAKE_TIMEOUT
+from offline_store import OfflineStore, mailbox_of
+from timer_wheel import TimerWheel
+from server_metrics import Metrics, start_metrics_server
+from server_auth import Authenticator
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+RESUME_TOKEN_SIZE = 16
+# How often the loop refreshes gauges that need it to walk its clients.
+GAUGE_INTERVAL = 1.0
+
+
+def raise_file_limit():
+    # Each connection is a file descriptor; lift the soft limit to the hard one
+    # so the process can hold tens of thousands of idle clients.
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            print(f"Could not raise open file limit: {e}")
+
+
+class ChatProtocol(asyncio.BufferedProtocol):
+    # One instance per connection; keep it small so idle connections stay cheap.
+    __slots__ = ('server', 'transport', 'client_id', 'session_id', 'handshake_done', 'parser',
+                 'timer', 'last_activity', 'received_at', 'user', 'authenticating', 'resumable')
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.client_id = None
+        self.session_id = DEFAULT_SESSION
+        self.handshake_done = False
+        self.parser = FrameParser(initial_size=server.read_buffer_size)
+        self.timer = None
+        self.last_activity = time.monotonic()
+        self.received_at = None
+        self.user = None
+        self.authenticating = False
+        self.resumable = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client_id = transport.get_extra_info('peername')
+        print(f"New connection from {self.client_id}")
+        self.server.metrics.add_gauge('connections', 1)
+        self.server.metrics.add_gauge('handshakes_in_flight', 1)
+        if self.server.handshake_timeout:
+            self.timer = self.server.timers.schedule(self.server.handshake_timeout, self.expire,
+                                                     "no PUBLIC_KEY received")
+        transport.write(encode_frame(REQUEST_PUBLIC_KEY,
+                                     AUTH_REQUIRED if self.server.authenticator is not None else b''))
+
+    def handshake_completed(self):
+        self.handshake_done = True
+        self.server.metrics.add_gauge('handshakes_in_flight', -1)
+        self.server.timers.cancel(self.timer)
+        self.timer = None
+        if self.server.idle_timeout:
+            self.timer = self.server.timers.schedule(self.server.idle_timeout, self.check_idle)
+
+    def authorized(self):
+        return self.user is not None or self.server.authenticator is None
+
+    def authenticated(self, username, ok, reason):
+        self.authenticating = False
+        if self.transport.is_closing():
+            return
+        self.transport.write(encode_frame(AUTH_RESULT, encode_auth_result(ok, reason)))
+        if ok:
+            self.user = username
+        else:
+            print(f"Refusing client {self.client_id}: {reason}")
+            self.transport.close()
+
+    def check_idle(self):
+        if self.transport.is_closing():
+            return
+        idle = time.monotonic() - self.last_activity
+        if idle >= self.server.idle_timeout:
+            self.expire(f"idle for {idle:.0f}s")
+        else:
+            self.timer = self.server.timers.schedule(self.server.idle_timeout - idle, self.check_idle)
+
+    def expire(self, reason):
+        print(f"Disconnecting client {self.client_id}: {reason}")
+        self.transport.close()
+
+    def get_buffer(self, sizehint):
+        return self.parser.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.parser.advance(nbytes)
+        self.received_at = time.perf_counter()
+        self.last_activity = time.monotonic()
+        try:
+            for frame_type, payload in self.parser.frames():
+                if self.transport.is_closing():
+                    return
+                self.frame_received(frame_type, payload)
+        except SessionFull as e:
+            print(f"Rejecting client {self.client_id}: {e}")
+            self.transport.write(encode_frame(DISCONNECT))
+            self.transport.close()
+        except Exception as e:
+            print(f"Error handling client {self.client_id}: {e}")
+            self.transport.close()
+
+    def frame_received(self, frame_type, payload):
+        if frame_type == MESSAGE and self.handshake_done:
+            self.server.route_message(self.client_id, payload, self.received_at)
+        elif frame_type == STORED_MESSAGE and self.handshake_done:
+            self.server.route_stored(self.client_id, payload)
+        elif frame_type == HEARTBEAT:
+            pass
+        elif frame_type == AUTH and self.user is None and not self.authenticating:
+            self.authenticating = True
+            self.server.authenticate(self, payload)
+        elif frame_type == JOIN and not self.handshake_done:
+            self.session_id = bytes(payload)
+        elif frame_type == PUBLIC_KEY and not self.handshake_done:
+            if not self.authorized():
+                raise ProtocolError("PUBLIC_KEY before AUTH")
+            self.server.join_session(self.transport, self.client_id, self.session_id, bytes(payload),
+                                     resumable=self.resumable, user=self.user)
+            self.handshake_completed()
+        elif frame_type == RESUME and not self.handshake_done:
+            if not self.authorized():
+                raise ProtocolError("RESUME before AUTH")
+            if not payload:
+                # A new session the client will want to resume if it drops.
+                self.resumable = True
+            elif self.server.resume_session(self, bytes(payload)):
+                self.handshake_completed()
+        elif frame_type == DISCONNECT:
+            print(f"Client {self.client_id} disconnected")
+            self.server.remove_client(self.client_id)
+            self.transport.close()
+        else:
+            raise ProtocolError(f"Unexpected frame type {frame_type}")
+
+    def pause_writing(self):
+        # Our send buffer is over max_queue_bytes. Under the BLOCK policy the
+        # peer filling it stops being read until we drain.
+        if self.server.overflow_policy == BLOCK:
+            peer = self.server.peer_transport(self.client_id)
+            if peer is not None and not peer.is_closing():
+                peer.pause_reading()
+
+    def resume_writing(self):
+        if self.server.overflow_policy == BLOCK:
+            peer = self.server.peer_transport(self.client_id)
+            if peer is not None and not peer.is_closing():
+                peer.resume_reading()
+
+    def connection_lost(self, exc):
+        self.server.timers.cancel(self.timer)
+        if not self.handshake_done:
+            self.server.metrics.add_gauge('handshakes_in_flight', -1)
+        self.server.metrics.add_gauge('connections', -1)
+        if exc is not None:
+            print(f"Client {self.client_id} reset the connection.")
+            self.server.metrics.inc('connection_errors')
+        self.server.client_lost(self.client_id, self.transport)
+
+
+class AsyncChatServer:
+    """Single-threaded asyncio engine with the same handshake as ChatServer.
+
+    Each connection is a ChatProtocol instance driven by the event loop, so
+    no thread (or thread stack) is spent per client. The transport's own
+    write buffer is the per-client outbound queue; overflow_policy applies
+    once it holds more than max_queue_bytes.
+    """
+
+    protocol_class = ChatProtocol
+
+    def __init__(self, host, port, backlog=1024, read_buffer_size=4096,
+                 max_queue_bytes=DEFAULT_MAX_QUEUE_BYTES, overflow_policy=DISCONNECT_CLIENT,
+                 reuse_port=False, certfile=None, keyfile=None, offline_dir=None,
+                 handshake_timeout=PUBLIC_KEY_TIMEOUT, idle_timeout=IDLE_TIMEOUT, metrics_port=None,
+                 users_db=None, resume_timeout=RESUME_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        # The event loop performs TLS handshakes without blocking accepts.
+        self.context = create_server_context(certfile, keyfile) if certfile else None
+        # With a store, a conversation outlives one side leaving (see ChatServer).
+        # Its file I/O runs on one thread of its own, off the loop; being one
+        # thread, it appends and replays in the order they were asked for.
+        self.offline_store = None
+        self.store_executor = None
+        if offline_dir:
+            self.offline_store = OfflineStore(offline_dir)
+            self.store_executor = ThreadPoolExecutor(1, thread_name_prefix='offline-store')
+        self.absent = {}  # client_id -> mailbox of the peer that left it
+        self.replaying = {}  # client_id -> live frames held until its stored ones are sent
+        # Handshake and idle timers for every connection share one wheel,
+        # ticked by a single loop callback.
+        self.handshake_timeout = handshake_timeout
+        self.idle_timeout = idle_timeout
+        self.timers = TimerWheel()
+        self.max_queue_bytes = max_queue_bytes
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        # Per-connection receive buffer; it only grows while a large frame is
+        # in flight and shrinks back once drained.
+        self.read_buffer_size = read_buffer_size
+        self.clients = {}
+        self.public_keys = {}
+        self.sessions = SessionTable()
+        # Resumable clients that drop are detached, not removed: their place
+        # in the session is kept until they resume or resume_timeout passes.
+        self.resume_timeout = resume_timeout
+        self.resume_tokens = {}  # token -> (client_id, user)
+        self.client_tokens = {}  # client_id -> token
+        self.detached = {}  # client_id -> expiry timer
+        self.pending_keys = {}  # detached client_id -> peer public key that arrived meanwhile
+        self.server = None
+        # Everything runs on the loop thread, so there is no route lock to time.
+        self.metrics = Metrics()
+        self.metrics.gauge_callback('sessions', lambda: len(self.sessions))
+        self.metrics.gauge_callback('detached_clients', lambda: len(self.detached))
+        # Transports belong to the loop, so this one is not read from the
+        # metrics thread at scrape time; update_gauges sets it on the loop.
+        self.metrics.set_gauge('outbound_queued_bytes', 0)
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        # Password checks run on the authenticator's own threads and report
+        # back to the loop.
+        self.authenticator = Authenticator(users_db, metrics=self.metrics) if users_db else None
+        if self.authenticator is not None and self.context is None:
+            print("Warning: --users-db without --certfile; clients will not send passwords without TLS.")
+
+    def authenticate(self, protocol, payload):
+        username, password = decode_auth(payload)
+        if self.authenticator is None:
+            protocol.authenticated(username, True, '')
+            return
+        loop = asyncio.get_running_loop()
+        future = self.authenticator.submit(username, password, protocol.client_id[0])
+
+        def done(future):
+            try:
+                ok, reason = future.result()
+            except Exception as e:
+                ok, reason = False, f"Authentication failed: {e}"
+            loop.call_soon_threadsafe(protocol.authenticated, username, ok, reason)
+        future.add_done_callback(done)
+
+    def drive_timers(self):
+        self.timers.advance()
+        asyncio.get_running_loop().call_later(self.timers.tick, self.drive_timers)
+
+    def update_gauges(self):
+        self.metrics.set_gauge('outbound_queued_bytes', sum(self.queue_depths().values()))
+        asyncio.get_running_loop().call_later(GAUGE_INTERVAL, self.update_gauges)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        loop.call_soon(self.drive_timers)
+        loop.call_soon(self.update_gauges)
+        self.server = await loop.create_server(
+            lambda: self.protocol_class(self), self.host, self.port,
+            reuse_address=True, reuse_port=self.reuse_port or None, backlog=self.backlog,
+            ssl=self.context, ssl_handshake_timeout=HANDSHAKE_TIMEOUT if self.context else None)
+        print(f"Server started on {self.host}:{self.port} (asyncio)")
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start_server(self):
+        raise_file_limit()
+        if self.metrics_port is not None:
+            self.metrics_server = start_metrics_server(self.metrics, self.metrics_port)
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("Server is shutting down.")
+        finally:
+            self.disconnect_all_clients()
+            if self.offline_store is not None:
+                self.store_executor.shutdown()
+                self.offline_store.close()
+            if self.authenticator is not None:
+                self.authenticator.close()
+            if self.metrics_server is not None:
+                self.metrics_server.shutdown()
+                self.metrics_server.server_close()
+
+    def join_session(self, transport, client_id, session_id, public_key, resumable=False, user=None):
+        peer_id = self.sessions.join(session_id, client_id)
+        self.clients[client_id] = transport
+        # Kept while the client is here, so a survivor can be paired again.
+        self.public_keys[client_id] = public_key
+        transport.set_write_buffer_limits(high=self.max_queue_bytes)
+        if resumable and self.resume_timeout:
+            token = secrets.token_bytes(RESUME_TOKEN_SIZE)
+            self.resume_tokens[token] = (client_id, user)
+            self.client_tokens[client_id] = token
+            transport.write(encode_frame(RESUME_TOKEN, token))
+        if peer_id is not None:
+            self.absent.pop(peer_id, None)
+            try:
+                transport.write(encode_frame(PEER_PUBLIC_KEY, self.public_keys[peer_id]))
+                peer_transport = self.clients.get(peer_id)
+                if peer_transport is None:
+                    # The peer is detached; it gets our key when it resumes.
+                    self.pending_keys[peer_id] = public_key
+                else:
+                    peer_transport.write(encode_frame(PEER_PUBLIC_KEY, public_key))
+            except Exception as e:
+                print(f"Error broadcasting public key: {e}")
+        if self.offline_store is not None:
+            # Live frames for us wait in self.replaying until the stored ones
+            # have been read and sent.
+            self.replaying[client_id] = []
+            self.read_stored(client_id, mailbox_of(session_id, public_key), None, 0)
+
+    def read_stored(self, client_id, mailbox, paths, count):
+        """Read the next stored segment on the store thread; send_stored
+        writes it on the loop."""
+        future = asyncio.get_running_loop().run_in_executor(self.store_executor, self.next_stored, mailbox, paths)
+        future.add_done_callback(functools.partial(self.send_stored, client_id, mailbox, count))
+
+    def next_stored(self, mailbox, paths):
+        # On the store thread. paths is None at the start, else it begins
+        # with the segment just sent, which can now go.
+        if paths is None:
+            paths = self.offline_store.pending_segments(mailbox)
+        else:
+            self.offline_store.finish_segment(mailbox, paths[0])
+            paths = paths[1:]
+        if not paths:
+            return paths, None
+        return paths, self.offline_store.read_segment(paths[0])
+
+    def send_stored(self, client_id, mailbox, count, future):
+        # Stored frames go out a segment at a time, and a segment is only
+        # deleted once written to the client, so a client that drops during
+        # the replay finds the rest still stored when it comes back.
+        transport = self.clients.get(client_id)
+        try:
+            paths, frames = future.result()
+        except Exception as e:
+            print(f"Could not read stored messages for client {client_id}: {e}")
+            paths, frames = [], None
+        if client_id not in self.replaying or transport is None:
+            if paths:
+                print(f"Client {client_id} went away; its stored messages are kept")
+            return
+        if frames is not None:
+            transport.write(b''.join(encode_frame(frame_type, payload) for frame_type, payload in frames))
+            self.read_stored(client_id, mailbox, paths, count + len(frames))
+            return
+        held = self.replaying.pop(client_id)
+        if count:
+            print(f"Replayed {count} stored messages to client {client_id}")
+        if held:
+            transport.write(b''.join(frame for frame, _ in held))
+        now = time.perf_counter()
+        for _, received_at in held:
+            if received_at is not None:
+                self.metrics.observe('relay_latency', now - received_at)
+
+    def resume_session(self, protocol, token):
+        """Hand a detached (or half-open) client's place to a new connection."""
+        entry = self.resume_tokens.get(token)
+        if entry is None or entry[1] != protocol.user:
+            protocol.transport.write(encode_frame(RESUME_RESULT,
+                                                  encode_resume_result(False, "Unknown or expired session")))
+            return False
+        client_id = entry[0]
+        self.timers.cancel(self.detached.pop(client_id, None))
+        old_transport = self.clients.get(client_id)
+        protocol.client_id = client_id
+        protocol.session_id = self.sessions.session_of(client_id)
+        self.clients[client_id] = protocol.transport
+        protocol.transport.set_write_buffer_limits(high=self.max_queue_bytes)
+        protocol.transport.write(encode_frame(RESUME_RESULT, encode_resume_result(True)))
+        public_key = self.pending_keys.pop(client_id, None)
+        if public_key is not None:
+            protocol.transport.write(encode_frame(PEER_PUBLIC_KEY, public_key))
+        if client_id in self.absent:
+            # Its peer left while it was away.
+            protocol.transport.write(encode_frame(PEER_LEFT))
+        if old_transport is not None:
+            old_transport.close()
+        print(f"Client {client_id} resumed its session")
+        self.metrics.inc('resumes')
+        return True
+
+    def client_lost(self, client_id, transport):
+        if self.clients.get(client_id) is not transport:
+            return  # Never joined, already removed, or taken over by a resumed connection.
+        if client_id not in self.client_tokens:
+            self.remove_client(client_id)
+            return
+        del self.clients[client_id]
+        self.detached[client_id] = self.timers.schedule(self.resume_timeout, self.expire_detached, client_id)
+
+    def expire_detached(self, client_id):
+        if self.detached.pop(client_id, None) is not None:
+            print(f"Client {client_id} did not resume within {self.resume_timeout:.0f}s")
+            self.remove_client(client_id)
+
+    def forget_resume(self, client_id):
+        token = self.client_tokens.pop(client_id, None)
+        if token is not None:
+            del self.resume_tokens[token]
+        self.timers.cancel(self.detached.pop(client_id, None))
+        self.pending_keys.pop(client_id, None)
+
+    def peer_transport(self, client_id):
+        return self.clients.get(self.sessions.peer_of(client_id))
+
+    def route_message(self, sender_id, payload, received_at=None):
+        peer_id = self.sessions.peer_of(sender_id)
+        held = self.replaying.get(peer_id)
+        if held is not None:
+            self.metrics.inc('messages_relayed')
+            self.metrics.inc('bytes_relayed', len(payload))
+            held.append((encode_frame(MESSAGE, payload), received_at))
+            return
+        transport = self.clients.get(peer_id)
+        if transport is None:
+            # A detached peer is sent whatever it has not acknowledged once
+            # it resumes; one that left gets STORED_MESSAGE instead.
+            return
+        queued = transport.get_write_buffer_size()
+        if queued and queued + len(payload) > self.max_queue_bytes:
+            if self.overflow_policy == DROP:
+                self.dropped += 1
+                self.metrics.inc('dropped_frames')
+                return
+            if self.overflow_policy == DISCONNECT_CLIENT:
+                print(f"Outbound queue for client {peer_id} overflowed; disconnecting.")
+                self.metrics.inc('overflow_disconnects')
+                self.remove_client(peer_id)
+                return
+            # BLOCK: the sender has already been paused by pause_writing.
+        # Transports may keep a reference to whatever they cannot send right
+        # away, so hand over one owned frame rather than a view into the
+        # sender's receive buffer.
+        self.metrics.inc('messages_relayed')
+        self.metrics.inc('bytes_relayed', len(payload))
+        transport.write(encode_frame(MESSAGE, payload))
+        # write() goes straight to the socket when nothing is buffered, so this
+        # is receipt-to-send except for frames left queued behind a slow reader.
+        if received_at is not None:
+            self.metrics.observe('relay_latency', time.perf_counter() - received_at)
+
+    def route_stored(self, sender_id, payload):
+        # Stored for the peer that left, or relayed if it is back before the
+        # sender has seen it rejoin.
+        peer_id = self.sessions.peer_of(sender_id)
+        held = self.replaying.get(peer_id)
+        if held is not None:
+            held.append((encode_frame(STORED_MESSAGE, payload), None))
+            return
+        transport = self.clients.get(peer_id)
+        if transport is not None:
+            transport.write(encode_frame(STORED_MESSAGE, payload))
+            return
+        mailbox = self.absent.get(sender_id)
+        if mailbox is not None:
+            # payload is a view into the sender's receive buffer.
+            future = self.store_executor.submit(self.offline_store.append, mailbox, STORED_MESSAGE,
+                                                bytes(payload))
+            future.add_done_callback(self.stored)
+            self.metrics.inc('messages_stored')
+
+    def stored(self, future):
+        # On the store thread.
+        if future.exception() is not None:
+            print(f"Could not store message: {future.exception()}")
+
+    def queue_depths(self):
+        return {client_id: transport.get_write_buffer_size()
+                for client_id, transport in self.clients.items()}
+
+    def dropped_frames(self):
+        return self.dropped
+
+    def remove_client(self, client_id):
+        transport = self.clients.pop(client_id, None)
+        public_key = self.public_keys.pop(client_id, None)
+        session_id = self.sessions.session_of(client_id)
+        self.forget_resume(client_id)
+        self.absent.pop(client_id, None)
+        self.replaying.pop(client_id, None)
+        peer_id = self.sessions.leave(client_id)
+        if transport is not None:
+            transport.close()
+        if peer_id is None:
+            return
+        if self.offline_store is not None and public_key is not None:
+            # The peer keeps its place and may leave messages for us.
+            self.absent[peer_id] = mailbox_of(session_id, public_key)
+            self.pending_keys.pop(peer_id, None)
+            peer_transport = self.clients.get(peer_id)
+            if peer_transport is not None:
+                peer_transport.write(encode_frame(PEER_LEFT))
+            return
+        # Without a store a conversation ends when either side leaves; other
+        # sessions are untouched.
+        self.sessions.leave(peer_id)
+        self.public_keys.pop(peer_id, None)
+        self.forget_resume(peer_id)
+        self.absent.pop(peer_id, None)
+        self.replaying.pop(peer_id, None)
+        peer_transport = self.clients.pop(peer_id, None)
+        if peer_transport is not None:
+            peer_transport.write(encode_frame(DISCONNECT))
+            peer_transport.close()
+
+    def disconnect_all_clients(self):
+        if not self.clients:
+            return
+        clients = list(self.clients.values())
+        self.clients.clear()
+        self.public_keys.clear()
+        self.sessions = SessionTable()
+        self.resume_tokens.clear()
+        self.client_tokens.clear()
+        self.detached.clear()
+        self.pending_keys.clear()
+        self.absent.clear()
+        self.replaying.clear()
+        for transport in clients:
+            try:
+                transport.write(encode_frame(DISCONNECT))
+                transport.close()
+            except Exception as e:
+                print(f"Error disconnecting client: {e}")
+        print("All clients have been disconnected. Waiting for new connections...")
@@ -0,0 +1,264 @@
+import sys
+import hmac
+import time
+import getpass
+import hashlib
+import secrets
+import argparse
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, Future
+import db
+
+# Server-side checks for AUTH frames against a central users.db.
+#
+# Password hashes are slow on purpose, which makes them a target: a client
+# that reconnects in a loop, or a credential-stuffing run, can keep every core
+# busy hashing. So each check goes through, in order:
+#
+#   1. throttling: a username or address with too many recent failures is
+#      refused outright until its lockout ends;
+#   2. a cache of recent successful logins (LRU with TTL), so a reconnecting
+#      client is let straight back in. Each entry records the password hash
+#      it was checked against and only counts while the account still has
+#      that hash, so a changed password takes effect at once;
+#   3. a negative cache of recently failed (username, password) pairs, so a
+#      replayed guess is refused without hashing it again;
+#   4. the real check, on a small pool of hashing threads. Identical checks
+#      already in flight share one result.
+#
+# The caches key passwords by an HMAC under a per-process secret, so they hold
+# nothing that could be brute-forced offline.
+
+DEFAULT_CACHE_SIZE = 4096
+DEFAULT_CACHE_TTL = 300.0
+DEFAULT_NEGATIVE_TTL = 60.0
+DEFAULT_MAX_FAILURES = 5
+DEFAULT_FAILURE_WINDOW = 300.0
+DEFAULT_LOCKOUT = 30.0
+MAX_LOCKOUT = 3600.0
+DEFAULT_AUTH_WORKERS = 2
+
+INVALID_CREDENTIALS = "Invalid username or password."
+THROTTLED = "Too many failed attempts. Try again later."
+
+
+def copy_result(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class TTLCache:
+    """Mapping that keeps at most size entries, evicting the least recently
+    used, and forgets each entry ttl seconds after it was stored. Not
+    thread-safe; the caller locks."""
+
+    def __init__(self, size, ttl, clock=time.monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()  # key -> (expires, value)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        if entry[0] <= self.clock():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+
+class FailureTracker:
+    """Recent failures per key (a username or an address).
+
+    A key that fails max_failures times within window is locked out for
+    lockout seconds, doubling with every further failure up to MAX_LOCKOUT.
+    Not thread-safe; the caller locks.
+    """
+
+    def __init__(self, max_failures=DEFAULT_MAX_FAILURES, window=DEFAULT_FAILURE_WINDOW,
+                 lockout=DEFAULT_LOCKOUT, size=DEFAULT_CACHE_SIZE, clock=time.monotonic):
+        self.max_failures = max_failures
+        self.window = window
+        self.lockout = lockout
+        self.clock = clock
+        # [failures, first failure, locked until]; forgotten once idle.
+        self.entries = TTLCache(size, window + MAX_LOCKOUT, clock)
+
+    def locked(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry[2] > self.clock()
+
+    def failed(self, key):
+        now = self.clock()
+        entry = self.entries.get(key)
+        if entry is None or (now - entry[1] > self.window and entry[2] <= now):
+            entry = [0, now, 0.0]
+        entry[0] += 1
+        if entry[0] >= self.max_failures:
+            excess = entry[0] - self.max_failures
+            entry[2] = now + min(self.lockout * 2 ** min(excess, 16), MAX_LOCKOUT)
+        self.entries.put(key, entry)
+
+    def succeeded(self, key):
+        self.entries.pop(key)
+
+
+class Authenticator:
+    """Checks credentials for the server; submit() never blocks on hashing.
+
+    submit(username, password, address) returns a Future of (ok, reason).
+    Checks answered by the throttle or the negative cache come back already
+    done; a cached login is confirmed with one database read on a lookup
+    thread; the rest run on the hashing pool.
+    """
+
+    def __init__(self, database_path, workers=DEFAULT_AUTH_WORKERS, cache_size=DEFAULT_CACHE_SIZE,
+                 cache_ttl=DEFAULT_CACHE_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 max_failures=DEFAULT_MAX_FAILURES, failure_window=DEFAULT_FAILURE_WINDOW,
+                 lockout=DEFAULT_LOCKOUT, metrics=None, clock=time.monotonic):
+        self.database = db.Database(database_path)
+        db.create_table(self.database)
+        self.metrics = metrics
+        self.secret = secrets.token_bytes(32)
+        self.verified = TTLCache(cache_size, cache_ttl, clock)
+        self.rejected = TTLCache(cache_size, negative_ttl, clock)
+        self.failures = FailureTracker(max_failures, failure_window, lockout, cache_size, clock)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="auth")
+        self.lookups = ThreadPoolExecutor(max_workers=1, thread_name_prefix="auth-lookup")
+
+    def count(self, name):
+        if self.metrics is not None:
+            self.metrics.inc(name)
+
+    def tag(self, password):
+        return hmac.new(self.secret, password.encode('utf-8'), hashlib.sha256).digest()
+
+    def submit(self, username, password, address):
+        tag = self.tag(password)
+        with self.lock:
+            result = self.check_cached(username, tag, address)
+            if isinstance(result, str):
+                # A cached login, to be confirmed against the account's
+                # current hash: one row read, no hashing.
+                future = Future()
+                self.lookups.submit(self.confirm, username, password, tag, address, result, future)
+                return future
+            if result is None:
+                future = self.in_flight.get((username, tag))
+                if future is None:
+                    future = self.executor.submit(self.verify, username, password, tag, address)
+                    self.in_flight[(username, tag)] = future
+                    self.count('auth_verifications')
+                return future
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def check_cached(self, username, tag, address):
+        # Caller holds self.lock. Returns (ok, reason), the stored hash of a
+        # cached login that matches, or None.
+        if self.failures.locked(username) or self.failures.locked(address):
+            self.count('auth_throttled')
+            return False, THROTTLED
+        cached = self.verified.get(username)
+        if cached is not None and hmac.compare_digest(cached[0], tag):
+            return cached[1]
+        if self.rejected.get((username, tag)):
+            self.count('auth_failures')
+            self.failures.failed(username)
+            self.failures.failed(address)
+            return False, INVALID_CREDENTIALS
+        return None
+
+    def confirm(self, username, password, tag, address, stored, result):
+        # On the lookup thread, so neither the event loop nor the hashing
+        # pool waits on the database for a cache hit.
+        try:
+            current = db.stored_password(username, self.database)
+        except Exception as e:
+            result.set_exception(e)
+            return
+        if current == stored:
+            self.count('auth_cache_hits')
+            result.set_result((True, ''))
+            return
+        # The password has changed since this login was cached.
+        with self.lock:
+            cached = self.verified.get(username)
+            if cached is not None and cached[1] == stored:
+                self.verified.pop(username)
+        self.submit(username, password, address).add_done_callback(lambda future: copy_result(future, result))
+
+    def verify(self, username, password, tag, address):
+        try:
+            stored = db.check_login(username, password, self.database)
+        except Exception:
+            with self.lock:
+                self.in_flight.pop((username, tag), None)
+            raise
+        # Caching the result and dropping the in-flight entry happen
+        # together, so no second check of the same pair can slip in between.
+        with self.lock:
+            self.in_flight.pop((username, tag), None)
+            if stored is not None:
+                self.verified.put(username, (tag, stored))
+                self.failures.succeeded(username)
+                return True, ''
+            self.count('auth_failures')
+            self.rejected.put((username, tag), True)
+            self.failures.failed(username)
+            self.failures.failed(address)
+        return False, INVALID_CREDENTIALS
+
+    def add_user(self, username, password):
+        with self.lock:
+            self.verified.pop(username)
+        return db.register_user(username, password, self.database)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.lookups.shutdown(wait=False, cancel_futures=True)
+        self.database.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the server's user store")
+    parser.add_argument('--users-db', default=db.DEFAULT_DB_PATH, help="SQLite file holding the accounts")
+    parser.add_argument('command', choices=('add',))
+    parser.add_argument('username')
+    args = parser.parse_args(argv)
+    password = getpass.getpass(f"Password for {args.username}: ")
+    if password != getpass.getpass("Repeat password: "):
+        print("Passwords do not match.")
+        return 1
+    database = db.Database(args.users_db)
+    db.create_table(database)
+    if not db.register_user(args.username, password, database):
+        print(f"User {args.username} already exists.")
+        return 1
+    print(f"Added {args.username}.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class LatencyHistogram:
+    """HDR-style log-linear histogram of durations.
+
+    Values are recorded in microseconds into buckets of 2**SUB_BITS linear
+    sub-buckets per power of two, so every recorded value is kept to within
+    about 3% and recording is O(1) regardless of range.
+    """
+
+    SUB_BITS = 5
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def bucket(self, micros):
+        if micros < (1 << self.SUB_BITS):
+            return micros
+        shift = micros.bit_length() - self.SUB_BITS - 1
+        return ((shift + 1) << self.SUB_BITS) + ((micros >> shift) - (1 << self.SUB_BITS))
+
+    def bucket_value(self, index):
+        # Upper bound, in microseconds, of the values that map to this bucket.
+        if index < (1 << self.SUB_BITS):
+            return index
+        shift = (index >> self.SUB_BITS) - 1
+        sub = (index & ((1 << self.SUB_BITS) - 1)) + (1 << self.SUB_BITS)
+        return ((sub + 1) << shift) - 1
+
+    def record(self, seconds):
+        index = self.bucket(max(0, int(seconds * 1_000_000)))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, quantile):
+        if not self.count:
+            return 0.0
+        rank = quantile * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return self.bucket_value(index) / 1_000_000
+        return self.max
+
+
+class Metrics:
+    """Thread-safe counters, gauges and latency histograms for the relay."""
+
+    def __init__(self, prefix='chat'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_callbacks = {}
+        self.histograms = {}
+        self.last_render = None
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def gauge_callback(self, name, callback):
+        # For gauges that are cheaper to compute at scrape time.
+        self.gauge_callbacks[name] = callback
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def counter(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def histogram(self, name):
+        with self.lock:
+            return self.histograms.get(name)
+
+    def render(self):
+        """Prometheus text exposition, plus per-second rates of every counter
+        since the previous render."""
+        callbacks = {name: callback() for name, callback in self.gauge_callbacks.items()}
+        now = time.monotonic()
+        lines = []
+        with self.lock:
+            previous = self.last_render
+            for name, value in sorted(self.counters.items()):
+                metric = f"{self.prefix}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {value}")
+                if previous is not None and now > previous[0]:
+                    rate = (value - previous[1].get(name, 0)) / (now - previous[0])
+                    lines.append(f"{self.prefix}_{name}_per_second {rate:.3f}")
+            for name, value in sorted({**self.gauges, **callbacks}.items()):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {value}")
+            for name, histogram in sorted(self.histograms.items()):
+                metric = f"{self.prefix}_{name}_seconds"
+                lines.append(f"# TYPE {metric} summary")
+                for quantile in QUANTILES:
+                    lines.append(f'{metric}{{quantile="{quantile}"}} {histogram.percentile(quantile):.6f}')
+                lines.append(f"{metric}_max {histogram.max:.6f}")
+                lines.append(f"{metric}_sum {histogram.total:.6f}")
+                lines.append(f"{metric}_count {histogram.count}")
+            self.last_render = (now, dict(self.counters))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(metrics, port, host='127.0.0.1'):
+    """Serve metrics.render() at http://host:port/metrics from a daemon thread."""
+    httpd = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    httpd.daemon_threads = True
+    httpd.metrics = metrics
+    threading.Thread(target=httpd.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"Metrics available at http://{host}:{httpd.server_address[1]}/metrics")
+    return httpd
@@ -0,0 +1,156 @@
+import time
+import socket
+import threading
+import collections
+from protocol import encode_header
+
+DROP = 'drop'
+DISCONNECT_CLIENT = 'disconnect'
+BLOCK = 'block'
+OVERFLOW_POLICIES = (DROP, DISCONNECT_CLIENT, BLOCK)
+
+DEFAULT_MAX_QUEUE_BYTES = 4 * 1024 * 1024
+
+# Non-blocking sends let put() write straight to the socket when nothing is
+# queued, without ever stalling the sender on a slow reader.
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+class OutboundQueue:
+    """Bounded per-connection send queue drained by a dedicated writer thread.
+
+    put() never waits on the socket. When the queue is empty it tries one
+    non-blocking sendmsg of header + payload, which is the zero-copy common
+    case; whatever could not be sent is copied into the queue and written by
+    the writer thread. When queued bytes would exceed max_bytes, policy picks
+    what happens: DROP discards the frame, DISCONNECT_CLIENT calls
+    on_failure(), and BLOCK makes the caller wait for room.
+
+    If metrics is given, frames put with a received_at timestamp record the
+    time from receipt to the send completing as relay_latency.
+    """
+
+    def __init__(self, sock, client_id, max_bytes=DEFAULT_MAX_QUEUE_BYTES,
+                 policy=DISCONNECT_CLIENT, on_failure=None, metrics=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}")
+        self.sock = sock
+        self.client_id = client_id
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.on_failure = on_failure
+        self.metrics = metrics
+        self.frames = collections.deque()
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.sending = False
+        self.closed = False
+        self.flush_on_close = False
+        self.send_nowait = bool(MSG_DONTWAIT) and hasattr(sock, 'sendmsg') and not hasattr(sock, 'getpeercert')
+        self.condition = threading.Condition()
+        self.writer = threading.Thread(target=self.drain, name=f"writer-{client_id}", daemon=True)
+        self.writer.start()
+
+    def depth(self):
+        with self.condition:
+            return len(self.frames), self.queued_bytes
+
+    def put(self, frame_type, payload=b'', received_at=None):
+        header = encode_header(frame_type, len(payload))
+        size = len(header) + len(payload)
+        overflow = False
+        with self.condition:
+            if self.closed:
+                return False
+            data = None
+            if self.send_nowait and not self.frames and not self.sending:
+                sent = self._send_nowait(header, payload)
+                if sent == size:
+                    self._record_sent(received_at)
+                    return True
+                data = (header + payload)[sent:]
+            while self.frames and self.queued_bytes + size > self.max_bytes:
+                if self.policy == DROP:
+                    self.dropped += 1
+                    if self.metrics is not None:
+                        self.metrics.inc('dropped_frames')
+                    return False
+                if self.policy == DISCONNECT_CLIENT:
+                    overflow = True
+                    break
+                self.condition.wait()
+                if self.closed:
+                    return False
+            if not overflow:
+                if data is None:
+                    data = header + payload
+                self.frames.append((data, received_at))
+                self.queued_bytes += len(data)
+                self.condition.notify_all()
+                return True
+        print(f"Outbound queue for client {self.client_id} overflowed; disconnecting.")
+        if self.metrics is not None:
+            self.metrics.inc('overflow_disconnects')
+        self.fail()
+        return False
+
+    def _send_nowait(self, header, payload):
+        buffers = [header, payload] if payload else [header]
+        try:
+            return self.sock.sendmsg(buffers, [], MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        except OSError:
+            # Leave the error for the writer thread to report.
+            return 0
+
+    def _record_sent(self, received_at):
+        if received_at is not None and self.metrics is not None:
+            self.metrics.observe('relay_latency', time.perf_counter() - received_at)
+
+    def drain(self):
+        while True:
+            with self.condition:
+                while not self.frames and not self.closed:
+                    self.condition.wait()
+                if not self.frames:
+                    break
+                data, received_at = self.frames.popleft()
+                self.sending = True
+            try:
+                self.sock.sendall(data)
+            except OSError as e:
+                print(f"Error sending to client {self.client_id}: {e}")
+                if self.metrics is not None:
+                    self.metrics.inc('send_errors')
+                self.fail()
+                return
+            self._record_sent(received_at)
+            with self.condition:
+                self.queued_bytes -= len(data)
+                self.sending = False
+                self.condition.notify_all()
+        if self.flush_on_close:
+            # Queue drained after close(flush=True): now hang up the socket,
+            # which also wakes the reader thread blocked in recv.
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+    def close(self, flush=False):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.flush_on_close = flush
+            if not flush:
+                self.frames.clear()
+                self.queued_bytes = 0
+            self.condition.notify_all()
+
+    def fail(self):
+        self.close()
+        if self.on_failure is not None:
+            self.on_failure()
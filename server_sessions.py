@@ -0,0 +1,54 @@
+DEFAULT_SESSION = b''
+
+
+class SessionFull(Exception):
+    pass
+
+
+class SessionTable:
+    """Pairs clients into two-party conversations keyed by session ID.
+
+    Lookups are dict hits, so routing cost does not depend on how many
+    conversations the server carries. The table is not thread-safe; the
+    threaded server calls it under its own lock.
+    """
+
+    def __init__(self):
+        self.sessions = {}  # session_id -> [client_id, ...] (at most two)
+        self.client_sessions = {}  # client_id -> session_id
+        self.peers = {}  # client_id -> peer client_id
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def join(self, session_id, client_id):
+        members = self.sessions.setdefault(session_id, [])
+        if len(members) >= 2:
+            raise SessionFull(f"Session {session_id!r} already has two clients")
+        members.append(client_id)
+        self.client_sessions[client_id] = session_id
+        if len(members) == 2:
+            peer_id = members[0]
+            self.peers[client_id] = peer_id
+            self.peers[peer_id] = client_id
+            return peer_id
+        return None
+
+    def leave(self, client_id):
+        session_id = self.client_sessions.pop(client_id, None)
+        if session_id is None:
+            return None
+        members = self.sessions[session_id]
+        members.remove(client_id)
+        if not members:
+            del self.sessions[session_id]
+        peer_id = self.peers.pop(client_id, None)
+        if peer_id is not None:
+            del self.peers[peer_id]
+        return peer_id
+
+    def peer_of(self, client_id):
+        return self.peers.get(client_id)
+
+    def session_of(self, client_id):
+        return self.client_sessions.get(client_id)
@@ -0,0 +1,241 @@
+import os
+import zlib
+import shutil
+import socket
+import struct
+import asyncio
+import itertools
+import tempfile
+import multiprocessing
+from protocol import (FrameParser, encode_frame, PUBLIC_KEY, DISCONNECT, MESSAGE, JOIN, HEARTBEAT,
+                      STORED_MESSAGE)
+from server_sessions import SessionFull
+from server_async import AsyncChatServer, ChatProtocol
+
+# Pre-fork mode: N worker processes each run an AsyncChatServer on the same
+# port (SO_REUSEPORT lets the kernel spread accepts across them). Every
+# conversation has a home worker, picked by hashing its session ID, which
+# owns the SessionTable entry. A client that lands on another worker is
+# proxied to the home worker over a Unix socket link, so two peers on
+# different workers are still paired and routed to each other.
+#
+# Links carry ordinary frames whose payload starts with ROUTE (source worker,
+# connection ID on that worker). Client frames (JOIN, PUBLIC_KEY, MESSAGE,
+# STORED_MESSAGE) travel edge -> home; IPC_DELIVER carries encoded client
+# frames home -> edge.
+# AUTH is checked by the edge worker before the client is proxied.
+
+ROUTE = struct.Struct('!HQ')
+IPC_DELIVER = 0x80
+IPC_CLOSE_CLIENT = 0x81
+IPC_CLIENT_GONE = 0x82
+
+
+class RemoteTransport:
+    """Stands in, on the home worker, for a client connected to another worker."""
+
+    __slots__ = ('server', 'worker', 'conn_id', 'closing')
+
+    def __init__(self, server, worker, conn_id):
+        self.server = server
+        self.worker = worker
+        self.conn_id = conn_id
+        self.closing = False
+
+    def write(self, data):
+        if not self.closing:
+            self.server.send_ipc(self.worker, IPC_DELIVER, self.conn_id, data)
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            self.server.send_ipc(self.worker, IPC_CLOSE_CLIENT, self.conn_id)
+
+    def is_closing(self):
+        return self.closing
+
+    def get_write_buffer_size(self):
+        # The link buffer is shared by every proxied client, so it says
+        # nothing about this one; its real backlog sits on the edge worker.
+        return 0
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    # Backpressure stays local to each worker; link buffers are shared by
+    # every proxied client, so one slow peer must not pause the whole link.
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+
+class WorkerChatProtocol(ChatProtocol):
+    __slots__ = ('conn_id', 'home')
+
+    def __init__(self, server):
+        super().__init__(server)
+        self.conn_id = None
+        self.home = None
+
+    def frame_received(self, frame_type, payload):
+        if self.conn_id is not None:
+            if frame_type == DISCONNECT:
+                self.transport.close()
+            elif frame_type != HEARTBEAT:
+                self.server.send_ipc(self.home, frame_type, self.conn_id, payload)
+            return
+        if frame_type == PUBLIC_KEY and not self.handshake_done and self.authorized():
+            home = self.server.home_worker(self.session_id)
+            if home != self.server.worker_index:
+                self.server.open_proxy(self, home, payload)
+                self.handshake_completed()
+                return
+        super().frame_received(frame_type, payload)
+
+    def connection_lost(self, exc):
+        if self.conn_id is not None:
+            self.server.close_proxy(self)
+        # A proxied client is not in self.server.clients, so this only drops
+        # its timer and gauges.
+        super().connection_lost(exc)
+
+
+class IPCLinkProtocol(asyncio.BufferedProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.parser = FrameParser()
+
+    def get_buffer(self, sizehint):
+        return self.parser.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.parser.advance(nbytes)
+        for frame_type, payload in self.parser.frames():
+            worker, conn_id = ROUTE.unpack_from(payload)
+            self.server.ipc_frame_received(frame_type, worker, conn_id, payload[ROUTE.size:])
+
+
+class WorkerChatServer(AsyncChatServer):
+    protocol_class = WorkerChatProtocol
+
+    def __init__(self, host, port, worker_index, worker_count, ipc_dir, **kwargs):
+        kwargs.setdefault('reuse_port', True)
+        # A resumed client may land on any worker, while its place is held by
+        # the session's home worker; until that is routed, drops end the
+        # conversation as before.
+        kwargs['resume_timeout'] = 0
+        super().__init__(host, port, **kwargs)
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+        self.ipc_dir = ipc_dir
+        self.links = {}
+        self.proxies = {}
+        self.conn_ids = itertools.count(1)
+        self.remote_sessions = {}
+
+    def ipc_path(self, worker_index):
+        return os.path.join(self.ipc_dir, f"worker-{worker_index}.sock")
+
+    def home_worker(self, session_id):
+        return zlib.crc32(session_id) % self.worker_count
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_unix_server(lambda: IPCLinkProtocol(self), self.ipc_path(self.worker_index))
+        for worker in range(self.worker_count):
+            if worker != self.worker_index:
+                self.links[worker] = await self.connect_link(worker)
+        await super().serve()
+
+    async def connect_link(self, worker, attempts=200):
+        loop = asyncio.get_running_loop()
+        for _ in range(attempts):
+            try:
+                transport, _ = await loop.create_unix_connection(asyncio.Protocol, self.ipc_path(worker))
+                return transport
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.05)
+        raise RuntimeError(f"Worker {self.worker_index} could not reach worker {worker}")
+
+    def send_ipc(self, worker, frame_type, conn_id, payload=b''):
+        self.links[worker].write(encode_frame(frame_type, ROUTE.pack(self.worker_index, conn_id) + payload))
+
+    # Edge side: this worker holds the client socket, the home worker the session.
+
+    def open_proxy(self, protocol, home, public_key):
+        protocol.conn_id = next(self.conn_ids)
+        protocol.home = home
+        self.proxies[protocol.conn_id] = protocol
+        self.send_ipc(home, JOIN, protocol.conn_id, protocol.session_id)
+        self.send_ipc(home, PUBLIC_KEY, protocol.conn_id, public_key)
+
+    def close_proxy(self, protocol):
+        if self.proxies.pop(protocol.conn_id, None) is not None:
+            self.send_ipc(protocol.home, IPC_CLIENT_GONE, protocol.conn_id)
+
+    # Home side: frames from, and for, clients proxied by other workers.
+
+    def ipc_frame_received(self, frame_type, worker, conn_id, payload):
+        if frame_type == IPC_DELIVER:
+            protocol = self.proxies.get(conn_id)
+            if protocol is not None:
+                protocol.transport.write(bytes(payload))
+            return
+        if frame_type == IPC_CLOSE_CLIENT:
+            protocol = self.proxies.pop(conn_id, None)
+            if protocol is not None:
+                protocol.transport.close()
+            return
+
+        client_id = ('worker', worker, conn_id)
+        if frame_type == MESSAGE:
+            self.route_message(client_id, payload)
+        elif frame_type == STORED_MESSAGE:
+            self.route_stored(client_id, payload)
+        elif frame_type == JOIN:
+            self.remote_sessions[client_id] = bytes(payload)
+        elif frame_type == PUBLIC_KEY:
+            transport = RemoteTransport(self, worker, conn_id)
+            session_id = self.remote_sessions.pop(client_id)
+            try:
+                self.join_session(transport, client_id, session_id, bytes(payload))
+            except SessionFull as e:
+                print(f"Rejecting client {client_id}: {e}")
+                transport.write(encode_frame(DISCONNECT))
+                transport.close()
+        elif frame_type == IPC_CLIENT_GONE:
+            self.remote_sessions.pop(client_id, None)
+            self.remove_client(client_id)
+
+
+def run_worker(worker_index, worker_count, ipc_dir, host, port, server_options):
+    if server_options.get('metrics_port') is not None:
+        server_options = dict(server_options, metrics_port=server_options['metrics_port'] + worker_index)
+    server = WorkerChatServer(host, port, worker_index, worker_count, ipc_dir, **server_options)
+    server.start_server()
+
+
+def run_workers(host, port, worker_count, **server_options):
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit("Multi-process mode needs SO_REUSEPORT, which this platform lacks.")
+    ipc_dir = tempfile.mkdtemp(prefix='secure-chat-')
+    processes = [
+        multiprocessing.Process(target=run_worker, daemon=True,
+                                args=(index, worker_count, ipc_dir, host, port, server_options))
+        for index in range(worker_count)
+    ]
+    print(f"Starting {worker_count} workers on {host}:{port}")
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("Server is shutting down.")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        shutil.rmtree(ipc_dir, ignore_errors=True)
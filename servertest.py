@@ -0,0 +1,627 @@
+import os
+import unittest
+import socket
+import asyncio
+import threading
+import time
+import shutil
+import tempfile
+from concurrent.futures import Future
+from protocol import (FrameParser, encode_frame, decode_resume_result, REQUEST_PUBLIC_KEY, PUBLIC_KEY,
+                      PEER_PUBLIC_KEY, DISCONNECT, MESSAGE, JOIN, RESUME, RESUME_TOKEN, RESUME_RESULT,
+                      PEER_LEFT, STORED_MESSAGE)
+from server import ChatServer
+from server_async import AsyncChatServer
+from server_workers import WorkerChatServer
+from server_outbound import OutboundQueue, DROP, DISCONNECT_CLIENT, BLOCK
+from offline_store import OfflineStore, mailbox_of
+from loadtest import run_benchmark
+
+
+class FrameClient:
+    """Minimal blocking client speaking the framed protocol."""
+
+    def __init__(self, port, session_id=b'', public_key=b'KEY', resumable=False, resume_token=None):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.parser = FrameParser()
+        self.frames = []
+        self.expect(REQUEST_PUBLIC_KEY)
+        if resume_token is not None:
+            self.sock.sendall(encode_frame(RESUME, resume_token))
+            return
+        hello = encode_frame(RESUME) if resumable else b''
+        self.sock.sendall(hello + encode_frame(JOIN, session_id) + encode_frame(PUBLIC_KEY, public_key))
+
+    def read_frame(self):
+        while not self.frames:
+            if self.parser.recv_into(self.sock) == 0:
+                return None, b''
+            self.frames.extend((frame_type, bytes(payload)) for frame_type, payload in self.parser.frames())
+        return self.frames.pop(0)
+
+    def expect(self, frame_type):
+        received_type, payload = self.read_frame()
+        if received_type != frame_type:
+            raise AssertionError(f"Expected frame {frame_type}, got {received_type}")
+        return payload
+
+    def send(self, payload):
+        self.sock.sendall(encode_frame(MESSAGE, payload))
+
+    def close(self):
+        self.sock.close()
+
+
+class ServerTestMixin:
+    """Relay behaviour shared by both server engines."""
+
+    def test_pair_exchanges_keys_and_messages(self):
+        alice = FrameClient(self.port, b'room', b'ALICE')
+        bob = FrameClient(self.port, b'room', b'BOB')
+        self.assertEqual(alice.expect(PEER_PUBLIC_KEY), b'BOB')
+        self.assertEqual(bob.expect(PEER_PUBLIC_KEY), b'ALICE')
+        alice.send(b'ciphertext')
+        self.assertEqual(bob.expect(MESSAGE), b'ciphertext')
+        bob.send(b'reply')
+        self.assertEqual(alice.expect(MESSAGE), b'reply')
+        alice.close()
+        bob.close()
+
+    def test_sessions_are_isolated(self):
+        a1 = FrameClient(self.port, b'one', b'A1')
+        b1 = FrameClient(self.port, b'two', b'B1')
+        a2 = FrameClient(self.port, b'one', b'A2')
+        b2 = FrameClient(self.port, b'two', b'B2')
+        self.assertEqual(a1.expect(PEER_PUBLIC_KEY), b'A2')
+        self.assertEqual(b1.expect(PEER_PUBLIC_KEY), b'B2')
+        a2.expect(PEER_PUBLIC_KEY)
+        b2.expect(PEER_PUBLIC_KEY)
+        a1.send(b'for a2')
+        b1.send(b'for b2')
+        self.assertEqual(a2.expect(MESSAGE), b'for a2')
+        self.assertEqual(b2.expect(MESSAGE), b'for b2')
+
+        # Leaving one conversation only tells that peer (these servers keep
+        # an offline store, so it stays).
+        a1.sock.sendall(encode_frame(DISCONNECT))
+        a2.expect(PEER_LEFT)
+        b2.send(b'still here')
+        self.assertEqual(b1.expect(MESSAGE), b'still here')
+        for client in (a1, a2, b1, b2):
+            client.close()
+
+    def test_full_session_rejects_third_client(self):
+        alice = FrameClient(self.port, b'room')
+        bob = FrameClient(self.port, b'room')
+        alice.expect(PEER_PUBLIC_KEY)
+        bob.expect(PEER_PUBLIC_KEY)
+        mallory = FrameClient(self.port, b'room')
+        mallory.expect(DISCONNECT)
+        alice.send(b'unaffected')
+        self.assertEqual(bob.expect(MESSAGE), b'unaffected')
+        for client in (alice, bob, mallory):
+            client.close()
+
+    def test_client_without_public_key_times_out(self):
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+        start = time.monotonic()
+        while sock.recv(4096):
+            pass
+        self.assertLess(time.monotonic() - start, 4)
+        sock.close()
+
+    def leave_alice_alone(self, session_id):
+        alice = FrameClient(self.port, session_id, b'ALICE')
+        bob = FrameClient(self.port, session_id, b'BOB')
+        alice.expect(PEER_PUBLIC_KEY)
+        bob.expect(PEER_PUBLIC_KEY)
+        bob.sock.sendall(encode_frame(DISCONNECT))
+        alice.expect(PEER_LEFT)
+        bob.close()
+        return alice
+
+    def test_messages_for_peer_that_left_are_replayed(self):
+        alice = self.leave_alice_alone(b'mailbox')
+        # Sequenced traffic is not stored, only what is meant for the peer's return.
+        alice.send(b'not stored')
+        alice.sock.sendall(encode_frame(STORED_MESSAGE, b'first') + encode_frame(STORED_MESSAGE, b'second'))
+        time.sleep(0.2)
+        bob = FrameClient(self.port, b'mailbox', b'BOB')
+        self.assertEqual(bob.expect(PEER_PUBLIC_KEY), b'ALICE')
+        self.assertEqual(alice.expect(PEER_PUBLIC_KEY), b'BOB')
+        self.assertEqual(bob.expect(STORED_MESSAGE), b'first')
+        self.assertEqual(bob.expect(STORED_MESSAGE), b'second')
+        alice.send(b'live')
+        self.assertEqual(bob.expect(MESSAGE), b'live')
+        self.assertEqual(self.server.metrics.counter('messages_stored'), 2)
+        alice.close()
+        bob.close()
+
+    def test_stored_messages_wait_for_their_recipient(self):
+        alice = self.leave_alice_alone(b'waiting')
+        alice.sock.sendall(encode_frame(STORED_MESSAGE, b'for bob'))
+        time.sleep(0.2)
+        # Someone else taking Bob's place is paired with Alice but gets
+        # nothing of Bob's; Alice leaving does not hand her own frames back.
+        carol = FrameClient(self.port, b'waiting', b'CAROL')
+        self.assertEqual(carol.expect(PEER_PUBLIC_KEY), b'ALICE')
+        alice.sock.sendall(encode_frame(DISCONNECT))
+        carol.expect(PEER_LEFT)
+        alice.close()
+        alice = FrameClient(self.port, b'waiting', b'ALICE')
+        self.assertEqual(alice.expect(PEER_PUBLIC_KEY), b'CAROL')
+        carol.send(b'hello')
+        self.assertEqual(alice.expect(MESSAGE), b'hello')
+        self.assertTrue(self.server.offline_store.has_messages(mailbox_of(b'waiting', b'BOB')))
+        alice.close()
+        carol.close()
+
+    def test_resumed_client_hears_its_peer_left(self):
+        alice = FrameClient(self.port, b'gone', b'ALICE', resumable=True)
+        token = alice.expect(RESUME_TOKEN)
+        bob = FrameClient(self.port, b'gone', b'BOB')
+        alice.expect(PEER_PUBLIC_KEY)
+        bob.expect(PEER_PUBLIC_KEY)
+        alice.close()
+        time.sleep(0.2)
+        bob.sock.sendall(encode_frame(DISCONNECT))
+        bob.close()
+        time.sleep(0.2)
+        alice = FrameClient(self.port, resume_token=token)
+        self.assertEqual(decode_resume_result(alice.expect(RESUME_RESULT)), (True, ''))
+        alice.expect(PEER_LEFT)
+        alice.close()
+
+    def test_dropped_client_resumes_its_place(self):
+        alice = FrameClient(self.port, b'resume', b'ALICE', resumable=True)
+        token = alice.expect(RESUME_TOKEN)
+        bob = FrameClient(self.port, b'resume', b'BOB')
+        self.assertEqual(alice.expect(PEER_PUBLIC_KEY), b'BOB')
+        bob.expect(PEER_PUBLIC_KEY)
+        # Gone without DISCONNECT: Bob keeps his conversation.
+        alice.close()
+        time.sleep(0.2)
+        self.assertEqual(len(self.server.detached), 1)
+        alice = FrameClient(self.port, resume_token=token)
+        self.assertEqual(decode_resume_result(alice.expect(RESUME_RESULT)), (True, ''))
+        alice.send(b'back')
+        self.assertEqual(bob.expect(MESSAGE), b'back')
+        bob.send(b'welcome back')
+        self.assertEqual(alice.expect(MESSAGE), b'welcome back')
+        self.assertEqual(self.server.metrics.counter('resumes'), 1)
+        alice.close()
+        bob.close()
+
+    def test_expired_resume_falls_back_to_join(self):
+        self.server.resume_timeout = 0.2
+        alice = FrameClient(self.port, b'expiry', b'ALICE', resumable=True)
+        token = alice.expect(RESUME_TOKEN)
+        alice.close()
+        deadline = time.monotonic() + 5
+        while (self.server.detached or self.server.resume_tokens) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        alice = FrameClient(self.port, resume_token=token)
+        ok, reason = decode_resume_result(alice.expect(RESUME_RESULT))
+        self.assertFalse(ok)
+        alice.sock.sendall(encode_frame(JOIN, b'expiry') + encode_frame(PUBLIC_KEY, b'ALICE'))
+        bob = FrameClient(self.port, b'expiry', b'BOB')
+        self.assertEqual(bob.expect(PEER_PUBLIC_KEY), b'ALICE')
+        self.assertEqual(alice.expect(PEER_PUBLIC_KEY), b'BOB')
+        alice.close()
+        bob.close()
+
+    def test_relay_is_counted_in_metrics(self):
+        alice = FrameClient(self.port, b'metrics', b'ALICE')
+        bob = FrameClient(self.port, b'metrics', b'BOB')
+        alice.expect(PEER_PUBLIC_KEY)
+        bob.expect(PEER_PUBLIC_KEY)
+        alice.send(b'0123456789')
+        bob.expect(MESSAGE)
+        metrics = self.server.metrics
+        # The relay may count the frame just after the peer has received it.
+        deadline = time.monotonic() + 2
+        while metrics.histogram('relay_latency') is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(metrics.counter('messages_relayed'), 1)
+        self.assertEqual(metrics.counter('bytes_relayed'), 10)
+        self.assertEqual(metrics.histogram('relay_latency').count, 1)
+        self.assertEqual(metrics.gauges['connections'], 2)
+        self.assertEqual(metrics.gauges['handshakes_in_flight'], 0)
+        self.assertIn('chat_messages_relayed_total 1', metrics.render())
+        self.assertIn('chat_outbound_queued_bytes 0', metrics.render())
+        alice.close()
+        bob.close()
+
+    def test_load_harness_reports_relay(self):
+        report = asyncio.run(run_benchmark('127.0.0.1', self.port, pairs=2, rate=50, size=64,
+                                           duration=0.5, key_bits=1024, server_pid=os.getpid()))
+        self.assertGreater(report['sent'], 0)
+        self.assertEqual(report['received'], report['sent'])
+        self.assertGreater(report['latency_p99_ms'], 0)
+        self.assertIn('server_threads', report)
+
+
+class TestThreadedServer(ServerTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.offline_dir = tempfile.mkdtemp()
+        self.server = ChatServer('127.0.0.1', 0, offline_dir=self.offline_dir, handshake_timeout=1.0)
+        threading.Thread(target=self.server.start_server, daemon=True).start()
+        while self.server.server_socket.getsockname()[1] == 0:
+            time.sleep(0.01)
+        self.port = self.server.server_socket.getsockname()[1]
+
+    def tearDown(self):
+        self.server.shutdown_server()
+        shutil.rmtree(self.offline_dir, ignore_errors=True)
+
+
+class AsyncServerMixin:
+    """An AsyncChatServer on its own loop thread, with an offline store
+    unless offline is False."""
+
+    offline = True
+
+    def setUp(self):
+        self.offline_dir = tempfile.mkdtemp() if self.offline else None
+        self.server = AsyncChatServer('127.0.0.1', 0, offline_dir=self.offline_dir, handshake_timeout=1.0)
+        self.loop = asyncio.new_event_loop()
+        self.task = self.loop.create_task(self.server.serve())
+        threading.Thread(target=self.run_loop, daemon=True).start()
+        while self.server.server is None or not self.server.server.sockets:
+            time.sleep(0.01)
+        self.port = self.server.server.sockets[0].getsockname()[1]
+
+    def run_loop(self):
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        while not self.task.done():
+            time.sleep(0.01)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.server.offline_store is not None:
+            self.server.store_executor.shutdown()
+            self.server.offline_store.close()
+            shutil.rmtree(self.offline_dir, ignore_errors=True)
+
+    def on_loop(self, function, *args):
+        """Run function on the server's loop, where its state lives, and
+        return the result."""
+        future = Future()
+
+        def call():
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+        self.loop.call_soon_threadsafe(call)
+        return future.result(5)
+
+
+class TestAsyncServer(AsyncServerMixin, ServerTestMixin, unittest.TestCase):
+    pass
+
+
+class TestAsyncEngine(AsyncServerMixin, unittest.TestCase):
+    """The asyncio engine's own bookkeeping, without an offline store."""
+
+    offline = False
+
+    def pair(self, session_id=b'room'):
+        alice = FrameClient(self.port, session_id, b'ALICE')
+        bob = FrameClient(self.port, session_id, b'BOB')
+        self.assertEqual(alice.expect(PEER_PUBLIC_KEY), b'BOB')
+        self.assertEqual(bob.expect(PEER_PUBLIC_KEY), b'ALICE')
+        # The server knows each client by its address.
+        return alice, bob, alice.sock.getsockname(), bob.sock.getsockname()
+
+    def state(self):
+        server = self.server
+        return {
+            'clients': set(server.clients),
+            'public_keys': dict(server.public_keys),
+            'sessions': len(server.sessions),
+            'peers': {client_id: server.sessions.peer_of(client_id) for client_id in server.clients},
+            'queue_depths': server.queue_depths(),
+        }
+
+    def wait_for_state(self, condition):
+        deadline = time.monotonic() + 5
+        state = self.on_loop(self.state)
+        while not condition(state) and time.monotonic() < deadline:
+            time.sleep(0.01)
+            state = self.on_loop(self.state)
+        return state
+
+    def test_pairing_records_both_clients(self):
+        alice, bob, alice_id, bob_id = self.pair()
+        state = self.on_loop(self.state)
+        self.assertEqual(state['clients'], {alice_id, bob_id})
+        self.assertEqual(state['public_keys'], {alice_id: b'ALICE', bob_id: b'BOB'})
+        self.assertEqual(state['sessions'], 1)
+        self.assertEqual(state['peers'], {alice_id: bob_id, bob_id: alice_id})
+        self.assertEqual(state['queue_depths'], {alice_id: 0, bob_id: 0})
+        self.assertEqual(self.server.metrics.gauges['handshakes_in_flight'], 0)
+        alice.close()
+        bob.close()
+
+    def test_messages_are_forwarded_in_order_both_ways(self):
+        alice, bob, _, _ = self.pair()
+        for n in range(20):
+            alice.send(f'a{n}'.encode())
+            bob.send(f'b{n}'.encode())
+        self.assertEqual([bob.expect(MESSAGE) for _ in range(20)], [f'a{n}'.encode() for n in range(20)])
+        self.assertEqual([alice.expect(MESSAGE) for _ in range(20)], [f'b{n}'.encode() for n in range(20)])
+        self.assertEqual(self.server.metrics.counter('messages_relayed'), 40)
+        alice.close()
+        bob.close()
+
+    def test_disconnect_ends_the_conversation(self):
+        alice, bob, _, _ = self.pair()
+        alice.sock.sendall(encode_frame(DISCONNECT))
+        self.assertEqual(bob.read_frame()[0], DISCONNECT)
+        self.assertEqual(bob.read_frame()[0], None)
+        state = self.wait_for_state(lambda state: not state['clients'])
+        self.assertEqual(state['clients'], set())
+        self.assertEqual(state['public_keys'], {})
+        self.assertEqual(state['sessions'], 0)
+        self.assertEqual(state['queue_depths'], {})
+        alice.close()
+        bob.close()
+
+    def test_dropped_connection_ends_the_conversation(self):
+        alice, bob, _, _ = self.pair()
+        other_alice, other_bob, other_alice_id, other_bob_id = self.pair(b'other')
+        alice.close()
+        self.assertEqual(bob.read_frame()[0], DISCONNECT)
+        state = self.wait_for_state(lambda state: len(state['clients']) == 2)
+        # The other conversation carries on.
+        self.assertEqual(state['clients'], {other_alice_id, other_bob_id})
+        self.assertEqual(state['sessions'], 1)
+        other_alice.send(b'unaffected')
+        self.assertEqual(other_bob.expect(MESSAGE), b'unaffected')
+        self.assertEqual(self.server.metrics.gauges['connections'], 2)
+        for client in (bob, other_alice, other_bob):
+            client.close()
+
+    def test_queued_bytes_gauge_is_updated_on_the_loop(self):
+        alice, bob, _, _ = self.pair()
+        self.server.metrics.set_gauge('outbound_queued_bytes', -1)
+        self.on_loop(self.server.update_gauges)
+        self.assertEqual(self.server.metrics.gauges['outbound_queued_bytes'], 0)
+        alice.close()
+        bob.close()
+
+
+class TestAsyncEngineWithStore(TestAsyncEngine):
+    """The same, with an offline store keeping the survivor in place."""
+
+    offline = True
+
+    def test_disconnect_ends_the_conversation(self):
+        alice, bob, alice_id, bob_id = self.pair()
+        bob.sock.sendall(encode_frame(DISCONNECT))
+        alice.expect(PEER_LEFT)
+        state = self.wait_for_state(lambda state: len(state['clients']) == 1)
+        self.assertEqual(state['clients'], {alice_id})
+        self.assertEqual(state['public_keys'], {alice_id: b'ALICE'})
+        self.assertEqual(state['sessions'], 1)
+        self.assertEqual(self.on_loop(dict, self.server.absent), {alice_id: mailbox_of(b'room', b'BOB')})
+        alice.close()
+        bob.close()
+
+    def test_client_that_drops_during_replay_keeps_the_rest(self):
+        server = self.server
+        server.offline_store.segment_bytes = 1  # one frame per segment
+        mailbox = mailbox_of(b'room', b'BOB')
+        for payload in (b'first', b'second', b'third'):
+            server.offline_store.append(mailbox, STORED_MESSAGE, payload)
+        written = []
+
+        class DroppingTransport:
+            """Loses its connection once the first segment is written."""
+
+            def write(self, data):
+                written.append(data)
+                server.remove_client('gone')
+
+            def close(self):
+                pass
+
+        def join():
+            server.clients['gone'] = DroppingTransport()
+            server.replaying['gone'] = []
+            server.read_stored('gone', mailbox, None, 0)
+        self.on_loop(join)
+        deadline = time.monotonic() + 5
+        while len(server.offline_store.segment_paths(mailbox)) != 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(written, [encode_frame(STORED_MESSAGE, b'first')])
+        self.assertEqual(len(server.offline_store.segment_paths(mailbox)), 2)
+
+        # The rest reach the client when it comes back.
+        bob = FrameClient(self.port, b'room', b'BOB')
+        self.assertEqual(bob.expect(STORED_MESSAGE), b'second')
+        self.assertEqual(bob.expect(STORED_MESSAGE), b'third')
+        bob.close()
+
+    def test_dropped_connection_ends_the_conversation(self):
+        alice, bob, alice_id, _ = self.pair()
+        bob.close()
+        alice.expect(PEER_LEFT)
+        # Alice leaving too ends the session and clears what was kept for her.
+        alice.close()
+        state = self.wait_for_state(lambda state: not state['clients'])
+        self.assertEqual(state['clients'], set())
+        self.assertEqual(state['sessions'], 0)
+        self.assertEqual(self.on_loop(dict, self.server.absent), {})
+
+
+class TestWorkerServers(unittest.TestCase):
+    """Peers on different worker processes are routed over the IPC links."""
+
+    def setUp(self):
+        self.ipc_dir = tempfile.mkdtemp()
+        self.loops = []
+        self.ports = []
+        servers = [WorkerChatServer('127.0.0.1', 0, index, 2, self.ipc_dir, reuse_port=False)
+                   for index in range(2)]
+        for server in servers:
+            loop = asyncio.new_event_loop()
+            task = loop.create_task(server.serve())
+            threading.Thread(target=self.run_loop, args=(loop, task), daemon=True).start()
+            self.loops.append((loop, task))
+        for server in servers:
+            while server.server is None or not server.server.sockets:
+                time.sleep(0.01)
+            self.ports.append(server.server.sockets[0].getsockname()[1])
+        self.servers = servers
+
+    def run_loop(self, loop, task):
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+
+    def tearDown(self):
+        for loop, task in self.loops:
+            loop.call_soon_threadsafe(task.cancel)
+        shutil.rmtree(self.ipc_dir, ignore_errors=True)
+
+    def test_cross_worker_routing(self):
+        # Try both home workers so either side may be the proxied one.
+        for session_id in (b'alpha', b'beta', b'gamma', b'delta'):
+            alice = FrameClient(self.ports[0], session_id, b'ALICE')
+            bob = FrameClient(self.ports[1], session_id, b'BOB')
+            self.assertEqual(alice.expect(PEER_PUBLIC_KEY), b'BOB')
+            self.assertEqual(bob.expect(PEER_PUBLIC_KEY), b'ALICE')
+            alice.send(b'hello bob')
+            self.assertEqual(bob.expect(MESSAGE), b'hello bob')
+            bob.send(b'hello alice')
+            self.assertEqual(alice.expect(MESSAGE), b'hello alice')
+            alice.sock.sendall(encode_frame(DISCONNECT))
+            bob.expect(DISCONNECT)
+            alice.close()
+            bob.close()
+        homes = {self.servers[0].home_worker(s) for s in (b'alpha', b'beta', b'gamma', b'delta')}
+        self.assertEqual(homes, {0, 1})
+        # Proxied clients are counted out and their timers dropped too.
+        deadline = time.monotonic() + 5
+        while (any(server.metrics.gauges['connections'] for server in self.servers)
+               and time.monotonic() < deadline):
+            time.sleep(0.01)
+        self.assertEqual([server.metrics.gauges['connections'] for server in self.servers], [0, 0])
+        self.assertEqual([len(server.timers) for server in self.servers], [0, 0])
+
+
+class TestOutboundQueue(unittest.TestCase):
+    """Overflow policies of the per-client outbound queue."""
+
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+        self.left.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.payload = b'x' * 65536
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def fill(self, queue, count=64):
+        return [queue.put(MESSAGE, self.payload) for _ in range(count)]
+
+    def test_drop_policy(self):
+        queue = OutboundQueue(self.left, 'slow', max_bytes=256 * 1024, policy=DROP)
+        results = self.fill(queue)
+        self.assertIn(False, results)
+        self.assertEqual(queue.dropped, results.count(False))
+        self.assertLessEqual(queue.depth()[1], 256 * 1024 + len(self.payload) + 5)
+        queue.close()
+
+    def test_disconnect_policy(self):
+        failed = threading.Event()
+        queue = OutboundQueue(self.left, 'slow', max_bytes=256 * 1024, policy=DISCONNECT_CLIENT,
+                              on_failure=failed.set)
+        self.fill(queue)
+        self.assertTrue(failed.is_set())
+        self.assertFalse(queue.put(MESSAGE, b'after close'))
+
+    def test_block_policy_waits_for_reader(self):
+        queue = OutboundQueue(self.left, 'slow', max_bytes=256 * 1024, policy=BLOCK)
+        sender = threading.Thread(target=self.fill, args=(queue, 16))
+        sender.start()
+        sender.join(0.2)
+        self.assertTrue(sender.is_alive())
+
+        parser = FrameParser()
+        received = 0
+        while received < 16:
+            parser.recv_into(self.right)
+            received += sum(1 for _ in parser.frames())
+        sender.join(5)
+        self.assertFalse(sender.is_alive())
+        queue.close()
+
+
+class TestOfflineStore(unittest.TestCase):
+    """Segment rotation and replay of the offline message store."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = OfflineStore(self.directory, segment_bytes=64)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def replay(self, recipient):
+        frames = []
+        self.store.replay(recipient, lambda frame_type, payload: frames.append((frame_type, bytes(payload))))
+        return frames
+
+    def test_rotation_preserves_order(self):
+        payloads = [b'message %d' % i + b'.' * 20 for i in range(10)]
+        for payload in payloads:
+            self.store.append(b'room', MESSAGE, payload)
+        self.assertGreater(len(self.store.segment_paths(b'room')), 1)
+        self.assertEqual(self.replay(b'room'), [(MESSAGE, payload) for payload in payloads])
+        self.assertFalse(self.store.has_messages(b'room'))
+        self.assertEqual(self.replay(b'room'), [])
+
+    def test_recipients_are_separate(self):
+        self.store.append(b'one', MESSAGE, b'for one')
+        self.store.append(b'two', MESSAGE, b'for two')
+        self.assertEqual(self.replay(b'two'), [(MESSAGE, b'for two')])
+        self.assertEqual(self.replay(b'one'), [(MESSAGE, b'for one')])
+
+    def test_torn_record_is_ignored(self):
+        self.store.append(b'room', MESSAGE, b'complete')
+        self.store.close_segment(b'room')
+        with open(self.store.segment_paths(b'room')[-1], 'ab') as segment:
+            segment.write(encode_frame(MESSAGE, b'torn')[:-2])
+        self.assertEqual(self.replay(b'room'), [(MESSAGE, b'complete')])
+
+    def test_undelivered_frames_stay_stored(self):
+        payloads = [b'message %d' % i + b'.' * 20 for i in range(10)]
+        for payload in payloads:
+            self.store.append(b'room', MESSAGE, payload)
+        taken = []
+
+        def deliver(frame_type, payload):
+            # The recipient goes away after four frames.
+            if len(taken) == 4:
+                return False
+            taken.append(bytes(payload))
+            return True
+
+        self.assertEqual(self.store.replay(b'room', deliver), 4)
+        self.assertEqual(taken, payloads[:4])
+        self.assertEqual(self.replay(b'room'), [(MESSAGE, payload) for payload in payloads[4:]])
+        self.assertFalse(self.store.has_messages(b'room'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+# Cold-start timing for client.py. Each run starts a fresh interpreter with
+# --startup-report, so the client exits as soon as its login window has
+# painted and the chat modules have loaded behind it. One more run under
+# -X importtime breaks the imports down by top-level package, split into
+# those paid before the first window and those deferred until after it.
+# The breakdown also counts imports on the client's other threads and in
+# its key generator process, which run alongside the GUI thread: the
+# first-window time, not the import total, is what the user waits for.
+# Results are JSON, so a run can be saved and later runs compared with it:
+#
+#   python3 startupbench.py --output baseline.json
+#   python3 startupbench.py --compare baseline.json      # exit 1 on regression
+#
+# Without a display, pass --platform offscreen.
+
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client.py')
+DEFAULT_RUNS = 5
+DEFAULT_TOP = 10
+DEFAULT_THRESHOLD = 0.20
+FIRST_WINDOW = re.compile(r'Startup: first window painted after ([\d.]+) ms')
+CHAT_MODULES = re.compile(r'Startup: chat modules loaded after ([\d.]+) ms')
+IMPORT_TIME = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)')
+
+
+def run_client(platform_name=None, importtime=False, timeout=60):
+    """Start client.py once; returns (milliseconds to each report line
+    measured from process start, stderr lines)."""
+    env = dict(os.environ)
+    if platform_name:
+        env['QT_QPA_PLATFORM'] = platform_name
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else [])
+    with tempfile.TemporaryDirectory() as directory:
+        # Keep the run's accounts database out of the working directory.
+        command += [CLIENT, '--startup-report', '--database', os.path.join(directory, 'users.db')]
+        started = time.perf_counter()
+        process = subprocess.Popen(command, env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                   text=True)
+        timings = {}
+        lines = []
+        try:
+            for line in process.stderr:
+                lines.append(line.rstrip('\n'))
+                for name, pattern in (('first_window_ms', FIRST_WINDOW), ('chat_modules_ms', CHAT_MODULES)):
+                    if pattern.search(line):
+                        timings[name] = (time.perf_counter() - started) * 1000
+            process.wait(timeout)
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+    if process.returncode != 0 or len(timings) < 2:
+        raise RuntimeError(f"client.py exited with status {process.returncode}:\n" + '\n'.join(lines[-20:]))
+    return timings, lines
+
+
+def import_breakdown(lines, top=DEFAULT_TOP):
+    """Sum -X importtime self times by top-level package, before and after
+    the first window painted."""
+    phases = {'before_first_window': {}, 'after_first_window': {}}
+    phase = phases['before_first_window']
+    for line in lines:
+        if FIRST_WINDOW.search(line):
+            phase = phases['after_first_window']
+            continue
+        match = IMPORT_TIME.match(line)
+        if match is None:
+            continue
+        package = match.group(4).split('.')[0]
+        phase[package] = phase.get(package, 0) + int(match.group(1))
+    breakdown = {}
+    for name, packages in phases.items():
+        ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+        breakdown[name] = {
+            'total_ms': round(sum(packages.values()) / 1000, 3),
+            'top': [[package, round(us / 1000, 3)] for package, us in ranked[:top]],
+        }
+    return breakdown
+
+
+def summarize(samples):
+    return {'median': round(statistics.median(samples), 3), 'min': round(min(samples), 3),
+            'max': round(max(samples), 3)}
+
+
+def run(runs=DEFAULT_RUNS, platform_name=None, top=DEFAULT_TOP, report=None):
+    samples = {'first_window_ms': [], 'chat_modules_ms': []}
+    # The first start warms the OS file cache; it is not counted.
+    run_client(platform_name)
+    for n in range(runs):
+        timings, _ = run_client(platform_name)
+        for name, value in timings.items():
+            samples[name].append(value)
+        if report is not None:
+            report(n, timings)
+    _, lines = run_client(platform_name, importtime=True)
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'qt_platform': platform_name or os.environ.get('QT_QPA_PLATFORM', ''),
+            'runs': runs,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': {name: summarize(values) for name, values in samples.items()},
+        'imports': import_breakdown(lines, top),
+    }
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Return [(name, baseline median, current median, change)] and the
+    names whose median got slower by more than threshold."""
+    rows = []
+    regressions = []
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        change = result['median'] / before['median'] - 1
+        rows.append((name, before['median'], result['median'], change))
+        if change > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def print_run(n, timings):
+    print(f"run {n + 1}: first window {timings['first_window_ms']:.1f} ms, "
+          f"chat modules {timings['chat_modules_ms']:.1f} ms", file=sys.stderr)
+
+
+def print_breakdown(breakdown):
+    for phase, result in breakdown.items():
+        print(f"imports {phase.replace('_', ' ')}: {result['total_ms']:.1f} ms", file=sys.stderr)
+        for package, ms in result['top']:
+            print(f"  {package:<30} {ms:>8.1f} ms", file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Cold-start timing for the chat client")
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS, help="timed starts (default 5)")
+    parser.add_argument('--platform', help="Qt platform plugin to use, e.g. offscreen")
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP, help="packages to list per import phase")
+    parser.add_argument('--output', help="write the JSON results here (default: stdout)")
+    parser.add_argument('--compare', metavar='BASELINE', help="compare with a saved JSON run")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="fractional slowdown that counts as a regression (default 0.20)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    current = run(args.runs, args.platform, args.top, print_run)
+    print_breakdown(current['imports'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+    elif not args.compare:
+        print(json.dumps(current, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows, regressions = compare(baseline, current, args.threshold)
+        for name, before, after, change in rows:
+            flag = "  REGRESSION" if name in regressions else ""
+            print(f"{name:<20} {before:>10.1f} -> {after:>10.1f} ms {change:>+8.1%}{flag}")
+        if regressions:
+            print(f"{len(regressions)} measure(s) slower than the baseline by more than {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+import math
+import time
+import threading
+
+
+class Timer:
+    __slots__ = ('callback', 'args', 'slot', 'rounds', 'active')
+
+    def __init__(self, callback, args, slot, rounds):
+        self.callback = callback
+        self.args = args
+        self.slot = slot
+        self.rounds = rounds
+        self.active = True
+
+
+class TimerWheel:
+    """Hashed timer wheel: O(1) schedule and cancel, no thread of its own.
+
+    Time is divided into ticks of `tick` seconds spread over `slots` buckets;
+    a timer further out than one revolution carries a round counter. The
+    owner drives the wheel by calling advance() at least once per tick from
+    a loop it already runs (an accept loop, an event loop, a Qt timer), and
+    expired callbacks run on that caller's thread.
+    """
+
+    def __init__(self, tick=0.5, slots=512, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.buckets = [set() for _ in range(slots)]
+        self.current = 0
+        self.last_tick_time = clock()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(bucket) for bucket in self.buckets)
+
+    def schedule(self, delay, callback, *args):
+        ticks = max(1, math.ceil(delay / self.tick))
+        slots = len(self.buckets)
+        with self.lock:
+            slot = (self.current + ticks) % slots
+            timer = Timer(callback, args, slot, (ticks - 1) // slots)
+            self.buckets[slot].add(timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer is None:
+            return
+        with self.lock:
+            if timer.active:
+                timer.active = False
+                self.buckets[timer.slot].discard(timer)
+
+    def advance(self):
+        now = self.clock()
+        expired = []
+        with self.lock:
+            while now - self.last_tick_time >= self.tick:
+                self.last_tick_time += self.tick
+                self.current = (self.current + 1) % len(self.buckets)
+                bucket = self.buckets[self.current]
+                for timer in list(bucket):
+                    if timer.rounds:
+                        timer.rounds -= 1
+                    else:
+                        bucket.discard(timer)
+                        timer.active = False
+                        expired.append(timer)
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                print(f"Error in timer callback: {e}")
+        return len(expired)
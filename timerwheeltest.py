@@ -0,0 +1,61 @@
+import unittest
+from timer_wheel import TimerWheel
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTimerWheel(unittest.TestCase):
+    """Test cases for the hashed timer wheel."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wheel = TimerWheel(tick=1.0, slots=8, clock=self.clock)
+        self.fired = []
+
+    def advance_to(self, now):
+        self.clock.now = now
+        return self.wheel.advance()
+
+    def test_fires_after_delay(self):
+        self.wheel.schedule(3, self.fired.append, 'a')
+        self.advance_to(2)
+        self.assertEqual(self.fired, [])
+        self.advance_to(3)
+        self.assertEqual(self.fired, ['a'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel(self):
+        timer = self.wheel.schedule(2, self.fired.append, 'a')
+        self.wheel.cancel(timer)
+        self.wheel.cancel(timer)
+        self.advance_to(10)
+        self.assertEqual(self.fired, [])
+
+    def test_delay_longer_than_one_revolution(self):
+        self.wheel.schedule(20, self.fired.append, 'late')
+        self.wheel.schedule(4, self.fired.append, 'early')
+        self.advance_to(12)
+        self.assertEqual(self.fired, ['early'])
+        self.advance_to(19)
+        self.assertEqual(self.fired, ['early'])
+        self.advance_to(20)
+        self.assertEqual(self.fired, ['early', 'late'])
+
+    def test_callback_can_reschedule(self):
+        def tick():
+            self.fired.append(self.clock.now)
+            if len(self.fired) < 3:
+                self.wheel.schedule(2, tick)
+        self.wheel.schedule(2, tick)
+        for now in range(1, 10):
+            self.advance_to(now)
+        self.assertEqual(self.fired, [2, 4, 6])
+
+
+if __name__ == '__main__':
+    unittest.main()
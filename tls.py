@@ -0,0 +1,69 @@
+import ssl
+
+# Full TLS handshakes with the 4096-bit server key are expensive, so both
+# sides are set up for resumption: the server issues session tickets and the
+# client hands its last session back on reconnect.
+
+SESSION_TICKETS = 2
+HANDSHAKE_TIMEOUT = 10.0
+
+
+def create_server_context(certfile, keyfile):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = SESSION_TICKETS
+    return context
+
+
+def create_client_context(cafile=None):
+    context = ResumingClientContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.sessions = ClientSessionCache()
+    if cafile:
+        context.load_verify_locations(cafile=cafile)
+    else:
+        context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.check_hostname = True
+    return context
+
+
+class ClientSessionCache:
+    """Remembers the last TLS session per server so reconnects can resume it."""
+
+    def __init__(self):
+        self.sessions = {}
+
+    def get(self, server_hostname):
+        return self.sessions.get(server_hostname)
+
+    def store(self, server_hostname, ssl_object):
+        # TLS 1.3 tickets arrive after the handshake, so this is called on the
+        # way out as well as right after connecting.
+        try:
+            session = ssl_object.session
+        except (AttributeError, ValueError):
+            return
+        if session is not None:
+            self.sessions[server_hostname] = session
+
+
+class ResumingClientContext(ssl.SSLContext):
+    """A client context that offers each server the last session it gave us.
+
+    asyncio wraps its connections with wrap_bio and has no way to pass a
+    session in, so the context looks it up in its ClientSessionCache.
+    Sessions only resume on the context that made them, so connections to
+    the same server should share one context.
+    """
+
+    sessions = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side and self.sessions is not None:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def save_session(self, ssl_object):
+        if self.sessions is not None:
+            self.sessions.store(ssl_object.server_hostname, ssl_object)
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from client_crypto import CryptoManager
+from client_pipeline import DecryptPipeline
+from client_transfer import FileTransferManager
+
+
+class Peer:
+    """One side of a transfer, wired straight to the other side's pipeline."""
+
+    def __init__(self, crypto_manager, download_dir, chunk_size, window_bytes):
+        self.crypto_manager = crypto_manager
+        self.other = None
+        self.send_lock = threading.Lock()
+        self.notes = []
+        self.linked = True
+        self.manager = FileTransferManager(crypto_manager, self.send_record, self.send_chunk,
+                                           self.progress, self.notes.append, download_dir,
+                                           chunk_size=chunk_size, window_bytes=window_bytes)
+        self.pipeline = DecryptPipeline(crypto_manager, lambda plaintext: None, self.notes.append,
+                                        on_control=self.manager.handle_control,
+                                        on_chunk=self.manager.handle_chunk)
+        self.max_in_flight = 0
+        self.chunks_sent = 0
+        self.stop_after_chunks = None
+
+    def send_record(self, kind, plaintext):
+        with self.send_lock:
+            self.deliver(self.crypto_manager.encrypt_payload(plaintext, kind))
+
+    def send_chunk(self, record):
+        with self.send_lock:
+            if self.stop_after_chunks is not None and self.chunks_sent >= self.stop_after_chunks:
+                raise ConnectionError("link down")
+            self.chunks_sent += 1
+            self.deliver(bytes(record))
+
+    def deliver(self, payload):
+        if self.linked:
+            self.other.pipeline.submit(payload)
+
+    def progress(self, name, done, total):
+        for transfer in list(self.manager.outgoing.values()):
+            self.max_in_flight = max(self.max_in_flight, transfer.sent - transfer.acked)
+
+
+class TestFileTransfer(unittest.TestCase):
+    """Test cases for chunked, flow-controlled, resumable file transfer."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.alice_keys = CryptoManager(key_size=1024)
+        cls.bob_keys = CryptoManager(key_size=1024)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'report.bin')
+        self.data = os.urandom(1_000_000 + 123)
+        with open(self.source, 'wb') as f:
+            f.write(self.data)
+        self.downloads = os.path.join(self.directory, 'downloads')
+        self.alice = Peer(self.alice_keys, os.path.join(self.directory, 'alice'), 16384, 65536)
+        self.bob = Peer(self.bob_keys, self.downloads, 16384, 65536)
+        self.alice.other, self.bob.other = self.bob, self.alice
+        self.start_session()
+
+    def tearDown(self):
+        self.alice.pipeline.close()
+        self.bob.pipeline.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def start_session(self):
+        for peer in (self.alice, self.bob):
+            peer.crypto_manager.set_peer_public_key(peer.other.crypto_manager.get_public_key())
+        for peer in (self.alice, self.bob):
+            peer.deliver(peer.crypto_manager.create_session_key())
+
+    def wait_for(self, condition, timeout=30):
+        event = threading.Event()
+        for _ in range(int(timeout * 100)):
+            if condition():
+                return True
+            event.wait(0.01)
+        return False
+
+    def received(self):
+        path = os.path.join(self.downloads, 'report.bin')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_file_arrives_intact_within_window(self):
+        self.alice.manager.send_file(self.source)
+        self.assertTrue(self.wait_for(lambda: not self.alice.manager.outgoing))
+        self.assertEqual(self.received(), self.data)
+        self.assertLessEqual(self.alice.max_in_flight, 65536)
+        self.assertFalse([name for name in os.listdir(self.downloads) if name.endswith('.part')])
+
+    def test_interrupted_transfer_resumes_from_offset(self):
+        self.alice.stop_after_chunks = 20
+        self.alice.manager.send_file(self.source)
+        self.assertTrue(self.wait_for(lambda: any('stopped' in note for note in self.alice.notes)))
+        self.assertTrue(self.wait_for(lambda: self.bob.pipeline.depths() == {'decrypt': 0, 'delivery': 0}))
+        self.alice.manager.connection_lost()
+        self.bob.manager.connection_lost()
+        part = [name for name in os.listdir(self.downloads) if name.endswith('.part')]
+        self.assertEqual(len(part), 1)
+        partial = os.path.getsize(os.path.join(self.downloads, part[0]))
+        self.assertGreater(partial, 0)
+
+        self.alice.stop_after_chunks = None
+        self.alice.chunks_sent = 0
+        self.start_session()
+        self.alice.manager.resume()
+        self.assertTrue(self.wait_for(lambda: not self.alice.manager.outgoing))
+        self.assertEqual(self.received(), self.data)
+        self.assertLess(self.alice.chunks_sent, len(self.data) // 16384 + 1)
+        self.assertTrue(any('resuming at' in note for note in self.bob.notes))
+
+
+if __name__ == '__main__':
+    unittest.main()